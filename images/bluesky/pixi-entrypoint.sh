@@ -0,0 +1,8 @@
+#!/usr/bin/bash
+# Activate the pixi environment baked into the image at build time and exec
+# the command, so container starts do not re-check the environment against
+# pixi.lock the way `pixi run` does.
+if [ -n "$NBS_PIXI_ENV" ] && [ -f "/etc/pixi/activate-$NBS_PIXI_ENV.sh" ]; then
+    source "/etc/pixi/activate-$NBS_PIXI_ENV.sh"
+fi
+exec "$@"
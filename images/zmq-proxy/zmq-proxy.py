@@ -0,0 +1,277 @@
+"""Forward bluesky documents between ZMQ publishers and subscribers.
+
+A drop-in replacement for ``bluesky-0MQ-proxy IN_PORT OUT_PORT`` that only
+needs pyzmq. RunEngines publish to IN_PORT; RemoteDispatchers (live GUIs,
+viewers) subscribe on OUT_PORT. Messages are forwarded unchanged.
+
+Unlike a plain forwarder, the proxy counts the messages it cannot deliver.
+The subscriber side does not drop messages silently: when a subscriber's
+queue holds ``--sndhwm`` messages, the proxy waits up to ``--send-timeout``
+milliseconds for it to catch up. If it does not, the message is dropped
+and counted, as is every message until the subscriber has room again.
+Dropped messages are dropped for all subscribers. Counters of received,
+forwarded and dropped messages, and the number of connected publishers
+and subscribers, are served in the Prometheus text format on
+``--metrics-port``. Drops are also logged every ``--stats-interval``
+seconds in which they happened.
+
+Every option can also be set with the environment variable shown in
+``--help``.
+"""
+
+import argparse
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import zmq
+from zmq.utils.monitor import recv_monitor_message
+
+# Socket events that change the number of connected peers
+CONNECT_EVENTS = {zmq.EVENT_ACCEPTED: 1, zmq.EVENT_DISCONNECTED: -1}
+
+
+def log(message):
+    print(f"zmq-proxy: {message}", flush=True)
+
+
+class Counters:
+    """Proxy statistics, written by the proxy loop and read by the metrics server."""
+
+    def __init__(self, name):
+        self.name = name
+        self.received = 0
+        self.forwarded = 0
+        self.dropped = 0
+        self.bytes = 0
+        self.publishers = 0
+        self.subscribers = 0
+
+    def render(self):
+        """Render the counters in the Prometheus text format."""
+        label = f'{{proxy="{self.name}"}}'
+        metrics = (
+            ("messages_received_total", "counter", "Messages received from publishers", self.received),
+            ("messages_forwarded_total", "counter", "Messages forwarded to subscribers", self.forwarded),
+            ("messages_dropped_total", "counter", "Messages dropped because a subscriber was full", self.dropped),
+            ("bytes_forwarded_total", "counter", "Bytes forwarded to subscribers", self.bytes),
+            ("publishers", "gauge", "Connected publishers", self.publishers),
+            ("subscribers", "gauge", "Connected subscribers", self.subscribers),
+        )
+        lines = []
+        for name, kind, help_text, value in metrics:
+            lines += [
+                f"# HELP zmq_proxy_{name} {help_text}",
+                f"# TYPE zmq_proxy_{name} {kind}",
+                f"zmq_proxy_{name}{label} {value}",
+            ]
+        return "\n".join(lines) + "\n"
+
+
+def serve_metrics(counters, port):
+    """Serve ``/metrics`` in a background thread."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = counters.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("0.0.0.0", port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def configure(socket, args, send):
+    """Apply the high-water mark and kernel buffer options to a socket."""
+    if send:
+        socket.setsockopt(zmq.SNDHWM, args.sndhwm)
+        if args.sndbuf:
+            socket.setsockopt(zmq.SNDBUF, args.sndbuf)
+    else:
+        socket.setsockopt(zmq.RCVHWM, args.rcvhwm)
+        if args.rcvbuf:
+            socket.setsockopt(zmq.RCVBUF, args.rcvbuf)
+
+
+def run(args):
+    context = zmq.Context()
+    frontend = context.socket(zmq.SUB)
+    configure(frontend, args, send=False)
+    frontend.setsockopt(zmq.SUBSCRIBE, b"")
+    frontend.bind(f"tcp://*:{args.in_port}")
+    backend = context.socket(zmq.XPUB)
+    configure(backend, args, send=True)
+    # Report full subscriber queues instead of dropping silently
+    backend.setsockopt(zmq.XPUB_NODROP, 1)
+    backend.bind(f"tcp://*:{args.out_port}")
+
+    monitors = {
+        frontend.get_monitor_socket(zmq.EVENT_ACCEPTED | zmq.EVENT_DISCONNECTED): "publishers",
+        backend.get_monitor_socket(zmq.EVENT_ACCEPTED | zmq.EVENT_DISCONNECTED): "subscribers",
+    }
+    counters = Counters(args.name)
+    if args.metrics_port:
+        serve_metrics(counters, args.metrics_port)
+    log(
+        f"forwarding {args.in_port} -> {args.out_port} (sndhwm {args.sndhwm}, rcvhwm {args.rcvhwm}, "
+        f"send timeout {args.send_timeout} ms, batches of {args.batch_size})"
+    )
+
+    poller = zmq.Poller()
+    poller.register(frontend, zmq.POLLIN)
+    poller.register(backend, zmq.POLLIN)
+    for monitor in monitors:
+        poller.register(monitor, zmq.POLLIN)
+
+    # Whether a subscriber stayed full past the send timeout; until it has
+    # room again, messages are dropped without waiting, so that one stuck
+    # subscriber does not slow the proxy down for everyone
+    congested = False
+
+    def forward(message):
+        nonlocal congested
+        try:
+            backend.send_multipart(message, zmq.NOBLOCK)
+        except zmq.Again:
+            # A subscriber is full: give it a moment before dropping
+            if congested or not args.send_timeout or not backend.poll(args.send_timeout, zmq.POLLOUT):
+                congested = True
+                counters.dropped += 1
+                return
+            try:
+                backend.send_multipart(message, zmq.NOBLOCK)
+            except zmq.Again:
+                congested = True
+                counters.dropped += 1
+                return
+        congested = False
+        counters.forwarded += 1
+        counters.bytes += sum(len(frame) for frame in message)
+
+    last_report = time.monotonic()
+    reported_drops = 0
+    while True:
+        events = dict(poller.poll(1000))
+        for monitor, gauge in monitors.items():
+            if monitor in events:
+                event = recv_monitor_message(monitor)
+                setattr(counters, gauge, max(0, getattr(counters, gauge) + CONNECT_EVENTS.get(event["event"], 0)))
+        if backend in events:
+            # Subscription messages; the subscribers are counted by the monitor
+            backend.recv_multipart(zmq.NOBLOCK)
+        if frontend in events:
+            # Forward what is queued, up to a batch, before polling again
+            for _ in range(args.batch_size):
+                try:
+                    message = frontend.recv_multipart(zmq.NOBLOCK)
+                except zmq.Again:
+                    break
+                counters.received += 1
+                forward(message)
+            if args.batch_interval:
+                # Let messages accumulate, trading latency for fewer wake-ups
+                time.sleep(args.batch_interval / 1000)
+        now = time.monotonic()
+        if args.stats_interval and now - last_report >= args.stats_interval:
+            if counters.dropped > reported_drops:
+                log(
+                    f"dropped {counters.dropped - reported_drops} messages in the last "
+                    f"{now - last_report:.0f} s; {counters.subscribers} subscribers"
+                )
+                reported_drops = counters.dropped
+            last_report = now
+
+
+def env_default(name, default, convert=str):
+    value = os.getenv(name)
+    return default if value in (None, "") else convert(value)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("in_port", type=int, help="Port publishers connect to")
+    parser.add_argument("out_port", type=int, help="Port subscribers connect to")
+    parser.add_argument(
+        "--name",
+        default=env_default("ZMQ_PROXY_NAME", "zmq_proxy"),
+        help="Proxy name in the metrics (ZMQ_PROXY_NAME)",
+    )
+    parser.add_argument(
+        "--sndhwm",
+        type=int,
+        default=env_default("ZMQ_PROXY_SNDHWM", 10000, int),
+        help="Messages queued per subscriber before it counts as full (ZMQ_PROXY_SNDHWM)",
+    )
+    parser.add_argument(
+        "--rcvhwm",
+        type=int,
+        default=env_default("ZMQ_PROXY_RCVHWM", 10000, int),
+        help="Messages queued per publisher (ZMQ_PROXY_RCVHWM)",
+    )
+    parser.add_argument(
+        "--sndbuf",
+        type=int,
+        default=env_default("ZMQ_PROXY_SNDBUF", 0, int),
+        help="Kernel send buffer in bytes, 0 for the OS default (ZMQ_PROXY_SNDBUF)",
+    )
+    parser.add_argument(
+        "--rcvbuf",
+        type=int,
+        default=env_default("ZMQ_PROXY_RCVBUF", 0, int),
+        help="Kernel receive buffer in bytes, 0 for the OS default (ZMQ_PROXY_RCVBUF)",
+    )
+    parser.add_argument(
+        "--send-timeout",
+        type=int,
+        default=env_default("ZMQ_PROXY_SEND_TIMEOUT", 100, int),
+        help="Milliseconds to wait for a full subscriber before dropping a message "
+        "(ZMQ_PROXY_SEND_TIMEOUT)",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=env_default("ZMQ_PROXY_BATCH_SIZE", 1000, int),
+        help="Messages forwarded per wake-up (ZMQ_PROXY_BATCH_SIZE)",
+    )
+    parser.add_argument(
+        "--batch-interval",
+        type=float,
+        default=env_default("ZMQ_PROXY_BATCH_INTERVAL", 0.0, float),
+        help="Milliseconds to wait between batches, 0 to forward right away "
+        "(ZMQ_PROXY_BATCH_INTERVAL)",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=env_default("ZMQ_PROXY_METRICS_PORT", 9100, int),
+        help="Port of the /metrics endpoint, 0 to disable (ZMQ_PROXY_METRICS_PORT)",
+    )
+    parser.add_argument(
+        "--stats-interval",
+        type=float,
+        default=env_default("ZMQ_PROXY_STATS_INTERVAL", 10.0, float),
+        help="Seconds between drop reports in the log, 0 to disable (ZMQ_PROXY_STATS_INTERVAL)",
+    )
+    args = parser.parse_args(argv)
+    if args.sndhwm < 0 or args.rcvhwm < 0 or args.send_timeout < 0 or args.batch_size < 1:
+        parser.error("high-water marks and send timeout must not be negative, batch size positive")
+    try:
+        run(args)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""Benchmark nbs-pods CLI startup latency per subcommand.
+
+Each subcommand is run in a fresh interpreter, the same way the nbs-pods
+console script runs it. "cold" runs start from an empty nbs-pods cache
+directory, "warm" runs reuse a populated one. The script exits with a
+non-zero status if the median warm latency of any subcommand exceeds the
+budget, or the median cold latency exceeds the cold budget.
+
+Usage:
+    scripts/bench-cli.py [--runs N] [--budget-ms MS] [--cold-budget-ms MS]
+                         [--json FILE]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+SUBCOMMANDS = [
+    ["--help"],
+    ["list"],
+    ["start", "--help"],
+    ["stop", "--help"],
+]
+ENTRY_POINT = "import sys; from nbs_pods.cli import main; sys.exit(main())"
+
+
+def time_command(command, env):
+    """Run a command and return its wall time in milliseconds."""
+    start = time.perf_counter()
+    subprocess.run(
+        command,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        check=False,
+    )
+    return (time.perf_counter() - start) * 1000
+
+
+def bench(args, runs, cache_root):
+    """
+    Measure cold and warm latency of one subcommand.
+
+    Returns
+    -------
+    tuple[list[float], list[float]]
+        (cold, warm) timings in milliseconds
+    """
+    command = [sys.executable, "-c", ENTRY_POINT] + args
+    cold = []
+    for i in range(runs):
+        env = dict(os.environ, XDG_CACHE_HOME=os.path.join(cache_root, f"cold-{i}"))
+        cold.append(time_command(command, env))
+
+    env = dict(os.environ, XDG_CACHE_HOME=os.path.join(cache_root, "warm"))
+    time_command(command, env)
+    warm = [time_command(command, env) for _ in range(runs)]
+    return cold, warm
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10, help="Runs per measurement")
+    parser.add_argument(
+        "--budget-ms", type=float, default=100.0, help="Budget for median warm latency"
+    )
+    parser.add_argument(
+        "--cold-budget-ms",
+        type=float,
+        default=150.0,
+        help="Budget for median cold latency",
+    )
+    parser.add_argument("--json", help="Write results to this file")
+    args = parser.parse_args()
+
+    baseline = [
+        time_command([sys.executable, "-c", "pass"], os.environ) for _ in range(args.runs)
+    ]
+    baseline_ms = statistics.median(baseline)
+    print(f"Interpreter baseline: {baseline_ms:.1f} ms\n")
+    print(f"{'subcommand':<16} {'cold':>9} {'warm':>9} {'warm p90':>9} {'overhead':>9}")
+
+    results = {"baseline_ms": baseline_ms, "subcommands": {}}
+    failures = []
+    with tempfile.TemporaryDirectory() as cache_root:
+        for subcommand in SUBCOMMANDS:
+            name = " ".join(subcommand)
+            cold, warm = bench(subcommand, args.runs, cache_root)
+            cold_ms = statistics.median(cold)
+            warm_ms = statistics.median(warm)
+            warm_p90 = sorted(warm)[int(0.9 * (len(warm) - 1))]
+            print(
+                f"{name:<16} {cold_ms:>7.1f}ms {warm_ms:>7.1f}ms "
+                f"{warm_p90:>7.1f}ms {warm_ms - baseline_ms:>7.1f}ms"
+            )
+            results["subcommands"][name] = {"cold_ms": cold, "warm_ms": warm}
+            if warm_ms > args.budget_ms:
+                failures.append(f"{name}: warm {warm_ms:.1f} ms > {args.budget_ms:.0f} ms")
+            if cold_ms > args.cold_budget_ms:
+                failures.append(
+                    f"{name}: cold {cold_ms:.1f} ms > {args.cold_budget_ms:.0f} ms"
+                )
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+    if failures:
+        print("\nOver budget:", file=sys.stderr)
+        for failure in failures:
+            print(f"  {failure}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,50 +1,20 @@
 #!/bin/bash
+# Build the container images; see `nbs-pods build --help`.
+#
+#   ./scripts/build-images.sh              # build all images that changed
+#   ./scripts/build-images.sh gui sim      # build gui and sim (and bluesky if needed)
 
 set -e
 
 SCRIPT_DIR="$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)"
 NBS_PODS_DIR="$(dirname "$SCRIPT_DIR")"
 
-# Define available images
-IMAGES=(
-    "conda"
-    "bluesky"
-    "nbs"
-)
-
-build_image() {
-    local image=$1
-    echo "Building $image..."
-    bash "$NBS_PODS_DIR/images/$image/build_${image}_image.sh"
-}
-
-build_all_images() {
-    for image in "${IMAGES[@]}"; do
-        build_image "$image"
-    done
-}
-
-usage() {
-    echo "Usage: $0 [image1 image2 ...]"
-    echo "If no images are specified, all will be built."
-    echo ""
-    echo "Available images:"
-    for image in "${IMAGES[@]}"; do
-        echo "  - $image"
-    done
-    exit 1
-}
-
-# Main execution
-if [ $# -eq 0 ]; then
-    build_all_images
+if command -v nbs-pods &> /dev/null; then
+    exec nbs-pods build --context "$NBS_PODS_DIR" "$@"
+elif command -v pixi &> /dev/null && [ -f "$NBS_PODS_DIR/pyproject.toml" ]; then
+    cd "$NBS_PODS_DIR"
+    exec pixi run nbs-pods build --context "$NBS_PODS_DIR" "$@"
 else
-    for image in "$@"; do
-        if [[ ! " ${IMAGES[@]} " =~ " ${image} " ]]; then
-            echo "Error: Unknown image '$image'"
-            echo ""
-            usage
-        fi
-        build_image "$image"
-    done
-fi 
\ No newline at end of file
+    echo "Error: nbs-pods CLI not found. Install nbs-pods or use pixi." >&2
+    exit 1
+fi
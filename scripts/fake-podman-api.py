@@ -0,0 +1,368 @@
+#!/usr/bin/env python3
+"""Serve a fake libpod API on a Unix socket for the nbs-pods api backend.
+
+The server keeps containers, networks, volumes and images in memory and
+answers the subset of the libpod v4 API that ``nbs_pods.podman_api`` uses,
+with the status codes podman returns: creating a container whose image was
+not pulled or whose network does not exist fails with 404, names that are
+taken fail with 409, and removing what does not exist fails with 404. No
+container actually runs; ``start``, ``stop``, ``pause`` and ``unpause`` only
+change its state, and write one line to its log.
+
+Point nbs-pods at the socket to exercise ``--backend api`` without podman:
+
+    scripts/fake-podman-api.py /tmp/fake-podman.sock &
+    export NBS_PODS_PODMAN_SOCKET=/tmp/fake-podman.sock
+    nbs-pods start --backend api bluesky-services
+    nbs-pods status
+    nbs-pods stop --backend api bluesky-services
+
+``GET /fake/state`` (outside the libpod prefix) returns the current objects
+and every request served so far, for checks after a run:
+
+    curl -s --unix-socket /tmp/fake-podman.sock http://d/fake/state
+
+Usage:
+    scripts/fake-podman-api.py [SOCKET] [--image REF ...] [--fail-pull REF ...]
+                               [--delay MS] [--verbose]
+"""
+
+import argparse
+import json
+import os
+import re
+import signal
+import socketserver
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import parse_qs, unquote, urlparse
+
+API_PREFIX = "/v4.0.0/libpod"
+DEFAULT_SOCKET = "/tmp/fake-podman.sock"
+
+
+class NotFound(Exception):
+    pass
+
+
+class Conflict(Exception):
+    pass
+
+
+class FakePodman:
+    """In-memory containers, networks, volumes and images."""
+
+    def __init__(self, images=(), fail_pulls=()):
+        self.lock = threading.Lock()
+        self.containers = {}
+        self.networks = {"podman": {"name": "podman", "driver": "bridge", "labels": {}}}
+        self.volumes = {}
+        self.images = set(images)
+        self.fail_pulls = set(fail_pulls)
+        self.requests = []
+        self.next_id = 0
+
+    def find_container(self, name):
+        for container in self.containers.values():
+            if name in (container["Name"], container["Id"], container["Id"][:12]):
+                return container
+        raise NotFound(f"no container with name or ID \"{name}\" found: no such container")
+
+    def create_container(self, spec):
+        name = spec["name"]
+        if any(container["Name"] == name for container in self.containers.values()):
+            raise Conflict(f"the container name \"{name}\" is already in use")
+        if spec["image"] not in self.images:
+            raise NotFound(f"{spec['image']}: image not known")
+        for network in spec.get("Networks") or {}:
+            if network not in self.networks:
+                raise NotFound(f"unable to find network with name or ID {network}: network not found")
+        for volume in spec.get("volumes") or []:
+            # Named volumes are created on demand, as podman does
+            self.volumes.setdefault(volume["Name"], {"Name": volume["Name"], "Labels": {}})
+        self.next_id += 1
+        container_id = f"{self.next_id:064x}"
+        self.containers[container_id] = {
+            "Id": container_id,
+            "Name": name,
+            "Image": spec["image"],
+            "Labels": spec.get("labels") or {},
+            "State": "created",
+            "Spec": spec,
+            "Logs": [],
+        }
+        return container_id
+
+    def set_state(self, name, action):
+        container = self.find_container(name)
+        transitions = {
+            "start": ({"created", "exited", "running"}, "running"),
+            "stop": ({"created", "exited", "running", "paused"}, "exited"),
+            "pause": ({"running"}, "paused"),
+            "unpause": ({"paused"}, "running"),
+        }
+        allowed, state = transitions[action]
+        if container["State"] not in allowed:
+            raise Conflict(f"\"{container['Name']}\" is {container['State']}, cannot {action}")
+        container["State"] = state
+        now = time.time_ns()
+        moment = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(now // 10**9)) + f".{now % 10**9:09d}Z"
+        container["Logs"].append(f"{moment} INFO fake-podman-api: {action} {container['Name']}\n")
+
+    def summary(self, container):
+        return {
+            "Id": container["Id"],
+            "Names": [container["Name"]],
+            "Image": container["Image"],
+            "Labels": container["Labels"],
+            "State": container["State"],
+        }
+
+    def inspect(self, container):
+        return {
+            "Id": container["Id"],
+            "Name": container["Name"],
+            "Image": container["Image"],
+            "State": {"Status": container["State"], "Running": container["State"] == "running"},
+            "Config": {"Labels": container["Labels"]},
+        }
+
+    def stats(self, container):
+        return {
+            "ContainerID": container["Id"],
+            "Name": container["Name"],
+            "CPU": 0.5,
+            "CPUNano": 1000000,
+            "MemUsage": 64 * 1024 * 1024,
+            "MemLimit": 1024 * 1024 * 1024,
+            "NetInput": 0,
+            "NetOutput": 0,
+            "BlockInput": 0,
+            "BlockOutput": 0,
+            "PIDs": 1,
+        }
+
+    def state(self):
+        return {
+            "containers": [dict(self.summary(c), Spec=c["Spec"]) for c in self.containers.values()],
+            "networks": sorted(self.networks),
+            "volumes": sorted(self.volumes),
+            "images": sorted(self.images),
+            "requests": self.requests,
+        }
+
+
+def matches_labels(labels, filters):
+    """Check ``key=value`` (or bare ``key``) label filters against labels."""
+    for label_filter in filters.get("label", []):
+        key, sep, value = label_filter.partition("=")
+        if key not in labels or (sep and labels[key] != value):
+            return False
+    return True
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def address_string(self):
+        return "unix"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            print(f"fake-podman-api: {format % args}", flush=True)
+
+    def send(self, status, body=None, raw=None):
+        data = raw if raw is not None else (b"" if body is None else json.dumps(body).encode())
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def handle_request(self):
+        url = urlparse(self.path)
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length)) if length else None
+        query = parse_qs(url.query)
+        fake = self.server.fake
+        if self.server.delay:
+            time.sleep(self.server.delay / 1000)
+        with fake.lock:
+            if url.path == "/fake/state":
+                return self.send(200, fake.state())
+            if not url.path.startswith(API_PREFIX):
+                return self.send(404, {"message": f"unknown path {url.path}"})
+            path = url.path[len(API_PREFIX):]
+            fake.requests.append(f"{self.command} {path}")
+            try:
+                status, response = self.route(fake, self.command, path, query, body)
+            except NotFound as e:
+                return self.send(404, {"cause": "no such object", "message": str(e), "response": 404})
+            except Conflict as e:
+                return self.send(409, {"cause": "conflict", "message": str(e), "response": 409})
+        if isinstance(response, bytes):
+            return self.send(status, raw=response)
+        return self.send(status, response)
+
+    do_GET = do_POST = do_DELETE = handle_request
+
+    def route(self, fake, method, path, query, body):
+        filters = json.loads(query.get("filters", ["{}"])[0])
+
+        if path == "/_ping":
+            return 200, b"OK"
+        match = re.fullmatch(r"/(containers|networks|volumes|images)/(.+)/exists", path)
+        if match:
+            kind, name = match.group(1), unquote(match.group(2))
+            if kind == "containers":
+                fake.find_container(name)
+            elif kind == "images":
+                if name not in fake.images:
+                    raise NotFound(f"{name}: image not known")
+            elif name not in getattr(fake, kind):
+                raise NotFound(f"{name}: no such {kind[:-1]}")
+            return 204, None
+
+        # Containers
+        if path == "/containers/json":
+            include_all = query.get("all", ["false"])[0] == "true"
+            return 200, [
+                fake.summary(container)
+                for container in fake.containers.values()
+                if (include_all or container["State"] == "running")
+                and matches_labels(container["Labels"], filters)
+            ]
+        if path == "/containers/create":
+            return 201, {"Id": fake.create_container(body), "Warnings": []}
+        if path == "/containers/stats":
+            names = query.get("containers", [])
+            containers = (
+                [fake.find_container(name) for name in names]
+                if names
+                else [c for c in fake.containers.values() if c["State"] == "running"]
+            )
+            return 200, {"Error": None, "Stats": [fake.stats(c) for c in containers]}
+        match = re.fullmatch(r"/containers/([^/]+)/(start|stop|pause|unpause)", path)
+        if match:
+            fake.set_state(unquote(match.group(1)), match.group(2))
+            return 204, None
+        match = re.fullmatch(r"/containers/([^/]+)/logs", path)
+        if match:
+            # Multiplexed like the log of a container without a TTY: an 8-byte
+            # header (stream 1 = stdout, big-endian length) before each line
+            container = fake.find_container(unquote(match.group(1)))
+            frames = b""
+            for line in container["Logs"]:
+                data = line.encode()
+                frames += b"\x01\x00\x00\x00" + len(data).to_bytes(4, "big") + data
+            return 200, frames
+        match = re.fullmatch(r"/containers/([^/]+)/json", path)
+        if match:
+            return 200, fake.inspect(fake.find_container(unquote(match.group(1))))
+        match = re.fullmatch(r"/containers/([^/]+)", path)
+        if match and method == "DELETE":
+            container = fake.find_container(unquote(match.group(1)))
+            if container["State"] in ("running", "paused") and query.get("force", ["false"])[0] != "true":
+                raise Conflict(f"cannot remove container {container['Name']} as it is {container['State']}")
+            del fake.containers[container["Id"]]
+            return 200, [{"Id": container["Id"], "Err": None}]
+
+        # Networks
+        if path == "/networks/json":
+            return 200, [n for n in fake.networks.values() if matches_labels(n.get("labels") or {}, filters)]
+        if path == "/networks/create":
+            if body["name"] in fake.networks:
+                raise Conflict(f"network name {body['name']} already used: network already exists")
+            network = {"name": body["name"], "driver": body.get("driver", "bridge"), "labels": body.get("labels") or {}}
+            fake.networks[body["name"]] = network
+            return 200, network
+        match = re.fullmatch(r"/networks/([^/]+)", path)
+        if match and method == "DELETE":
+            name = unquote(match.group(1))
+            if name not in fake.networks:
+                raise NotFound(f"unable to find network with name or ID {name}: network not found")
+            in_use = [c["Name"] for c in fake.containers.values() if name in (c["Spec"].get("Networks") or {})]
+            if in_use:
+                raise Conflict(f"network {name} is being used by {', '.join(in_use)}")
+            del fake.networks[name]
+            return 200, [{"Name": name, "Err": None}]
+
+        # Volumes
+        if path == "/volumes/json":
+            return 200, [v for v in fake.volumes.values() if matches_labels(v.get("Labels") or {}, filters)]
+        if path == "/volumes/create":
+            if body["Name"] in fake.volumes:
+                raise Conflict(f"volume with name {body['Name']} already exists: volume already exists")
+            volume = {"Name": body["Name"], "Labels": body.get("Label") or {}}
+            fake.volumes[body["Name"]] = volume
+            return 201, volume
+        match = re.fullmatch(r"/volumes/([^/]+)", path)
+        if match and method == "DELETE":
+            name = unquote(match.group(1))
+            if name not in fake.volumes:
+                raise NotFound(f"no volume with name \"{name}\" found: no such volume")
+            del fake.volumes[name]
+            return 204, None
+
+        # Images
+        if path == "/images/pull":
+            reference = query["reference"][0]
+            if reference in fake.fail_pulls:
+                report = {"error": f"initializing source docker://{reference}: manifest unknown"}
+            else:
+                fake.images.add(reference)
+                report = {"id": f"{len(fake.images):064x}", "images": [reference]}
+            return 200, (json.dumps(report) + "\n").encode()
+        match = re.fullmatch(r"/images/(.+)/json", path)
+        if match:
+            reference = unquote(match.group(1))
+            if reference not in fake.images:
+                raise NotFound(f"{reference}: image not known")
+            return 200, {"Id": reference, "RepoTags": [reference]}
+
+        raise NotFound(f"{method} {path} is not served by the fake podman API")
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "socket", nargs="?", default=DEFAULT_SOCKET, help=f"Socket path (default: {DEFAULT_SOCKET})"
+    )
+    parser.add_argument(
+        "--image", action="append", default=[], help="Image that is present from the start"
+    )
+    parser.add_argument(
+        "--fail-pull", action="append", default=[], help="Image whose pull reports an error"
+    )
+    parser.add_argument(
+        "--delay", type=float, default=0, help="Milliseconds to wait before every answer"
+    )
+    parser.add_argument("-v", "--verbose", action="store_true", help="Log every request")
+    args = parser.parse_args()
+
+    if os.path.exists(args.socket):
+        os.unlink(args.socket)
+    server = Server(args.socket, Handler)
+    server.fake = FakePodman(args.image, args.fail_pull)
+    server.delay = args.delay
+    server.verbose = args.verbose
+    print(f"fake-podman-api: serving on {args.socket}", flush=True)
+    # Clean up the socket when killed as well as on Ctrl-C
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(args.socket)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
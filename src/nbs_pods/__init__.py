@@ -1,8 +1,14 @@
 """NBS Pods - Containerized NBS services management."""
 
-from importlib.metadata import PackageNotFoundError, version
 
-try:
-    __version__ = version("nbs-pods")
-except PackageNotFoundError:
-    __version__ = "0.0.0"
+def __getattr__(name):
+    # Resolved on first access: importlib.metadata costs tens of milliseconds
+    # at import time, which every CLI invocation would otherwise pay
+    if name == "__version__":
+        from importlib.metadata import PackageNotFoundError, version
+
+        try:
+            return version("nbs-pods")
+        except PackageNotFoundError:
+            return "0.0.0"
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,549 @@
+"""Start and stop compose projects through the podman REST API.
+
+This backend brings a resolved compose chain up or down without spawning
+podman-compose: the chain is merged and interpolated in-process, translated
+to libpod container specs, and created over the podman service socket.
+Containers, networks and volumes carry the same names and labels
+podman-compose would give them, so both backends can manage the same
+project.
+"""
+
+import os
+import shlex
+import threading
+
+from nbs_pods.compose import _as_mapping, get_compose_project, interpolate, load_compose_chain
+from nbs_pods.podman import PROJECT_LABEL, SERVICE_LABEL
+from nbs_pods.podman_api import PodmanAPIError, get_client
+from nbs_pods.scheduler import run_in_dependency_order
+from nbs_pods.trace import span
+
+STOP_TIMEOUT = 10
+
+_pull_lock = threading.Lock()
+_pull_locks = {}
+
+
+def _qualify_resources(resources, project, client, kind, create):
+    """
+    Map a project's network or volume keys to their podman names.
+
+    Parameters
+    ----------
+    resources : dict
+        Top-level ``networks`` or ``volumes`` of the compose document
+    project : str
+        Compose project name
+    client : PodmanClient
+        Podman API client
+    kind : str
+        'networks' or 'volumes'
+    create : bool
+        Whether to create missing project resources
+
+    Returns
+    -------
+    dict[str, str]
+        Mapping of key to podman name
+    """
+    names = {}
+    for key, definition in (resources or {}).items():
+        definition = definition or {}
+        if definition.get("external"):
+            names[key] = definition.get("name", key)
+            continue
+        name = definition.get("name", f"{project}_{key}")
+        names[key] = name
+        if not create or client.exists(kind, name):
+            continue
+        labels = {PROJECT_LABEL: project, **_as_mapping(definition.get("labels"))}
+        if kind == "networks":
+            client.create_network(
+                {
+                    "name": name,
+                    "driver": definition.get("driver", "bridge"),
+                    "dns_enabled": True,
+                    "labels": labels,
+                }
+            )
+        else:
+            client.create_volume(name, labels)
+    return names
+
+
+def _read_env_files(env_files):
+    """Read ``KEY=VALUE`` lines from compose env files."""
+    if isinstance(env_files, str):
+        env_files = [env_files]
+    values = {}
+    for env_file in env_files or []:
+        with open(env_file, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                key, _, value = line.partition("=")
+                values[key.strip()] = value.strip().strip("'\"")
+    return values
+
+
+def _parse_port(port):
+    """Convert a compose port entry to a libpod port mapping."""
+    if isinstance(port, dict):
+        return {
+            "host_ip": port.get("host_ip", ""),
+            "host_port": int(port.get("published", port["target"])),
+            "container_port": int(port["target"]),
+            "protocol": port.get("protocol", "tcp"),
+        }
+    port, _, protocol = str(port).partition("/")
+    parts = port.rsplit(":", 2)
+    container_port = int(parts[-1])
+    host_port = int(parts[-2]) if len(parts) > 1 and parts[-2] else container_port
+    host_ip = parts[0] if len(parts) == 3 else ""
+    return {
+        "host_ip": host_ip,
+        "host_port": host_port,
+        "container_port": container_port,
+        "protocol": protocol or "tcp",
+    }
+
+
+def _parse_volumes(volumes, volume_names):
+    """
+    Split compose volume entries into bind mounts and named volumes.
+
+    Returns
+    -------
+    tuple[list[dict], list[dict]]
+        (mounts, volumes) in libpod spec format
+    """
+    mounts = []
+    named = []
+    for volume in volumes or []:
+        if isinstance(volume, dict):
+            source = volume.get("source", "")
+            target = volume["target"]
+            options = ["ro"] if volume.get("read_only") else []
+            is_bind = volume.get("type", "volume") == "bind"
+        else:
+            parts = str(volume).split(":")
+            if len(parts) == 1:
+                source, target, options = "", parts[0], []
+            else:
+                source, target = parts[0], parts[1]
+                options = parts[2].split(",") if len(parts) > 2 else []
+            is_bind = source.startswith(("/", "~", "."))
+        if is_bind:
+            mounts.append(
+                {
+                    "type": "bind",
+                    "source": os.path.expanduser(source),
+                    "destination": target,
+                    "options": ["rbind"] + options,
+                }
+            )
+        else:
+            # An empty name gives an anonymous volume, as in compose
+            named.append(
+                {"Name": volume_names.get(source, source), "Dest": target, "Options": options}
+            )
+    return mounts, named
+
+
+def _parse_bytes(value):
+    """Parse a compose byte value such as ``512m`` or ``4g``."""
+    if isinstance(value, (int, float)):
+        return int(value)
+    value = str(value).strip().lower().rstrip("b")
+    units = {"k": 1024, "m": 1024 ** 2, "g": 1024 ** 3}
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(float(value))
+
+
+def _parse_resource_limits(definition):
+    """Translate compose resource keys to OCI resource limits."""
+    cpu = {}
+    if definition.get("cpus") is not None:
+        period = 100000
+        cpu["period"] = period
+        cpu["quota"] = int(float(definition["cpus"]) * period)
+    if definition.get("cpu_shares") is not None:
+        cpu["shares"] = int(definition["cpu_shares"])
+    if definition.get("cpuset") is not None:
+        cpu["cpus"] = str(definition["cpuset"])
+    memory = {}
+    for key, limit_key in (
+        ("mem_limit", "limit"),
+        ("mem_reservation", "reservation"),
+        ("memswap_limit", "swap"),
+    ):
+        if definition.get(key) is not None:
+            memory[limit_key] = _parse_bytes(definition[key])
+    limits = {}
+    if cpu:
+        limits["cpu"] = cpu
+    if memory:
+        limits["memory"] = memory
+    weight = (definition.get("blkio_config") or {}).get("weight")
+    if weight is not None:
+        limits["blockIO"] = {"weight": int(weight)}
+    if definition.get("pids_limit") is not None:
+        limits["pids"] = {"limit": int(definition["pids_limit"])}
+    return limits
+
+
+def get_replicas(name, definition):
+    """
+    Get the number of containers of a compose service.
+
+    Parameters
+    ----------
+    name : str
+        Compose service (container) name
+    definition : dict
+        Interpolated compose service definition
+
+    Returns
+    -------
+    int
+        ``deploy.replicas``, or ``scale``, or 1
+
+    Raises
+    ------
+    RuntimeError
+        If the count is invalid, or several replicas would share a
+        ``container_name``
+    """
+    value = (definition.get("deploy") or {}).get("replicas", definition.get("scale", 1))
+    try:
+        replicas = int(value)
+    except (TypeError, ValueError):
+        raise RuntimeError(f"Container '{name}' has an invalid replica count '{value}'")
+    if replicas < 0:
+        raise RuntimeError(f"Container '{name}' has an invalid replica count '{value}'")
+    if replicas > 1 and "container_name" in definition:
+        raise RuntimeError(f"Container '{name}' sets container_name and cannot have {replicas} replicas")
+    return replicas
+
+
+def build_container_spec(project, name, definition, network_names, volume_names, env, replica=1):
+    """
+    Translate a compose service definition to a libpod container spec.
+
+    Parameters
+    ----------
+    project : str
+        Compose project name
+    name : str
+        Compose service (container) name
+    definition : dict
+        Interpolated compose service definition
+    network_names : dict[str, str]
+        Mapping of network key to podman network name
+    volume_names : dict[str, str]
+        Mapping of volume key to podman volume name
+    env : dict
+        Host environment, for environment entries without a value
+    replica : int
+        Number of the container among the service's replicas
+
+    Returns
+    -------
+    dict
+        libpod SpecGenerator
+
+    Raises
+    ------
+    RuntimeError
+        If the service has no image
+    """
+    if "image" not in definition:
+        raise RuntimeError(f"Container '{name}' has no image; build it first")
+
+    environment = _read_env_files(definition.get("env_file"))
+    for key, value in _as_mapping(definition.get("environment")).items():
+        if value is None:
+            value = env.get(key)
+        if value is not None:
+            environment[key] = str(value)
+
+    labels = {
+        key: str(value) for key, value in _as_mapping(definition.get("labels")).items()
+    }
+    labels.update({PROJECT_LABEL: project, SERVICE_LABEL: name})
+
+    spec = {
+        "name": definition.get("container_name", f"{project}_{name}_{replica}"),
+        "image": definition["image"],
+        "env": environment,
+        "labels": labels,
+        "hostname": definition.get("hostname", name),
+    }
+
+    for key, spec_key in (("command", "command"), ("entrypoint", "entrypoint")):
+        value = definition.get(key)
+        if value is not None:
+            spec[spec_key] = shlex.split(value) if isinstance(value, str) else [str(v) for v in value]
+
+    service_networks = definition.get("networks") or ["default"]
+    if isinstance(service_networks, dict):
+        service_networks = list(service_networks)
+    spec["Networks"] = {
+        network_names.get(key, f"{project}_{key}"): {"aliases": [name]}
+        for key in service_networks
+    }
+
+    if definition.get("ports"):
+        spec["portmappings"] = [_parse_port(port) for port in definition["ports"]]
+    mounts, volumes = _parse_volumes(definition.get("volumes"), volume_names)
+    if mounts:
+        spec["mounts"] = mounts
+    if volumes:
+        spec["volumes"] = volumes
+    if definition.get("devices"):
+        spec["devices"] = [{"path": str(device)} for device in definition["devices"]]
+    if definition.get("dns"):
+        dns = definition["dns"]
+        spec["dns_server"] = [dns] if isinstance(dns, str) else list(dns)
+    if definition.get("extra_hosts"):
+        spec["hostadd"] = [
+            f"{host}:{ip}" for host, ip in _as_mapping(definition["extra_hosts"], ":").items()
+        ]
+
+    resource_limits = _parse_resource_limits(definition)
+    if resource_limits:
+        spec["resource_limits"] = resource_limits
+
+    for key, spec_key in (
+        ("cap_add", "cap_add"),
+        ("cap_drop", "cap_drop"),
+        ("working_dir", "work_dir"),
+        ("user", "user"),
+        ("privileged", "privileged"),
+        ("tty", "terminal"),
+        ("stdin_open", "stdin"),
+        ("init", "init"),
+        ("restart", "restart_policy"),
+    ):
+        if key in definition:
+            spec[spec_key] = definition[key]
+    return spec
+
+
+def ensure_image(client, image, verbose=False):
+    """
+    Pull an image unless it exists locally.
+
+    Containers that share an image wait for a single pull of it instead of
+    pulling it concurrently.
+    """
+    with _pull_lock:
+        lock = _pull_locks.setdefault(image, threading.Lock())
+    with lock:
+        if client.exists("images", image):
+            return
+        if verbose:
+            print(f"  pulling {image}\n", end="", flush=True)
+        client.pull_image(image)
+
+
+def _get_depends_on(definition):
+    depends_on = definition.get("depends_on") or []
+    return set(depends_on if isinstance(depends_on, list) else depends_on.keys())
+
+
+def up(compose_file_string, env, containers=None, max_workers=None, verbose=False, service=None):
+    """
+    Bring up a compose project through the podman API, like ``up -d``.
+
+    Existing containers of the project are replaced. Containers are created
+    and started in ``depends_on`` order, independent ones concurrently. A
+    service with ``deploy.replicas`` gets that many containers, numbered
+    like podman-compose numbers them.
+
+    Parameters
+    ----------
+    compose_file_string : str
+        Colon-separated compose file chain
+    env : dict
+        Environment used for variable interpolation
+    containers : list[str], optional
+        Only (re)create these compose services, like ``up --no-deps``
+    max_workers : int, optional
+        Parallelism limit for container operations
+    verbose : bool
+        Whether to report every container operation
+    service : str, optional
+        nbs-pods service the project belongs to, for trace spans; defaults
+        to the compose project
+
+    Returns
+    -------
+    dict[str, str]
+        Mapping of compose service name to the container ID of its first
+        replica
+
+    Raises
+    ------
+    RuntimeError
+        If the chain cannot be translated or a container fails to start
+    OSError
+        If the podman socket cannot be reached
+    """
+    client = get_client()
+    project = get_compose_project(compose_file_string)
+    trace_service = service or project
+    compose_doc = interpolate(load_compose_chain(compose_file_string), env)
+    services = compose_doc.get("services") or {}
+
+    network_keys = dict(compose_doc.get("networks") or {})
+    if any(not definition.get("networks") for definition in services.values()):
+        network_keys.setdefault("default", {})
+    network_names = _qualify_resources(network_keys, project, client, "networks", create=True)
+    volume_names = _qualify_resources(compose_doc.get("volumes"), project, client, "volumes", create=True)
+
+    def start(name):
+        definition = services[name]
+        specs = [
+            build_container_spec(project, name, definition, network_names, volume_names, env, replica)
+            for replica in range(1, get_replicas(name, definition) + 1)
+        ]
+        # Also removes the replicas of a service that was scaled down
+        existing = client.list_containers({PROJECT_LABEL: project, SERVICE_LABEL: name})
+        existing = {container["Names"][0] for container in existing}
+        existing.update(spec["name"] for spec in specs if client.exists("containers", spec["name"]))
+        for container in sorted(existing):
+            with span(f"remove {container}", "remove", trace_service, row=name):
+                client.remove_container(container, force=True, volumes=True)
+        container_ids = []
+        for spec in specs:
+            with span(f"pull {spec['image']}", "pull", trace_service, row=name):
+                ensure_image(client, spec["image"], verbose)
+            with span(f"create {spec['name']}", "create", trace_service, row=name):
+                container_id = client.create_container(spec)
+            with span(f"start {spec['name']}", "start", trace_service, row=name):
+                client.start_container(container_id)
+            if verbose:
+                print(f"  started {spec['name']}\n", end="", flush=True)
+            container_ids.append(container_id)
+        return container_ids[0] if container_ids else None
+
+    selected = services if containers is None else containers
+    graph = {
+        name: {dep for dep in _get_depends_on(services[name]) if dep in selected}
+        for name in selected
+    }
+    results, errors, skipped = run_in_dependency_order(graph, start, max_workers)
+    if errors or skipped:
+        messages = [f"{name}: {error}" for name, error in errors.items()]
+        if skipped:
+            messages.append(f"skipped because a dependency failed: {', '.join(skipped)}")
+        raise RuntimeError("; ".join(messages))
+    return results
+
+
+def down(compose_file_string, remove_volumes=True, max_workers=None, verbose=False):
+    """
+    Take down a compose project through the podman API, like ``down``.
+
+    Parameters
+    ----------
+    compose_file_string : str
+        Colon-separated compose file chain, used for the project name
+    remove_volumes : bool
+        Whether to also remove the project's volumes, like ``down -v``
+    max_workers : int, optional
+        Parallelism limit for container operations
+    verbose : bool
+        Whether to report every container operation
+
+    Raises
+    ------
+    RuntimeError
+        If a container cannot be removed
+    OSError
+        If the podman socket cannot be reached
+    """
+    client = get_client()
+    project = get_compose_project(compose_file_string)
+    containers = client.list_containers({PROJECT_LABEL: project})
+
+    def remove(container_id):
+        client.stop_container(container_id, timeout=STOP_TIMEOUT)
+        client.remove_container(container_id, force=True, volumes=remove_volumes)
+
+    names = {container["Id"]: container["Names"][0] for container in containers}
+    _, errors, _ = run_in_dependency_order({cid: set() for cid in names}, remove, max_workers)
+    if errors:
+        raise RuntimeError(
+            "; ".join(f"{names[cid]}: {error}" for cid, error in errors.items())
+        )
+    if verbose:
+        for name in names.values():
+            print(f"  removed {name}\n", end="", flush=True)
+
+    for network in client.list_networks({PROJECT_LABEL: project}):
+        try:
+            client.remove_network(network["name"])
+        except PodmanAPIError as e:
+            # Still in use by containers of another project
+            if e.status != 409:
+                raise
+    if remove_volumes:
+        for volume in client.list_volumes({PROJECT_LABEL: project}):
+            client.remove_volume(volume["Name"], force=True)
+
+
+def set_project_state(compose_file_string, action, max_workers=None):
+    """
+    Stop, start, pause or unpause the existing containers of a project.
+
+    Containers and volumes are kept, so the project can be brought back
+    without recreating anything.
+
+    Parameters
+    ----------
+    compose_file_string : str
+        Colon-separated compose file chain, used for the project name
+    action : str
+        'stop', 'start', 'pause' or 'unpause'
+    max_workers : int, optional
+        Parallelism limit for container operations
+
+    Raises
+    ------
+    RuntimeError
+        If the action fails for a container
+    OSError
+        If the podman socket cannot be reached
+    """
+    client = get_client()
+    project = get_compose_project(compose_file_string)
+    containers = client.list_containers({PROJECT_LABEL: project})
+    actions = {
+        "stop": lambda cid: client.stop_container(cid, timeout=STOP_TIMEOUT),
+        "start": client.start_container,
+        "pause": client.pause_container,
+        "unpause": client.unpause_container,
+    }
+    # Only act on containers in a state the action applies to
+    from_states = {
+        "stop": ("running", "paused"),
+        "start": ("created", "exited", "stopped"),
+        "pause": ("running",),
+        "unpause": ("paused",),
+    }
+    names = {
+        container["Id"]: container["Names"][0]
+        for container in containers
+        if container.get("State") in from_states[action]
+    }
+    _, errors, _ = run_in_dependency_order(
+        {cid: set() for cid in names}, actions[action], max_workers
+    )
+    if errors:
+        raise RuntimeError(
+            "; ".join(f"{names[cid]}: {error}" for cid, error in errors.items())
+        )
@@ -0,0 +1,225 @@
+"""Run the document pipeline benchmark next to the running containers.
+
+The benchmark (``pipeline-bench.py`` of the nbs-pods scripts) runs in a
+throwaway container. If kafka-writer is running, that container shares its
+network and mounts, so it reaches the stack with the same Kafka client
+settings and Tiled profile the writer uses, and the storage and Tiled paths
+can be timed. Otherwise it joins the bluesky-services network and only the
+ZMQ and Kafka paths are timed.
+"""
+
+import json
+import os
+import platform
+import subprocess
+import time
+
+from nbs_pods.compose import get_compose_project
+from nbs_pods.kafka import (
+    KAFKA_CONFIG_TARGET,
+    KAFKA_PROFILE_ENV,
+    get_active_kafka_profile,
+    get_client_settings,
+    load_kafka_profiles,
+    write_kafka_config,
+)
+from nbs_pods.monitor import format_size
+from nbs_pods.podman import get_project_containers
+from nbs_pods.shared import (
+    SHARED_NETWORK,
+    SHARED_SERVICE,
+    get_beamline_namespace,
+    get_beamline_network,
+    get_kafka_topic,
+    is_shared_mode,
+)
+from nbs_pods.state import load_service_state
+
+BENCH_SCRIPT = "/opt/nbs-pods/scripts/pipeline-bench.py"
+WRITER_SERVICE = "kafka-writer"
+STREAM_PATHS = ["zmq_proxy", "zmq_proxy2", "kafka"]
+
+
+def get_running_container(service, container=None):
+    """
+    Get a running container of a service started by nbs-pods.
+
+    Parameters
+    ----------
+    service : str
+        nbs-pods service name
+    container : str, optional
+        Compose service in the service's project, defaults to ``service``
+
+    Returns
+    -------
+    str | None
+        Container name, or None if the service is not running
+    """
+    state = load_service_state(service)
+    if state is None:
+        return None
+    project = get_compose_project(state["compose_file"])
+    return get_project_containers(project).get(container or service)
+
+
+def get_bench_command(bench_args):
+    """
+    Build the podman command that runs the benchmark.
+
+    Parameters
+    ----------
+    bench_args : list[str]
+        Options of ``pipeline-bench.py``
+
+    Returns
+    -------
+    tuple[list[str], bool]
+        (command, whether kafka-writer is running)
+
+    Raises
+    ------
+    RuntimeError
+        If bluesky-services is not running, or the Kafka profile is invalid
+    """
+    bench_args = list(bench_args)
+    if is_shared_mode():
+        bench_args += ["--topic", get_kafka_topic(), "--tiled-path", get_beamline_namespace()]
+
+    writer = get_running_container(WRITER_SERVICE)
+    if writer is not None:
+        result = subprocess.run(
+            ["podman", "inspect", "--format", "{{.ImageName}}", writer],
+            capture_output=True,
+            text=True,
+        )
+        if result.returncode != 0:
+            raise RuntimeError(f"Could not inspect {writer}: {result.stderr.strip()}")
+        command = [
+            "podman", "run", "--rm",
+            "--network", f"container:{writer}",
+            "--volumes-from", writer,
+            result.stdout.strip(),
+        ]
+        return command + ["python", BENCH_SCRIPT] + bench_args, True
+
+    if get_running_container(SHARED_SERVICE, "kafka") is None:
+        raise RuntimeError(f"{SHARED_SERVICE} is not running; start it (and {WRITER_SERVICE}) first")
+    network = get_beamline_network() if is_shared_mode() else SHARED_NETWORK
+    command = ["podman", "run", "--rm", "--network", network]
+    settings = get_active_kafka_profile()
+    if settings is not None:
+        config_file = write_kafka_config(*get_client_settings(settings))
+        command += ["-v", f"{config_file}:{KAFKA_CONFIG_TARGET}:ro"]
+    image = f"{os.getenv('NBS_IMAGE_REG', 'ghcr.io/xraygui/nbs-pods/')}queueserver:latest"
+    if "--paths" not in bench_args:
+        bench_args += ["--paths"] + STREAM_PATHS
+    return command + [image, "python", BENCH_SCRIPT] + bench_args, False
+
+
+def run_bench(bench_args):
+    """
+    Run the benchmark and collect its report.
+
+    The benchmark's progress is passed through to stderr.
+
+    Parameters
+    ----------
+    bench_args : list[str]
+        Options of ``pipeline-bench.py``
+
+    Returns
+    -------
+    dict
+        Report of the benchmark, with the host and active profiles added
+
+    Raises
+    ------
+    RuntimeError
+        If the benchmark cannot be started or fails
+    """
+    command, with_writer = get_bench_command(bench_args)
+    if not with_writer:
+        print(
+            f"{WRITER_SERVICE} is not running; timing the ZMQ and Kafka paths only\n",
+            end="",
+            flush=True,
+        )
+    result = subprocess.run(command, stdout=subprocess.PIPE, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Benchmark failed with exit code {result.returncode}")
+    try:
+        report = json.loads(result.stdout.strip().splitlines()[-1])
+    except (IndexError, ValueError):
+        raise RuntimeError("Benchmark did not print a report")
+    _, kafka_profile = load_kafka_profiles()
+    report["host"] = platform.node()
+    report["time"] = time.strftime("%Y-%m-%dT%H:%M:%S%z")
+    report["kafka_profile"] = os.getenv(KAFKA_PROFILE_ENV, kafka_profile)
+    return report
+
+
+def _format_ms(latency, key):
+    return f"{latency[key]:.1f}" if latency else "-"
+
+
+def format_report(report):
+    """
+    Format a benchmark report as a table.
+
+    Parameters
+    ----------
+    report : dict
+        Report from ``run_bench``
+
+    Returns
+    -------
+    str
+        Report text
+    """
+    config = report["config"]
+    shape = "x".join(str(size) for size in config["shape"]) or "scalar"
+    rate = f"{config['rate']:g} events/s" if config["rate"] else "unpaced"
+    lines = [
+        f"{config['runs']} runs x {config['events']} events, {config['fields']} fields ({shape}), "
+        f"{config['page_size']} events/page, {rate}"
+        + (f" [{config['label']}]" if config.get("label") else ""),
+        f"Kafka profile: {report.get('kafka_profile') or 'none'}",
+        f"Emitted {report['documents']} documents ({format_size(report['payload_bytes'])}) "
+        f"in {report['emit_seconds']:.2f} s: {report['emitted_events_per_s'] or 0:.0f} events/s",
+        "",
+    ]
+    rows = [("PATH", "RECEIVED", "EVENTS/S", "P50 MS", "P99 MS", "MAX MS")]
+    for path, summary in report["paths"].items():
+        if path == "tiled":
+            received = f"{summary['received']}/{report['runs']} runs"
+        elif path == "storage":
+            received = f"{summary['received']}/{report['events']} events"
+        else:
+            received = f"{summary['received']}/{report['documents']}"
+        latency = summary["latency_ms"]
+        rows.append((
+            path,
+            received,
+            f"{summary['events_per_s']:.0f}" if summary["events_per_s"] else "-",
+            _format_ms(latency, "p50"),
+            _format_ms(latency, "p99"),
+            _format_ms(latency, "max"),
+        ))
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    for row in rows:
+        cells = [
+            cell.ljust(width) if i < 1 else cell.rjust(width)
+            for i, (cell, width) in enumerate(zip(row, widths))
+        ]
+        lines.append("  ".join(cells).rstrip())
+    amplification = report.get("amplification")
+    if amplification:
+        lines += [
+            "",
+            f"Storage: {format_size(amplification['stored_bytes'])} stored "
+            f"({amplification['stored_per_payload']:.2f}x payload), "
+            f"{format_size(amplification['written_bytes'])} written to disk "
+            f"({amplification['written_per_payload']:.2f}x payload)",
+        ]
+    return "\n".join(lines)
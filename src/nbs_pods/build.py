@@ -0,0 +1,432 @@
+"""Cache-aware, parallel builds of the nbs-pods container images.
+
+Every directory under ``images/`` holding a Containerfile is an image. An
+image whose Containerfile starts ``FROM ${BASE_IMAGE}`` is built on top of
+the image named by the default of its ``BASE_IMAGE`` argument, which gives
+the build graph; images without a parent in ``images/`` are roots.
+
+Each image is tagged with a hash of its inputs: the Containerfile, the
+files it copies from the build context, its build arguments and the hash
+of its parent. A ``pixi.lock`` copied into an image contributes only the
+sections of the environments the image installs, and ``pixi.toml`` does not
+contribute at all, since ``pixi install --frozen`` installs exactly what the
+lock file says. Bumping a dependency of the gui environment therefore
+changes the hash of the gui image only. An image whose hash is already
+tagged locally is not rebuilt.
+
+With shared environments, the service images are built on the ``envs``
+image instead, which installs every environment in one layer so that
+packages common to them are stored and pulled once. Their own
+``pixi install`` then finds the environment installed and adds little more
+than an activation script, at the cost of rebuilding ``envs`` on any
+environment's dependency bump.
+"""
+
+import json
+import os
+import re
+import subprocess
+from pathlib import Path
+
+from nbs_pods.config import get_nbs_pods_dir
+
+BUILD_HASH_LABEL = "io.nbs-pods.build-hash"
+DEFAULT_REGISTRY = "localhost/"
+SHARED_ENVS_IMAGE = "envs"
+HASH_LENGTH = 16
+
+_ARG_RE = re.compile(r"^ARG\s+(\w+)(?:=(\S*))?\s*$")
+_FROM_RE = re.compile(r"^FROM\s+(\S+)")
+_COPY_RE = re.compile(r"^(?:COPY|ADD)\s+(.*)$")
+_PIXI_ENV_RE = re.compile(r"pixi\s+install\b[^&;|]*?(?:-e|--environment)[ =](\S+)")
+
+_lock_environments = {}
+
+
+def get_build_context(context=None):
+    """
+    Get the build context the images are built from.
+
+    Parameters
+    ----------
+    context : str, optional
+        Directory given on the command line, defaults to the nbs-pods
+        source checkout this module is installed from
+
+    Returns
+    -------
+    Path
+        Directory containing ``images/``
+
+    Raises
+    ------
+    RuntimeError
+        If the directory has no ``images/``
+    """
+    if context is None:
+        # __file__ is src/nbs_pods/build.py in a checkout
+        path = get_nbs_pods_dir().parents[1]
+        if not (path / "images").is_dir():
+            raise RuntimeError(
+                "Building images needs an nbs-pods source checkout; "
+                "pass its location with --context"
+            )
+        return path
+    path = Path(os.path.expanduser(context)).resolve()
+    if not (path / "images").is_dir():
+        raise RuntimeError(f"No images/ directory in {path}")
+    return path
+
+
+def _join_continuation_lines(text):
+    """Split a Containerfile into instructions, joining continued lines."""
+    instructions = []
+    current = ""
+    for line in text.splitlines():
+        stripped = line.strip()
+        if not current and (not stripped or stripped.startswith("#")):
+            continue
+        if stripped.endswith("\\"):
+            current += stripped[:-1] + " "
+            continue
+        instructions.append(current + stripped)
+        current = ""
+    if current:
+        instructions.append(current)
+    return instructions
+
+
+def parse_containerfile(containerfile):
+    """
+    Extract what the build graph and hash need from a Containerfile.
+
+    Parameters
+    ----------
+    containerfile : Path
+        Path to the Containerfile
+
+    Returns
+    -------
+    dict
+        ``from``: the FROM reference, ``args``: mapping of ARG names to their
+        defaults, ``copies``: source paths of COPY/ADD instructions and
+        ``envs``: pixi environments installed with ``pixi install -e``
+    """
+    args = {}
+    from_image = None
+    copies = []
+    envs = []
+    for instruction in _join_continuation_lines(containerfile.read_text()):
+        match = _ARG_RE.match(instruction)
+        if match:
+            args[match.group(1)] = match.group(2)
+            continue
+        match = _FROM_RE.match(instruction)
+        if match:
+            from_image = match.group(1)
+            continue
+        match = _COPY_RE.match(instruction)
+        if match:
+            words = [word for word in match.group(1).split() if not word.startswith("--")]
+            if "--from" not in match.group(1):
+                copies.extend(words[:-1])
+            continue
+        if instruction.startswith("RUN"):
+            envs.extend(_PIXI_ENV_RE.findall(instruction))
+    return {"from": from_image, "args": args, "copies": copies, "envs": envs}
+
+
+def discover_images(context, shared_envs=False):
+    """
+    Find the images and the build graph between them.
+
+    Parameters
+    ----------
+    context : Path
+        Build context containing ``images/<name>/Containerfile``
+    shared_envs : bool
+        Whether images installing only environments that the ``envs`` image
+        installs are built on it rather than on their own parent
+
+    Returns
+    -------
+    dict[str, dict]
+        Mapping of image name to its parsed Containerfile (see
+        ``parse_containerfile``) plus ``containerfile`` and ``base``, the
+        name of the parent image or None
+    """
+    images = {}
+    for containerfile in sorted((context / "images").glob("*/Containerfile")):
+        images[containerfile.parent.name] = dict(
+            parse_containerfile(containerfile), containerfile=containerfile
+        )
+    for image in images.values():
+        base = None
+        if image["from"] in ("${BASE_IMAGE}", "$BASE_IMAGE"):
+            default = image["args"].get("BASE_IMAGE") or ""
+            # bluesky, bluesky:latest or <registry>/bluesky:latest
+            name = default.rsplit("/", 1)[-1].split(":", 1)[0]
+            if name in images:
+                base = name
+        image["base"] = base
+
+    shared = images.get(SHARED_ENVS_IMAGE)
+    if shared_envs and shared:
+        for name, image in images.items():
+            if (
+                name != SHARED_ENVS_IMAGE
+                and image["envs"]
+                and image["base"] == shared["base"]
+                and set(image["envs"]) <= set(shared["envs"])
+            ):
+                image["base"] = SHARED_ENVS_IMAGE
+    return images
+
+
+def get_build_graph(images, selected=None):
+    """
+    Get the build graph of some images and everything they are built on.
+
+    Parameters
+    ----------
+    images : dict[str, dict]
+        Images from ``discover_images``
+    selected : list[str], optional
+        Images to build, defaults to all but the ``envs`` image, which is
+        only built when images are built on it
+
+    Returns
+    -------
+    dict[str, set[str]]
+        Mapping of image to the set containing its parent, if any, with
+        parents before the images built on them
+
+    Raises
+    ------
+    ValueError
+        If a selected image does not exist, or images are built on each
+        other in a cycle
+    """
+    graph = {}
+    visiting = set()
+
+    def add(name):
+        if name in graph:
+            return
+        if name in visiting:
+            raise ValueError(f"Image '{name}' is built on itself")
+        visiting.add(name)
+        base = images[name]["base"]
+        if base:
+            add(base)
+        # Parents are inserted first, which plan_builds relies on
+        graph[name] = {base} if base else set()
+
+    for name in selected or [name for name in images if name != SHARED_ENVS_IMAGE]:
+        if name not in images:
+            raise ValueError(f"Unknown image '{name}'")
+        add(name)
+    return graph
+
+
+def _load_lock_environments(lock_file):
+    """Load the environments section of a pixi lock file, once per file."""
+    if lock_file not in _lock_environments:
+        import yaml
+
+        loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+        with open(lock_file, encoding="utf-8") as f:
+            _lock_environments[lock_file] = yaml.load(f, Loader=loader).get("environments") or {}
+    return _lock_environments[lock_file]
+
+
+def _hash_source(digest, context, source, envs):
+    """Feed a COPY source, relative to the build context, to a digest."""
+    path = context / source
+    if path.is_dir():
+        files = sorted(p for p in path.rglob("*") if p.is_file() and ".pixi" not in p.parts)
+    else:
+        files = sorted(path.parent.glob(path.name))
+    for file in files:
+        digest.update(file.relative_to(context).as_posix().encode() + b"\0")
+        if file.name == "pixi.toml":
+            continue
+        if file.name == "pixi.lock":
+            environments = _load_lock_environments(str(file))
+            for env in envs:
+                if env not in environments:
+                    raise ValueError(f"pixi environment '{env}' is not in {file.relative_to(context)}")
+                digest.update(json.dumps(environments[env], sort_keys=True).encode())
+            continue
+        digest.update(file.read_bytes())
+
+
+def hash_image(image, context, parent_hash=None, build_args=None):
+    """
+    Hash the inputs of an image build.
+
+    Parameters
+    ----------
+    image : dict
+        Image from ``discover_images``
+    context : Path
+        Build context
+    parent_hash : str, optional
+        Hash of the parent image, for images built on another image
+    build_args : dict, optional
+        Build arguments given on the command line
+
+    Returns
+    -------
+    str
+        Hex digest
+
+    Raises
+    ------
+    ValueError
+        If the image installs a pixi environment missing from the lock file
+    """
+    import hashlib
+
+    digest = hashlib.sha256(image["containerfile"].read_bytes())
+    # The parent hash stands in for BASE_IMAGE; for roots, the FROM
+    # reference is already part of the Containerfile
+    digest.update(f"parent={parent_hash}\0".encode())
+    for name, value in sorted((build_args or {}).items()):
+        if name != "BASE_IMAGE" and name in image["args"]:
+            digest.update(f"{name}={value}\0".encode())
+    for source in image["copies"]:
+        _hash_source(digest, context, source, image["envs"])
+    return digest.hexdigest()
+
+
+def plan_builds(images, graph, context, build_args=None):
+    """
+    Compute the hash of every image in a build graph.
+
+    Parameters
+    ----------
+    images : dict[str, dict]
+        Images from ``discover_images``
+    graph : dict[str, set[str]]
+        Build graph from ``get_build_graph``, parents first
+    context : Path
+        Build context
+    build_args : dict, optional
+        Build arguments given on the command line
+
+    Returns
+    -------
+    tuple[dict[str, str], dict[str, Exception]]
+        (hashes, errors) mapping images to their truncated hash, or to the
+        error that prevented hashing them or their parent
+    """
+    hashes = {}
+    errors = {}
+    for name in graph:
+        base = images[name]["base"]
+        if base in errors:
+            errors[name] = RuntimeError(f"cannot hash parent image {base}")
+            continue
+        try:
+            digest = hash_image(images[name], context, hashes.get(base), build_args)
+        except (OSError, ValueError) as e:
+            errors[name] = e
+            continue
+        hashes[name] = digest[:HASH_LENGTH]
+    return hashes, errors
+
+
+def get_image_reference(name, tag, registry=DEFAULT_REGISTRY):
+    """Get the full reference of an image, e.g. ``localhost/gui:<hash>``."""
+    return f"{registry}{name}:{tag}"
+
+
+def image_exists(reference):
+    """Whether an image reference exists in local storage."""
+    result = subprocess.run(
+        ["podman", "image", "exists", reference],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    return result.returncode == 0
+
+
+def get_build_command(name, image, context, build_hash, registry=DEFAULT_REGISTRY,
+                      base_hash=None, build_args=None, no_cache=False):
+    """
+    Get the ``podman build`` command for an image.
+
+    The image is tagged with its hash and ``latest``, and built on its
+    parent's hash tag, so it uses exactly the parent planned with it.
+
+    Returns
+    -------
+    list[str]
+        Command to run
+    """
+    command = [
+        "podman",
+        "build",
+        "-f",
+        str(image["containerfile"]),
+        "-t",
+        get_image_reference(name, build_hash, registry),
+        "-t",
+        get_image_reference(name, "latest", registry),
+        "--label",
+        f"{BUILD_HASH_LABEL}={build_hash}",
+    ]
+    args = {
+        key: value for key, value in (build_args or {}).items() if key in image["args"]
+    }
+    if image["base"]:
+        args["BASE_IMAGE"] = get_image_reference(image["base"], base_hash, registry)
+    for key, value in args.items():
+        command.extend(["--build-arg", f"{key}={value}"])
+    if no_cache:
+        command.append("--no-cache")
+    command.append(str(context))
+    return command
+
+
+def run_build_command(command, prefix=None):
+    """
+    Run a build command, prefixing its output lines with ``[prefix]``.
+
+    Returns
+    -------
+    int
+        Exit code
+    """
+    if prefix is None:
+        return subprocess.run(command).returncode
+    process = subprocess.Popen(
+        command,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        errors="replace",
+    )
+    for line in process.stdout:
+        print(f"[{prefix}] {line}", end="", flush=True)
+    return process.wait()
+
+
+def parse_build_args(values):
+    """
+    Parse ``NAME=VALUE`` build arguments.
+
+    Raises
+    ------
+    ValueError
+        If a value has no ``=``
+    """
+    build_args = {}
+    for value in values or []:
+        name, sep, arg = value.partition("=")
+        if not sep:
+            raise ValueError(f"Build argument '{value}' is not NAME=VALUE")
+        build_args[name] = arg
+    return build_args
+
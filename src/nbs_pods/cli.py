@@ -4,13 +4,83 @@ import argparse
 import os
 import subprocess
 import sys
+from contextlib import nullcontext
 from copy import copy
+from functools import lru_cache
 
-from nbs_pods.compose import build_compose_file_string
-from nbs_pods.config import get_beamline_pods_dir, get_nbs_pods_dir
-from nbs_pods.services import get_all_services, discover_gui_services
+from nbs_pods.compose import build_compose_file_string, get_compose_project
+from nbs_pods.confighash import (
+    compute_config_hashes,
+    get_changed_containers,
+    write_hash_override,
+)
+from nbs_pods.config import get_beamline_name, get_beamline_pods_dir, get_nbs_pods_dir
+from nbs_pods.kafka import KAFKA_KEY, KAFKA_PROFILE_ENV
+from nbs_pods.logs import LEVELS as LOG_LEVELS, capture_logs, get_service_containers, keep_logs
+from nbs_pods.mongo import MONGO_KEY, MONGO_PROFILE_ENV
+from nbs_pods.resources import PROFILE_ENV, RESOURCES_KEY
+from nbs_pods.shared import (
+    SHARED_ENV,
+    SHARED_KEY,
+    SHARED_SERVICE,
+    connect_beamline_network,
+    create_kafka_topic,
+    disconnect_beamline_network,
+    get_kafka_topic,
+    is_shared_mode,
+    load_shared_state,
+    save_shared_state,
+    shared_lock,
+    write_tiled_config,
+)
+from nbs_pods.scheduler import (
+    build_dependency_graph,
+    get_default_jobs,
+    reverse_graph,
+    run_in_dependency_order,
+)
+from nbs_pods.trace import span
+from nbs_pods.state import (
+    PAUSED,
+    RUNNING,
+    STOPPED,
+    clear_service_state,
+    get_services_with_status,
+    load_service_state,
+    save_service_state,
+)
+from nbs_pods.stack import (
+    build_stack_document,
+    get_stack_containers,
+    get_stack_project,
+    write_stack_file,
+)
+from nbs_pods.services import (
+    get_all_services,
+    discover_gui_services,
+    get_service_dependencies,
+)
+
+
+@lru_cache(maxsize=None)
+def get_gui_services():
+    """
+    Discover GUI services on first use rather than at import time.
+
+    Returns
+    -------
+    list[str]
+        GUI service names
+    """
+    return discover_gui_services()
+
+
+def __getattr__(name):
+    # Backwards compatibility for the former module-level gui_services list
+    if name == "gui_services":
+        return get_gui_services()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-gui_services = discover_gui_services()
 
 def setup_environment(beamline_pods_dir=None):
     """Setup environment variables."""
@@ -20,24 +90,154 @@ def setup_environment(beamline_pods_dir=None):
     if beamline_pods_dir is not None:
         env["BEAMLINE_PODS_DIR"] = str(beamline_pods_dir)
     else:
-        env["BEAMLINE_PODS_DIR"] = get_beamline_pods_dir()
+        env["BEAMLINE_PODS_DIR"] = str(get_beamline_pods_dir())
     return env
 
 
-def start_service(service, dev_mode=False, test_mode=False, hold_mode=False, ignore_override=False, verbose=False):
+def set_compose_files(env, compose_file_string):
+    """
+    Point podman-compose at a compose chain.
+
+    In multi-beamline mode the project name is set as well, since it is
+    prefixed with the beamline name rather than taken from the directory.
+
+    Parameters
+    ----------
+    env : dict
+        Environment to update
+    compose_file_string : str
+        Colon-separated compose file chain
+    """
+    env["COMPOSE_FILE"] = compose_file_string
+    if is_shared_mode():
+        env["COMPOSE_PROJECT_NAME"] = get_compose_project(compose_file_string)
+
+
+def run_compose_command(command, env, prefix=None):
     """
-    Start a service using podman-compose.
+    Run a podman-compose command.
+
+    Parameters
+    ----------
+    command : list[str]
+        Command to run
+    env : dict
+        Environment for the command
+    prefix : str, optional
+        If given, prefix every output line with ``[prefix]`` so that output
+        of services running concurrently can be told apart
+
+    Returns
+    -------
+    subprocess.CompletedProcess
+    """
+    if prefix is None:
+        return subprocess.run(command, env=env)
+
+    process = subprocess.Popen(
+        command,
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        errors="replace",
+    )
+    for line in process.stdout:
+        print(f"[{prefix}] {line}", end="", flush=True)
+    process.wait()
+    return subprocess.CompletedProcess(command, process.returncode)
+
+
+def get_default_backend():
+    """
+    Get the default backend for starting and stopping services.
+
+    Returns
+    -------
+    str
+        Value of NBS_PODS_BACKEND, or 'compose' if not set
+    """
+    return os.getenv("NBS_PODS_BACKEND", "compose")
+
+
+def run_api_command(action, service, compose_file_string, env, verbose=False, containers=None):
+    """
+    Bring a compose project up or down through the podman REST API.
+
+    Parameters
+    ----------
+    action : str
+        'up' or 'down', or 'stop', 'start', 'pause' or 'unpause' to change
+        the state of existing containers
+    service : str
+        Service name, used for reporting
+    compose_file_string : str
+        Colon-separated compose file chain
+    env : dict
+        Environment for variable interpolation
+    containers : list[str], optional
+        Only bring up these compose services
+
+    Returns
+    -------
+    subprocess.CompletedProcess
+        Return code 0 on success, 1 on failure
+    """
+    from nbs_pods import api_backend
+
+    command = ["podman-api", action, service]
+    try:
+        if action == "up":
+            api_backend.up(compose_file_string, env, containers, verbose=verbose, service=service)
+        elif action == "down":
+            api_backend.down(compose_file_string, verbose=verbose)
+        else:
+            api_backend.set_project_state(compose_file_string, action)
+    except (RuntimeError, OSError) as e:
+        print(f"Error: [{service}] {e}", file=sys.stderr, flush=True)
+        return subprocess.CompletedProcess(command, 1)
+    return subprocess.CompletedProcess(command, 0)
+
+
+def add_config_hash_override(service, compose_file_string, env):
+    """
+    Append a generated override labelling containers with their config hash.
 
     Parameters
     ----------
     service : str
         Service name
-    dev_mode : bool
-        Whether to start in development mode
+    compose_file_string : str
+        Colon-separated compose file chain
+    env : dict
+        Environment for variable interpolation
+
+    Returns
+    -------
+    tuple[str, dict]
+        (compose_file_string, hashes) where the chain has the hash override
+        appended; if the hashes cannot be computed the chain is returned
+        unchanged and hashes is None
     """
-    mode_str = " (dev mode)" if dev_mode else ""
-    print(f"Starting {service}{mode_str}...", flush=True)
+    try:
+        with span("config hash", "hash", service):
+            hashes = compute_config_hashes(compose_file_string, env)
+            hash_file = write_hash_override(service, hashes)
+    except (RuntimeError, OSError) as e:
+        print(f"Warning: could not hash configuration of {service}: {e}", file=sys.stderr)
+        return compose_file_string, None
+    return f"{compose_file_string}:{hash_file}", hashes
+
+
+def get_override_keys(dev_mode=False, test_mode=False, hold_mode=False, ignore_override=False):
+    """
+    Get the override keys to chain after a service's base compose file.
 
+    Returns
+    -------
+    list[str]
+        Override keys, in the order their files are applied
+    """
     override_keys = []
     if not ignore_override:
         override_keys.append("override")
@@ -47,153 +247,1280 @@ def start_service(service, dev_mode=False, test_mode=False, hold_mode=False, ign
         override_keys.append("test")
     if hold_mode:
         override_keys.append("hold")
+    override_keys.append(SHARED_KEY)
+    override_keys.append(KAFKA_KEY)
+    override_keys.append(MONGO_KEY)
+    override_keys.append(RESOURCES_KEY)
+    return override_keys
+
+
+def start_service(service, dev_mode=False, test_mode=False, hold_mode=False, ignore_override=False, verbose=False, check=True, prefix_output=False, wait=False, backend="compose"):
+    """
+    Start a service using podman-compose or the podman API.
+
+    Parameters
+    ----------
+    service : str
+        Service name
+    dev_mode : bool
+        Whether to start in development mode
+    check : bool
+        Whether to exit on failure, otherwise the result is returned
+    prefix_output : bool
+        Whether to prefix output lines with the service name
+    wait : bool
+        Whether to wait for the service's readiness probes to succeed
+    backend : str
+        'compose' to run podman-compose, 'api' to use the podman REST API
+    """
+    if service == SHARED_SERVICE and not test_mode and is_shared_mode():
+        try:
+            result = start_shared_service(
+                service, dev_mode, hold_mode, ignore_override, verbose, prefix_output, wait, backend
+            )
+        except RuntimeError as e:
+            if not check:
+                raise
+            print(f"Error: {e}", file=sys.stderr)
+            sys.exit(1)
+        if check and result.returncode != 0:
+            sys.exit(result.returncode)
+        return result
+
+    mode_str = " (dev mode)" if dev_mode else ""
+    print(f"Starting {service}{mode_str}...\n", end="", flush=True)
+
+    override_keys = get_override_keys(dev_mode, test_mode, hold_mode, ignore_override)
+
+    try:
+        with span("resolve compose files", "resolve", service):
+            compose_file_string = build_compose_file_string(service, verbose, get_gui_services(), override_keys)
+    except RuntimeError as e:
+        if not check:
+            raise
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    compose_files = compose_file_string.split(":")
+    labels = ["(base)"]
+    for compose_file in compose_files[1:]:
+        compose_name = os.path.basename(compose_file)
+        label = ""
+        for key in override_keys:
+            if compose_name == f"docker-compose.{key}.yml":
+                label = f"({key})"
+                break
+        labels.append(label)
+
+    # Print as one block so it is not interleaved with concurrent starts
+    lines = [f"  Using compose files ({service}):"]
+    for i, compose_file in enumerate(compose_files):
+        label = labels[i] if i < len(labels) else ""
+        lines.append(f"    - {compose_file} {label}")
+    print("\n".join(lines) + "\n", end="", flush=True)
+
+    env = setup_environment()
+    compose_file_string, _ = add_config_hash_override(service, compose_file_string, env)
+    set_compose_files(env, compose_file_string)
+
+    if backend == "api":
+        if test_mode:
+            message = "Test mode is not supported by the api backend"
+            if not check:
+                raise RuntimeError(message)
+            print(f"Error: {message}", file=sys.stderr)
+            sys.exit(1)
+        with span("podman API up", "up", service, project=get_compose_project(compose_file_string)):
+            result = run_api_command("up", service, compose_file_string, env, verbose)
+    else:
+        command = ["podman-compose", "up"]
+        if not test_mode:
+            command.append("-d")
+        else:
+            command.append("--abort-on-container-exit")
+            command.extend(["--exit-code-from", service])
+        with span("podman-compose up", "up", service, project=get_compose_project(compose_file_string)):
+            result = run_compose_command(command, env, prefix=service if prefix_output else None)
+        if test_mode:
+            # The test's containers stay behind; keep their logs for `nbs-pods logs`
+            keep_logs(service, get_compose_project(compose_file_string))
+            if result.returncode != 0:
+                print(
+                    f"{service} exited with code {result.returncode}; "
+                    f"see `nbs-pods logs {service}` for the logs of all its containers",
+                    file=sys.stderr,
+                )
+
+    if check and result.returncode != 0:
+        sys.exit(result.returncode)
+    if result.returncode == 0 and not test_mode:
+        save_service_state(service, compose_file_string)
+
+    if wait and not test_mode and result.returncode == 0:
+        try:
+            wait_for_service(service, compose_file_string)
+        except RuntimeError as e:
+            if not check:
+                raise
+            print(f"Error: {e}", file=sys.stderr)
+            sys.exit(1)
+    return result
+
+
+def restart_service(service, dev_mode=False, hold_mode=False, ignore_override=False, verbose=False, prefix_output=False, wait=False, backend="compose"):
+    """
+    Recreate the containers of a service whose configuration changed.
+
+    A container is recreated if its config hash label differs from the hash
+    of its current compose definition and mounted config files, or if it
+    does not exist. Unchanged containers keep running.
+
+    Parameters
+    ----------
+    service : str
+        Service name
+    dev_mode : bool
+        Whether to restart in development mode
+    prefix_output : bool
+        Whether to prefix output lines with the service name
+    wait : bool
+        Whether to wait for the service's readiness probes to succeed
+    backend : str
+        'compose' to run podman-compose, 'api' to use the podman REST API
+
+    Returns
+    -------
+    subprocess.CompletedProcess
+
+    Raises
+    ------
+    RuntimeError
+        If the compose chain cannot be resolved, or the service does not
+        become ready
+    """
+    shared_chain = None
+    if service == SHARED_SERVICE and is_shared_mode():
+        # The shared stack keeps the chain of the beamline that started it
+        shared_chain = load_shared_state()["compose_file"]
+    if shared_chain:
+        compose_file_string = shared_chain
+    else:
+        override_keys = get_override_keys(dev_mode, False, hold_mode, ignore_override)
+        with span("resolve compose files", "resolve", service):
+            compose_file_string = build_compose_file_string(service, verbose, get_gui_services(), override_keys)
+    return recreate_service(service, compose_file_string, verbose, prefix_output, wait, backend)
+
+
+def recreate_service(service, compose_file_string, verbose=False, prefix_output=False, wait=False, backend="compose"):
+    """
+    Recreate the containers of a resolved compose chain whose configuration changed.
+
+    Missing containers are created, so this also starts a service.
+
+    Parameters
+    ----------
+    service : str
+        Service name
+    compose_file_string : str
+        Colon-separated compose file chain, without the hash override
+    prefix_output : bool
+        Whether to prefix output lines with the service name
+    wait : bool
+        Whether to wait for the service's readiness probes to succeed
+    backend : str
+        'compose' to run podman-compose, 'api' to use the podman REST API
+
+    Returns
+    -------
+    subprocess.CompletedProcess
+
+    Raises
+    ------
+    RuntimeError
+        If the service does not become ready
+    """
+    project = get_compose_project(compose_file_string)
+
+    env = setup_environment()
+    labelled_chain, hashes = add_config_hash_override(service, compose_file_string, env)
+    set_compose_files(env, labelled_chain)
+
+    if backend == "api":
+        from nbs_pods.podman import PROJECT_LABEL, SERVICE_LABEL
+        from nbs_pods.podman_api import get_client
+
+        try:
+            containers = get_client().list_containers({PROJECT_LABEL: project})
+        except OSError as e:
+            raise RuntimeError(f"Cannot reach the podman service: {e}")
+        running_labels = {
+            container["Labels"].get(SERVICE_LABEL): container["Labels"]
+            for container in containers
+        }
+    else:
+        from nbs_pods.podman import get_project_labels
+
+        running_labels = get_project_labels(project)
+
+    changed = None
+    if hashes is not None:
+        changed = get_changed_containers(hashes, running_labels)
+    if changed == []:
+        print(f"{service} is up to date\n", end="", flush=True)
+        return subprocess.CompletedProcess([], 0)
+
+    verb = "Recreating" if running_labels else "Creating"
+    if changed is None:
+        print(f"{verb} {service}...\n", end="", flush=True)
+    else:
+        print(f"{verb} {service}: {', '.join(changed)}\n", end="", flush=True)
+    with span("recreate containers", "up", service, project=project):
+        if backend == "api":
+            result = run_api_command("up", service, labelled_chain, env, verbose, containers=changed)
+        else:
+            command = ["podman-compose", "up", "-d", "--force-recreate"]
+            if changed is not None:
+                command.extend(["--no-deps"] + changed)
+            result = run_compose_command(command, env, prefix=service if prefix_output else None)
+
+    if result.returncode == 0:
+        save_service_state(service, labelled_chain)
+    if wait and result.returncode == 0:
+        wait_for_service(service, labelled_chain)
+    return result
+
+
+def start_shared_service(service, dev_mode=False, hold_mode=False, ignore_override=False, verbose=False, prefix_output=False, wait=False, backend="compose"):
+    """
+    Start the bluesky-services stack shared by several beamlines, or join it.
+
+    The first beamline starts the stack from its own compose chain. Later
+    beamlines join the running stack, which only recreates Tiled to serve
+    their database. Either way the shared containers join the beamline's
+    network, and the beamline's Kafka topic is created.
+
+    Parameters
+    ----------
+    service : str
+        Service name
+    dev_mode : bool
+        Whether to start in development mode, if the stack is not running
+    prefix_output : bool
+        Whether to prefix output lines with the service name
+    wait : bool
+        Whether to wait for the service's readiness probes to succeed
+    backend : str
+        'compose' to run podman-compose, 'api' to use the podman REST API
+
+    Returns
+    -------
+    subprocess.CompletedProcess
+
+    Raises
+    ------
+    RuntimeError
+        If the compose chain cannot be resolved, the shared containers
+        cannot join the beamline's network, or the service does not become
+        ready
+    """
+    from nbs_pods.podman import find_containers
+
+    beamline = get_beamline_name()
+    with shared_lock():
+        shared_state = load_shared_state()
+        others = [name for name in shared_state["beamlines"] if name != beamline]
+        compose_file_string = shared_state["compose_file"]
+        if compose_file_string and not find_containers(get_compose_project(compose_file_string)):
+            compose_file_string = None
+        shared_state["beamlines"] = others + [beamline]
+        save_shared_state(shared_state)
+
+        if compose_file_string:
+            print(f"Joining {service} shared with {', '.join(others) or 'no other beamline'}...\n", end="", flush=True)
+            write_tiled_config(shared_state["beamlines"])
+        else:
+            mode_str = " (dev mode)" if dev_mode else ""
+            print(f"Starting shared {service}{mode_str}...\n", end="", flush=True)
+            override_keys = get_override_keys(dev_mode, False, hold_mode, ignore_override)
+            with span("resolve compose files", "resolve", service):
+                compose_file_string = build_compose_file_string(service, verbose, get_gui_services(), override_keys)
+            shared_state["compose_file"] = compose_file_string
+            save_shared_state(shared_state)
+
+        result = recreate_service(service, compose_file_string, verbose, prefix_output, wait, backend)
+        if result.returncode == 0:
+            project = get_compose_project(compose_file_string)
+            connect_beamline_network(project, beamline)
+            if not create_kafka_topic(project, beamline):
+                print(
+                    f"Warning: could not create Kafka topic {get_kafka_topic(beamline)}, "
+                    "it is created when first used",
+                    file=sys.stderr,
+                    flush=True,
+                )
+    return result
+
+
+def stop_service(service, verbose=False, check=True, prefix_output=False, backend="compose", keep_state=False):
+    """
+    Stop a service using podman-compose or the podman API.
+
+    The compose chain recorded when the service was started is used, so
+    development, hold and hash override files apply to the stop as well.
+
+    Parameters
+    ----------
+    service : str
+        Service name
+    check : bool
+        Whether to exit on failure, otherwise the result is returned
+    prefix_output : bool
+        Whether to prefix output lines with the service name
+    backend : str
+        'compose' to run podman-compose, 'api' to use the podman REST API
+    keep_state : bool
+        Whether to only stop the containers, keeping them and their volumes
+        so the service can be resumed, instead of removing them
+    """
+    print(f"Stopping {service}...\n", end="", flush=True)
+
+    shared = service == SHARED_SERVICE and is_shared_mode()
+    # Hold the shared lock until the stack is down, so no beamline joins it meanwhile
+    with shared_lock() if shared else nullcontext():
+        if shared:
+            beamline = get_beamline_name()
+            shared_state = load_shared_state()
+            others = [name for name in shared_state["beamlines"] if name != beamline]
+            if shared_state["compose_file"]:
+                disconnect_beamline_network(get_compose_project(shared_state["compose_file"]), beamline)
+            shared_state["beamlines"] = others
+            if not others:
+                shared_state["compose_file"] = None
+            save_shared_state(shared_state)
+            if others:
+                clear_service_state(service)
+                print(f"{service} is still used by {', '.join(others)}, leaving it running\n", end="", flush=True)
+                return subprocess.CompletedProcess([], 0)
+        return stop_service_containers(service, verbose, check, prefix_output, backend, keep_state)
+
+
+def stop_service_containers(service, verbose=False, check=True, prefix_output=False, backend="compose", keep_state=False):
+    """
+    Stop the containers of a service with its recorded compose chain.
+
+    Parameters
+    ----------
+    service : str
+        Service name
+    check : bool
+        Whether to exit on failure, otherwise the result is returned
+    prefix_output : bool
+        Whether to prefix output lines with the service name
+    backend : str
+        'compose' to run podman-compose, 'api' to use the podman REST API
+    keep_state : bool
+        Whether to only stop the containers instead of removing them
+
+    Returns
+    -------
+    subprocess.CompletedProcess
+    """
+    state = load_service_state(service)
+    if state is not None:
+        compose_file_string = state["compose_file"]
+        if verbose:
+            print(f"  Using recorded compose files: {compose_file_string}", flush=True)
+    else:
+        try:
+            compose_file_string = build_compose_file_string(
+                service, verbose=verbose, gui_services=get_gui_services()
+            )
+        except RuntimeError as e:
+            if not check:
+                raise
+            print(f"Error: {e}", file=sys.stderr)
+            sys.exit(1)
+
+        compose_files = compose_file_string.split(":")
+        if len(compose_files) > 1:
+            compose_file_string = ":".join(compose_files[:2])
+        else:
+            compose_file_string = compose_files[0]
+
+    env = setup_environment()
+    set_compose_files(env, compose_file_string)
+
+    if not keep_state:
+        with span("keep logs", "logs", service):
+            keep_logs(service, get_compose_project(compose_file_string), backend)
+
+    with span("stop containers", "down", service):
+        if backend == "api":
+            action = "stop" if keep_state else "down"
+            result = run_api_command(action, service, compose_file_string, env, verbose)
+        else:
+            command = ["podman-compose", "stop"] if keep_state else ["podman-compose", "down", "-v"]
+            result = run_compose_command(
+                command,
+                env,
+                prefix=service if prefix_output else None,
+            )
+
+    if check and result.returncode != 0:
+        sys.exit(result.returncode)
+    if result.returncode == 0:
+        if keep_state:
+            save_service_state(service, compose_file_string, STOPPED)
+        else:
+            clear_service_state(service)
+    return result
+
+
+def change_service_state(service, action, verbose=False, prefix_output=False, backend="compose", wait=False):
+    """
+    Pause or resume the existing containers of a service.
+
+    Parameters
+    ----------
+    service : str
+        Service name
+    action : str
+        'pause' to freeze running containers, or 'resume' to unpause paused
+        containers or start containers stopped with ``stop --keep-state``
+    prefix_output : bool
+        Whether to prefix output lines with the service name
+    backend : str
+        'compose' to run podman-compose, 'api' to use the podman REST API
+    wait : bool
+        Whether to wait for the service's readiness probes after resuming
+
+    Returns
+    -------
+    subprocess.CompletedProcess
+
+    Raises
+    ------
+    RuntimeError
+        If the service has no containers to pause or resume, or does not
+        become ready
+    """
+    state = load_service_state(service)
+    if state is None:
+        raise RuntimeError(f"{service} was not started by nbs-pods")
+    if service == SHARED_SERVICE and is_shared_mode():
+        others = [name for name in load_shared_state()["beamlines"] if name != get_beamline_name()]
+        if others:
+            raise RuntimeError(f"{service} is shared with {', '.join(others)}, not changing its state")
+
+    if action == "pause":
+        transitions = {RUNNING: ("pause", PAUSED)}
+    else:
+        transitions = {PAUSED: ("unpause", RUNNING), STOPPED: ("start", RUNNING)}
+    if state["status"] not in transitions:
+        print(f"{service} is already {state['status']}\n", end="", flush=True)
+        return subprocess.CompletedProcess([], 0)
+
+    command, status = transitions[state["status"]]
+    verb = "Pausing" if action == "pause" else "Resuming"
+    print(f"{verb} {service}...\n", end="", flush=True)
+
+    compose_file_string = state["compose_file"]
+    env = setup_environment()
+    set_compose_files(env, compose_file_string)
+    with span(f"{command} containers", "up", service, project=get_compose_project(compose_file_string)):
+        if backend == "api":
+            result = run_api_command(command, service, compose_file_string, env, verbose)
+        else:
+            result = run_compose_command(
+                ["podman-compose", command], env, prefix=service if prefix_output else None
+            )
+
+    if result.returncode == 0:
+        save_service_state(service, compose_file_string, status)
+        if wait and status == RUNNING:
+            wait_for_service(service, compose_file_string)
+    return result
+
+
+def build_stack(services, dev_services=(), hold_mode=False, ignore_override=False, verbose=False):
+    """
+    Resolve and merge the compose chains of services into one stack file.
+
+    Parameters
+    ----------
+    services : list[str]
+        Service names
+    dev_services : list[str]
+        Services to include in development mode
+
+    Returns
+    -------
+    tuple[dict, dict, Path]
+        (chains, stack_doc, stack_file) where ``chains`` maps each service
+        to its colon-separated compose file chain
+    """
+    chains = {}
+    try:
+        for service in services:
+            override_keys = get_override_keys(
+                dev_mode=service in dev_services,
+                hold_mode=hold_mode,
+                ignore_override=ignore_override,
+            )
+            chains[service] = build_compose_file_string(
+                service, verbose, get_gui_services(), override_keys
+            )
+        stack_doc = build_stack_document(chains)
+    except RuntimeError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    stack_file = write_stack_file(stack_doc)
+    if verbose:
+        print(f"  Wrote merged compose file: {stack_file}", flush=True)
+    return chains, stack_doc, stack_file
+
+
+def start_stack(services, dev_services=(), hold_mode=False, ignore_override=False, verbose=False, wait=False):
+    """
+    Start services as a single merged compose project.
+
+    Parameters
+    ----------
+    services : list[str]
+        Service names
+    dev_services : list[str]
+        Services to start in development mode
+    wait : bool
+        Whether to wait for the services' readiness probes to succeed
+    """
+    project = get_stack_project()
+    print(f"Starting {', '.join(services)} as stack {project}...", flush=True)
+    chains, _, stack_file = build_stack(
+        services, dev_services, hold_mode, ignore_override, verbose
+    )
+
+    env = setup_environment()
+    env.pop("COMPOSE_FILE", None)
+    with span("podman-compose up", "up", project=project):
+        result = subprocess.run(
+            ["podman-compose", "-p", project, "-f", str(stack_file), "up", "-d"],
+            env=env,
+        )
+    if result.returncode != 0:
+        sys.exit(result.returncode)
+
+    if wait:
+        run_services(
+            {service: set() for service in services},
+            lambda service: wait_for_service(service, chains[service], project),
+            len(services),
+        )
+    return result
+
+
+def wait_for_service(service, compose_file_string, project=None):
+    """
+    Wait for the readiness probes of one service.
+
+    Parameters
+    ----------
+    service : str
+        Service name
+    compose_file_string : str
+        Colon-separated compose file chain of the service
+    project : str, optional
+        Compose project the service runs in, defaults to the project of
+        its compose chain
+
+    Returns
+    -------
+    subprocess.CompletedProcess
+
+    Raises
+    ------
+    RuntimeError
+        If the service does not become ready
+    """
+    from nbs_pods.readiness import wait_for_ready
+
+    if project is None:
+        project = get_compose_project(compose_file_string)
+    try:
+        wait_for_ready(service, compose_file_string.split(":"), project)
+    except (TimeoutError, ValueError) as e:
+        raise RuntimeError(f"{service} did not become ready: {e}")
+    return subprocess.CompletedProcess([], 0)
+
+
+def stop_stack(services, all_services, verbose=False, keep_state=False):
+    """
+    Stop services that were started as a single merged compose project.
+
+    Parameters
+    ----------
+    services : list[str]
+        Service names to stop
+    all_services : list[str]
+        All known services; if every one is stopped, the whole project is
+        taken down including its networks
+    keep_state : bool
+        Whether to only stop the containers, keeping them and their volumes
+    """
+    project = get_stack_project()
+    print(f"Stopping {', '.join(services)} in stack {project}...", flush=True)
+    _, stack_doc, stack_file = build_stack(services, verbose=verbose)
+    if not keep_state:
+        try:
+            capture_logs(get_service_containers(services))
+        except (OSError, RuntimeError) as e:
+            print(f"Warning: could not keep the logs of {', '.join(services)}: {e}", file=sys.stderr)
+
+    command = ["podman-compose", "-p", project, "-f", str(stack_file)]
+    command.extend(["stop"] if keep_state else ["down", "-v"])
+    if set(services) != set(all_services):
+        command.extend(get_stack_containers(stack_doc, services))
+
+    env = setup_environment()
+    env.pop("COMPOSE_FILE", None)
+    result = subprocess.run(command, env=env)
+    if result.returncode != 0:
+        sys.exit(result.returncode)
+    return result
+
+
+def get_dependency_graph(services, all_services):
+    """
+    Build the dependency graph between services.
+
+    Parameters
+    ----------
+    services : list[str]
+        Services to include in the graph
+    all_services : list[str]
+        All known services, used to resolve dependencies
+
+    Returns
+    -------
+    dict[str, set[str]]
+        Mapping of service to the set of services it depends on
+    """
+
+    def get_dependencies(service):
+        try:
+            return get_service_dependencies(service, all_services, get_gui_services())
+        except RuntimeError:
+            # Reported when the service itself is started or stopped
+            return []
+
+    return build_dependency_graph(services, get_dependencies)
+
+
+def run_services(graph, func, jobs):
+    """
+    Run a start/stop function over a dependency graph and report failures.
+
+    Parameters
+    ----------
+    graph : dict[str, set[str]]
+        Mapping of service to the set of services it must wait for
+    func : callable
+        Function called with a service name, returning a CompletedProcess
+    jobs : int
+        Parallelism limit
+    """
+
+    def run(service):
+        result = func(service)
+        if result.returncode != 0:
+            raise RuntimeError(f"{service} exited with code {result.returncode}")
+        return result
+
+    try:
+        _, errors, skipped = run_in_dependency_order(graph, run, max_workers=jobs)
+    except RuntimeError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    for service, error in errors.items():
+        print(f"Error: {error}", file=sys.stderr)
+    if skipped:
+        print(
+            f"Skipped because a dependency failed: {', '.join(skipped)}",
+            file=sys.stderr,
+        )
+    if errors or skipped:
+        sys.exit(1)
+
+
+def cmd_start(args):
+    """Handle start command."""
+    with span("discover services", "discover"):
+        base_services, beamline_services = get_all_services()
+    all_services = base_services + beamline_services
+    jobs = args.jobs if args.jobs is not None else get_default_jobs()
+    prefix_output = jobs > 1
+    backend = args.backend or get_default_backend()
+
+    if args.stack:
+        if backend == "api":
+            print("Error: --stack is not supported by the api backend", file=sys.stderr)
+            sys.exit(1)
+        if args.test:
+            print("Error: --test cannot be combined with --stack", file=sys.stderr)
+            sys.exit(1)
+        if is_shared_mode():
+            print("Error: --stack is not supported in multi-beamline mode", file=sys.stderr)
+            sys.exit(1)
+        services = args.services + args.dev or all_services
+        for item in services:
+            if item not in all_services:
+                print(f"Error: Unknown service '{item}'", file=sys.stderr)
+                print_available_services()
+                sys.exit(1)
+        start_stack(
+            list(dict.fromkeys(services)),
+            dev_services=args.dev,
+            hold_mode=args.hold,
+            ignore_override=args.ignore_override,
+            verbose=args.verbose,
+            wait=not args.no_wait,
+        )
+        return
+
+    if not args.services and not args.dev and not args.test:
+        graph = get_dependency_graph(all_services, all_services)
+        run_services(
+            graph,
+            lambda service: start_service(
+                service,
+                check=False,
+                prefix_output=prefix_output,
+                wait=not args.no_wait,
+                backend=backend,
+            ),
+            jobs,
+        )
+        return
+
+    dev_services = args.dev
+    test_services = args.test
+    verbose = args.verbose
+    hold_mode = args.hold
+    ignore_override = args.ignore_override
+    for item in args.services + dev_services + test_services:
+        if item not in all_services:
+            print(f"Error: Unknown service '{item}'", file=sys.stderr)
+            print_available_services()
+            sys.exit(1)
+
+    graph = get_dependency_graph(args.services + dev_services, all_services)
+    run_services(
+        graph,
+        lambda service: start_service(
+            service,
+            dev_mode=service in dev_services,
+            verbose=verbose,
+            ignore_override=ignore_override,
+            hold_mode=hold_mode,
+            check=False,
+            prefix_output=prefix_output,
+            wait=not args.no_wait,
+            backend=backend,
+        ),
+        jobs,
+    )
+
+    # Test mode blocks until the service exits, so tests run one at a time
+    for item in test_services:
+        start_service(item, test_mode=True, verbose=verbose, ignore_override=ignore_override, hold_mode=hold_mode)
+
+
+def cmd_restart(args):
+    """Handle restart command."""
+    if args.full:
+        stop_args = copy(args)
+        stop_args.services = args.services + args.dev
+        print(f"Restarting {stop_args.services}")
+
+        cmd_stop(stop_args)
+        cmd_start(args)
+        return
+
+    base_services, beamline_services = get_all_services()
+    all_services = base_services + beamline_services
+    jobs = args.jobs if args.jobs is not None else get_default_jobs()
+    backend = args.backend or get_default_backend()
+    services = args.services + args.dev or all_services
+    for service in services:
+        if service not in all_services:
+            print(f"Error: Unknown service '{service}'", file=sys.stderr)
+            print_available_services()
+            sys.exit(1)
+
+    graph = get_dependency_graph(list(dict.fromkeys(services)), all_services)
+    run_services(
+        graph,
+        lambda service: restart_service(
+            service,
+            dev_mode=service in args.dev,
+            hold_mode=args.hold,
+            ignore_override=args.ignore_override,
+            verbose=args.verbose,
+            prefix_output=jobs > 1,
+            wait=not args.no_wait,
+            backend=backend,
+        ),
+        jobs,
+    )
+
+
+def cmd_stop(args):
+    """Handle stop command."""
+    base_services, beamline_services = get_all_services()
+    all_services = base_services + beamline_services
+    verbose = args.verbose
+    jobs = args.jobs if args.jobs is not None else get_default_jobs()
+    services = args.services or all_services
+
+    for service in services:
+        if service not in all_services:
+            print(f"Error: Unknown service '{service}'", file=sys.stderr)
+            print_available_services()
+            sys.exit(1)
+
+    backend = args.backend or get_default_backend()
+    if args.stack:
+        if backend == "api":
+            print("Error: --stack is not supported by the api backend", file=sys.stderr)
+            sys.exit(1)
+        if is_shared_mode():
+            print("Error: --stack is not supported in multi-beamline mode", file=sys.stderr)
+            sys.exit(1)
+        stop_stack(services, all_services, verbose, args.keep_state)
+        return
+
+    # Stop dependents before the services they depend on
+    graph = reverse_graph(get_dependency_graph(services, all_services))
+    run_services(
+        graph,
+        lambda service: stop_service(
+            service,
+            verbose,
+            check=False,
+            prefix_output=jobs > 1,
+            backend=backend,
+            keep_state=args.keep_state,
+        ),
+        jobs,
+    )
+
+
+def change_services_state(args, action, services):
+    """
+    Pause or resume services in dependency order.
+
+    Parameters
+    ----------
+    args : argparse.Namespace
+        Parsed pause/resume arguments
+    action : str
+        'pause' or 'resume'
+    services : list[str]
+        Services to pause or resume
+    """
+    base_services, beamline_services = get_all_services()
+    all_services = base_services + beamline_services
+    jobs = args.jobs if args.jobs is not None else get_default_jobs()
+    backend = args.backend or get_default_backend()
+    if not services:
+        print(f"No services to {action}")
+        return
+    for service in services:
+        if service not in all_services:
+            print(f"Error: Unknown service '{service}'", file=sys.stderr)
+            print_available_services()
+            sys.exit(1)
+
+    graph = get_dependency_graph(services, all_services)
+    if action == "pause":
+        # Freeze dependents before the services they depend on
+        graph = reverse_graph(graph)
+    run_services(
+        graph,
+        lambda service: change_service_state(
+            service,
+            action,
+            verbose=args.verbose,
+            prefix_output=jobs > 1,
+            backend=backend,
+            wait=not args.no_wait,
+        ),
+        jobs,
+    )
+
+
+def cmd_pause(args):
+    """Handle pause command."""
+    change_services_state(args, "pause", args.services or get_services_with_status([RUNNING]))
+
+
+def cmd_resume(args):
+    """Handle resume command."""
+    change_services_state(
+        args, "resume", args.services or get_services_with_status([PAUSED, STOPPED])
+    )
+
+
+def cmd_demo(args):
+    """Handle demo command."""
+    demo_services = ["bluesky-services", "gui", "queueserver", "sim", "viewer"]
+    base_services, beamline_services = get_all_services()
+    graph = get_dependency_graph(demo_services, base_services + beamline_services)
+    jobs = args.jobs if args.jobs is not None else get_default_jobs()
+    backend = args.backend or get_default_backend()
+    run_services(
+        graph,
+        lambda service: start_service(
+            service,
+            check=False,
+            prefix_output=jobs > 1,
+            wait=not args.no_wait,
+            backend=backend,
+        ),
+        jobs,
+    )
+
+
+def cmd_build(args):
+    """Handle build command."""
+    from nbs_pods.build import (
+        discover_images,
+        get_build_command,
+        get_build_context,
+        get_build_graph,
+        get_image_reference,
+        image_exists,
+        parse_build_args,
+        plan_builds,
+        run_build_command,
+    )
 
+    images = {}
     try:
-        compose_file_string = build_compose_file_string(service, verbose, gui_services, override_keys)
-    except RuntimeError as e:
+        context = get_build_context(args.context)
+        build_args = parse_build_args(args.build_arg)
+        images = discover_images(context, shared_envs=args.shared_envs)
+        graph = get_build_graph(images, args.images)
+    except (RuntimeError, ValueError) as e:
         print(f"Error: {e}", file=sys.stderr)
+        if args.images and images:
+            print(f"Available images: {', '.join(images)}", file=sys.stderr)
         sys.exit(1)
 
-    compose_files = compose_file_string.split(":")
-    print("  Using compose files:")
-    labels = ["(base)"]
-    for compose_file in compose_files[1:]:
-        compose_name = os.path.basename(compose_file)
-        label = ""
-        for key in override_keys:
-            if compose_name == f"docker-compose.{key}.yml":
-                label = f"({key})"
-                break
-        labels.append(label)
-
-    for i, compose_file in enumerate(compose_files):
-        label = labels[i] if i < len(labels) else ""
-        print(f"    - {compose_file} {label}", flush=True)
+    hashes, hash_errors = plan_builds(images, graph, context, build_args)
+    if not args.images:
+        # Building everything should not fail on an image nobody asked for
+        for name, error in hash_errors.items():
+            print(f"Warning: skipping {name}: {error}", file=sys.stderr)
+            del graph[name]
+    jobs = args.jobs if args.jobs is not None else get_default_jobs()
+    registry = args.registry
 
-    env = setup_environment()
-    env["COMPOSE_FILE"] = compose_file_string
+    def build(name):
+        if name in hash_errors:
+            raise RuntimeError(f"{name}: {hash_errors[name]}")
+        reference = get_image_reference(name, hashes[name], registry)
+        if not args.force and image_exists(reference):
+            print(f"{name} is up to date ({reference})", flush=True)
+            command = ["podman", "tag", reference, get_image_reference(name, "latest", registry)]
+            if args.dry_run:
+                return subprocess.CompletedProcess(command, 0)
+            return subprocess.run(command)
+        base = images[name]["base"]
+        command = get_build_command(
+            name,
+            images[name],
+            context,
+            hashes[name],
+            registry=registry,
+            base_hash=hashes.get(base),
+            build_args=build_args,
+            no_cache=args.no_cache,
+        )
+        print(f"Building {name} ({reference})", flush=True)
+        if args.dry_run:
+            print(" ".join(command), flush=True)
+            return subprocess.CompletedProcess(command, 0)
+        returncode = run_build_command(command, prefix=name if jobs > 1 else None)
+        return subprocess.CompletedProcess(command, returncode)
 
-    command = ["podman-compose", "up"]
-    if not test_mode:
-        command.append("-d")
-    else:
-        command.append("--abort-on-container-exit")
-        command.extend(["--exit-code-from", service])
-    result = subprocess.run(command, env=env)
+    run_services(graph, build, jobs)
 
-    if result.returncode != 0:
-        sys.exit(result.returncode)
-    return result
 
+def cmd_pull(args):
+    """Handle pull command."""
+    import threading
+    import time
 
-def stop_service(service, verbose=False):
-    """
-    Stop a service using podman-compose.
+    from nbs_pods.podman import get_image_digests
+    from nbs_pods.pull import check_image, collect_images, get_pull_command
 
-    Parameters
-    ----------
-    service : str
-        Service name
-    """
-    print(f"Stopping {service}...", flush=True)
+    base_services, beamline_services = get_all_services()
+    all_services = base_services + beamline_services
+    services = list(dict.fromkeys(args.services + args.dev)) or all_services
+    for service in services:
+        if service not in all_services:
+            print(f"Error: Unknown service '{service}'", file=sys.stderr)
+            print_available_services()
+            sys.exit(1)
 
+    env = setup_environment()
+    chains = {}
     try:
-        compose_file_string = build_compose_file_string(
-            service, verbose=verbose, gui_services=gui_services
-        )
+        for service in services:
+            override_keys = get_override_keys(
+                dev_mode=service in args.dev,
+                hold_mode=args.hold,
+                ignore_override=args.ignore_override,
+            )
+            chains[service] = build_compose_file_string(
+                service, args.verbose, get_gui_services(), override_keys
+            )
+        images = collect_images(chains, env)
     except RuntimeError as e:
         print(f"Error: {e}", file=sys.stderr)
         sys.exit(1)
 
-    compose_files = compose_file_string.split(":")
-    if len(compose_files) > 1:
-        compose_file_string = ":".join(compose_files[:2])
-    else:
-        compose_file_string = compose_files[0]
+    jobs = args.jobs if args.jobs is not None else get_default_jobs()
+    print(f"Checking {len(images)} images used by {len(services)} services", flush=True)
+    progress = {"done": 0}
+    progress_lock = threading.Lock()
 
-    env = setup_environment()
-    env["COMPOSE_FILE"] = compose_file_string
+    def report(reference, message):
+        with progress_lock:
+            progress["done"] += 1
+            print(f"[{progress['done']}/{len(images)}] {reference}: {message}", flush=True)
 
-    result = subprocess.run(
-        ["podman-compose", "down", "-v"],
-        env=env,
+    def pull(reference):
+        pull_needed, reason = check_image(reference, get_image_digests(reference))
+        if not pull_needed:
+            report(reference, reason)
+            return None
+        if args.verbose:
+            print(f"Pulling {reference} ({reason}) for {', '.join(images[reference])}", flush=True)
+        start = time.monotonic()
+        command = get_pull_command(reference)
+        if args.verbose:
+            result = run_compose_command(
+                command, os.environ, prefix=reference if jobs > 1 else None
+            )
+            detail = f"code {result.returncode}"
+        else:
+            result = subprocess.run(command, capture_output=True, text=True)
+            detail = (result.stderr.strip().splitlines() or [f"code {result.returncode}"])[-1]
+        if result.returncode != 0:
+            raise RuntimeError(f"Pulling {reference} failed: {detail}")
+        report(reference, f"pulled in {time.monotonic() - start:.1f}s")
+        return result
+
+    _, errors, _ = run_in_dependency_order(
+        {reference: set() for reference in images}, pull, max_workers=jobs
     )
+    for error in errors.values():
+        print(f"Error: {error}", file=sys.stderr)
+    if errors:
+        sys.exit(1)
 
-    if result.returncode != 0:
-        sys.exit(result.returncode)
-    return result
 
+def cmd_status(args):
+    """Handle status and top commands."""
+    import json
+    import time
+
+    from nbs_pods.monitor import format_summary, get_service_projects, sample_containers, summarize
 
-def cmd_start(args):
-    """Handle start command."""
     base_services, beamline_services = get_all_services()
-    all_services = base_services + beamline_services
+    projects = get_service_projects(base_services + beamline_services)
+    clear_screen = args.command == "top" and sys.stdout.isatty()
+    summary = None
+    sample_time = None
+    samples = 0
+    try:
+        while args.count is None or samples < args.count:
+            if samples:
+                time.sleep(args.interval)
+            try:
+                stats = sample_containers()
+            except RuntimeError as e:
+                print(f"Error: {e}", file=sys.stderr)
+                sys.exit(1)
+            now = time.monotonic()
+            interval = now - sample_time if sample_time is not None else None
+            summary = summarize(stats, projects, summary, interval)
+            sample_time = now
+            samples += 1
 
-    if not args.services and not args.dev and not args.test:
-        for service in all_services:
-            start_service(service, dev_mode=False)
-        return
+            table = format_summary(summary, show_containers=args.containers)
+            if clear_screen:
+                print("\033[H\033[J", end="")
+            print(table, flush=True)
+            if args.command == "top" and not clear_screen:
+                print(flush=True)
+            if args.json:
+                with open(args.json, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(summary) + "\n")
+    except KeyboardInterrupt:
+        pass
 
-    dev_services = args.dev
-    test_services = args.test
-    verbose = args.verbose
-    hold_mode = args.hold
-    ignore_override = args.ignore_override
-    for item in args.services:
-        if item not in all_services:
-            print(f"Error: Unknown service '{item}'", file=sys.stderr)
-            print_available_services()
-            sys.exit(1)
 
-        start_service(item, verbose=verbose, ignore_override=ignore_override, hold_mode=hold_mode)
-    for item in dev_services:
-        if item not in all_services:
-            print(f"Error: Unknown service '{item}'", file=sys.stderr)
-            print_available_services()
-            sys.exit(1)
-        start_service(item, dev_mode=True, verbose=verbose, ignore_override=ignore_override, hold_mode=hold_mode)
-    for item in test_services:
-        if item not in all_services:
-            print(f"Error: Unknown service '{item}'", file=sys.stderr)
-            print_available_services()
-            sys.exit(1)
-        start_service(item, test_mode=True, verbose=verbose, ignore_override=ignore_override, hold_mode=hold_mode)
+def cmd_bench(args):
+    """Handle bench command."""
+    import json
 
+    from nbs_pods.bench import format_report, run_bench
 
-def cmd_restart(args):
-    stop_args = copy(args)
-    stop_args.services += getattr(args, "dev", [])
-    stop_args.services += getattr(args, "test", [])
-    print(f"Restarting {stop_args.services}")
+    bench_args = [
+        "--runs", str(args.runs),
+        "--events", str(args.events),
+        "--rate", str(args.rate),
+        "--fields", str(args.fields),
+        "--shape", args.shape,
+        "--page-size", str(args.page_size),
+        "--timeout", str(args.timeout),
+    ]
+    if args.paths:
+        bench_args += ["--paths"] + args.paths
+    if args.label:
+        bench_args += ["--label", args.label]
+    if args.keep:
+        bench_args.append("--keep")
+    try:
+        report = run_bench(bench_args)
+    except RuntimeError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+    print(format_report(report), flush=True)
+    if args.json:
+        with open(args.json, "a", encoding="utf-8") as f:
+            f.write(json.dumps(report) + "\n")
 
-    cmd_stop(stop_args)
-    cmd_start(args)
 
+def cmd_metrics(args):
+    """Handle metrics command."""
+    import time
+
+    from nbs_pods.metrics import (
+        fetch_metrics,
+        format_metrics,
+        get_metrics_url,
+        get_scrape_time,
+        parse_metrics,
+        summarize,
+    )
+
+    url = args.url or get_metrics_url()
+    clear_screen = args.count != 1 and sys.stdout.isatty()
+    previous = None
+    latest = None
+    samples = 0
+    try:
+        while args.count is None or samples < args.count:
+            if samples:
+                time.sleep(args.interval)
+            try:
+                text = fetch_metrics(url)
+            except RuntimeError as e:
+                print(f"Error: {e}", file=sys.stderr)
+                sys.exit(1)
+            samples += 1
+            if args.raw:
+                print(text, end="", flush=True)
+                continue
+            metrics = parse_metrics(text)
+            if latest is not None and get_scrape_time(metrics) != get_scrape_time(latest):
+                # Rates are taken between two scrapes of the exporter
+                previous = latest
+            latest = metrics
+            summary = summarize(metrics, previous)
+            if clear_screen:
+                print("\033[H\033[J", end="")
+            print(format_metrics(summary), flush=True)
+            if args.count != 1 and not clear_screen:
+                print(flush=True)
+    except KeyboardInterrupt:
+        pass
+
+
+def cmd_logs(args):
+    """Handle logs command."""
+    from nbs_pods.logs import show_logs
 
-def cmd_stop(args):
-    """Handle stop command."""
     base_services, beamline_services = get_all_services()
     all_services = base_services + beamline_services
-    verbose = args.verbose
-    if not args.services:
-        for service in reversed(all_services):
-            stop_service(service, verbose)
-        return
-
     for service in args.services:
         if service not in all_services:
             print(f"Error: Unknown service '{service}'", file=sys.stderr)
             print_available_services()
             sys.exit(1)
+    try:
+        show_logs(
+            args.services or all_services,
+            follow=args.follow,
+            tail=args.tail,
+            pattern=args.grep,
+            level=args.level,
+            since=args.since,
+            until=args.until,
+            color=False if args.no_color else None,
+        )
+    except RuntimeError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
 
-        stop_service(service, verbose)
 
+def cmd_test(args):
+    """Handle test command."""
+    from nbs_pods.testrun import PASSED, format_report, get_test_services, run_tests, write_json_report, write_junit
 
-def cmd_demo(args):
-    """Handle demo command."""
-    demo_services = ["bluesky-services", "gui", "queueserver", "sim", "viewer"]
-    for service in demo_services:
-        start_service(service, dev_mode=False)
+    base_services, beamline_services = get_all_services()
+    all_services = base_services + beamline_services
+    for service in args.services:
+        if service not in all_services:
+            print(f"Error: Unknown service '{service}'", file=sys.stderr)
+            print_available_services()
+            sys.exit(1)
+    services = list(dict.fromkeys(args.services)) or get_test_services(all_services)
+    missing = [service for service in services if service not in get_test_services(services)]
+    if missing:
+        print(f"Error: No docker-compose.test.yml for {', '.join(missing)}", file=sys.stderr)
+        sys.exit(1)
+    if not services:
+        print("Error: No service has a docker-compose.test.yml", file=sys.stderr)
+        sys.exit(1)
+    if args.timeout is not None and args.timeout <= 0:
+        print("Error: --timeout must be positive", file=sys.stderr)
+        sys.exit(1)
+
+    jobs = args.jobs if args.jobs is not None else get_default_jobs()
+    report = run_tests(
+        services,
+        all_services,
+        setup_environment(),
+        get_override_keys(test_mode=True, ignore_override=args.ignore_override),
+        get_gui_services(),
+        jobs,
+        timeout=args.timeout,
+        keep=args.keep,
+    )
+    print(flush=True)
+    print(format_report(report), flush=True)
+    if args.junit:
+        write_junit(report, args.junit)
+    if args.json:
+        write_json_report(report, args.json)
+    if any(test["status"] != PASSED for test in report["tests"]):
+        sys.exit(1)
 
 
 def cmd_list(args):
@@ -214,8 +1541,15 @@ def print_available_services():
             print(f"  - {service}")
 
 
-def main():
-    """Main entry point."""
+def main(argv=None):
+    """
+    Main entry point.
+
+    Parameters
+    ----------
+    argv : list[str], optional
+        Command line arguments, defaults to ``sys.argv[1:]``
+    """
     parser = argparse.ArgumentParser(
         description=("NBS Pods - Containerized NBS services management"),
         formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -238,6 +1572,60 @@ def main():
     start_parser.add_argument(
         "-v", "--verbose", action="store_true", help="Verbose output"
     )
+    start_parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=None,
+        help="Maximum number of services to start concurrently "
+        "(default: $NBS_PODS_JOBS or 4)",
+    )
+    start_parser.add_argument(
+        "--no-wait",
+        action="store_true",
+        help="Do not wait for readiness probes before starting dependent services",
+    )
+    start_parser.add_argument(
+        "--stack",
+        action="store_true",
+        help="Merge all services into a single compose project and start it with one podman-compose call",
+    )
+    start_parser.add_argument(
+        "--backend",
+        choices=["compose", "api"],
+        default=None,
+        help="Run podman-compose, or talk to the podman service socket directly "
+        "(default: $NBS_PODS_BACKEND or compose)",
+    )
+    start_parser.add_argument(
+        "--trace",
+        metavar="FILE",
+        help="Record a timeline of the bring-up as Chrome trace JSON and print a summary",
+    )
+    start_parser.add_argument(
+        "--profile",
+        default=None,
+        help="Resource profile preset to apply, or 'none' "
+        "(default: $NBS_PODS_PROFILE or the profile set in resources.yml)",
+    )
+    start_parser.add_argument(
+        "--kafka-profile",
+        default=None,
+        help="Kafka producer/broker profile preset to apply, or 'none' "
+        "(default: $NBS_PODS_KAFKA_PROFILE or the profile set in kafka-profiles.yml)",
+    )
+    start_parser.add_argument(
+        "--mongo-profile",
+        default=None,
+        help="Mongo cache/storage profile preset to apply, or 'none' "
+        "(default: $NBS_PODS_MONGO_PROFILE or the profile set in mongo-profiles.yml)",
+    )
+    start_parser.add_argument(
+        "--shared",
+        action="store_true",
+        help="Share one bluesky-services stack with other beamlines on this host "
+        "(default: $NBS_PODS_SHARED)",
+    )
     start_parser.set_defaults(func=cmd_start)
 
     restart_parser = subparsers.add_parser("restart", help="Restart services")
@@ -249,10 +1637,66 @@ def main():
     restart_parser.add_argument(
         "--dev", nargs="*", help="Restart services in development mode", default=[]
     )
+    restart_parser.add_argument("--hold", action="store_true", help="Do not run any command, but hold all services after starting")
+    restart_parser.add_argument("--ignore-override", action="store_true", help="Ignore override files")
+    restart_parser.add_argument(
+        "--full",
+        action="store_true",
+        help="Stop and start services (removing their volumes) instead of "
+        "recreating only containers whose configuration changed",
+    )
     restart_parser.add_argument(
         "-v", "--verbose", action="store_true", help="Verbose output"
     )
-    restart_parser.set_defaults(func=cmd_restart)
+    restart_parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=None,
+        help="Maximum number of services to restart concurrently "
+        "(default: $NBS_PODS_JOBS or 4)",
+    )
+    restart_parser.add_argument(
+        "--no-wait",
+        action="store_true",
+        help="Do not wait for readiness probes before starting dependent services",
+    )
+    restart_parser.add_argument(
+        "--backend",
+        choices=["compose", "api"],
+        default=None,
+        help="Run podman-compose, or talk to the podman service socket directly "
+        "(default: $NBS_PODS_BACKEND or compose)",
+    )
+    restart_parser.add_argument(
+        "--trace",
+        metavar="FILE",
+        help="Record a timeline of the bring-up as Chrome trace JSON and print a summary",
+    )
+    restart_parser.add_argument(
+        "--profile",
+        default=None,
+        help="Resource profile preset to apply, or 'none' "
+        "(default: $NBS_PODS_PROFILE or the profile set in resources.yml)",
+    )
+    restart_parser.add_argument(
+        "--kafka-profile",
+        default=None,
+        help="Kafka producer/broker profile preset to apply, or 'none' "
+        "(default: $NBS_PODS_KAFKA_PROFILE or the profile set in kafka-profiles.yml)",
+    )
+    restart_parser.add_argument(
+        "--mongo-profile",
+        default=None,
+        help="Mongo cache/storage profile preset to apply, or 'none' "
+        "(default: $NBS_PODS_MONGO_PROFILE or the profile set in mongo-profiles.yml)",
+    )
+    restart_parser.add_argument(
+        "--shared",
+        action="store_true",
+        help="Restart in multi-beamline mode (default: $NBS_PODS_SHARED)",
+    )
+    restart_parser.set_defaults(func=cmd_restart, test=[], stack=False, keep_state=False)
 
     stop_parser = subparsers.add_parser("stop", help="Stop services")
     stop_parser.add_argument(
@@ -263,21 +1707,427 @@ def main():
     stop_parser.add_argument(
         "-v", "--verbose", action="store_true", help="Verbose output"
     )
+    stop_parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=None,
+        help="Maximum number of services to stop concurrently "
+        "(default: $NBS_PODS_JOBS or 4)",
+    )
+    stop_parser.add_argument(
+        "--stack",
+        action="store_true",
+        help="Stop services that were started with --stack",
+    )
+    stop_parser.add_argument(
+        "--keep-state",
+        action="store_true",
+        help="Stop containers without removing them or their volumes, "
+        "so the services can be resumed",
+    )
+    stop_parser.add_argument(
+        "--backend",
+        choices=["compose", "api"],
+        default=None,
+        help="Run podman-compose, or talk to the podman service socket directly "
+        "(default: $NBS_PODS_BACKEND or compose)",
+    )
+    stop_parser.add_argument(
+        "--shared",
+        action="store_true",
+        help="Stop in multi-beamline mode; the shared bluesky-services stack is "
+        "only stopped when no other beamline uses it (default: $NBS_PODS_SHARED)",
+    )
     stop_parser.set_defaults(func=cmd_stop)
 
+    pause_parser = subparsers.add_parser("pause", help="Pause (freeze) running services")
+    pause_parser.add_argument(
+        "services",
+        nargs="*",
+        help="Services to pause (default: all running services)",
+    )
+    pause_parser.add_argument(
+        "-v", "--verbose", action="store_true", help="Verbose output"
+    )
+    pause_parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=None,
+        help="Maximum number of services to pause concurrently "
+        "(default: $NBS_PODS_JOBS or 4)",
+    )
+    pause_parser.add_argument(
+        "--backend",
+        choices=["compose", "api"],
+        default=None,
+        help="Run podman-compose, or talk to the podman service socket directly "
+        "(default: $NBS_PODS_BACKEND or compose)",
+    )
+    pause_parser.set_defaults(func=cmd_pause, no_wait=True)
+
+    resume_parser = subparsers.add_parser(
+        "resume", help="Resume paused services, or services stopped with --keep-state"
+    )
+    resume_parser.add_argument(
+        "services",
+        nargs="*",
+        help="Services to resume (default: all paused or stopped services)",
+    )
+    resume_parser.add_argument(
+        "-v", "--verbose", action="store_true", help="Verbose output"
+    )
+    resume_parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=None,
+        help="Maximum number of services to resume concurrently "
+        "(default: $NBS_PODS_JOBS or 4)",
+    )
+    resume_parser.add_argument(
+        "--no-wait",
+        action="store_true",
+        help="Do not wait for readiness probes before resuming dependent services",
+    )
+    resume_parser.add_argument(
+        "--backend",
+        choices=["compose", "api"],
+        default=None,
+        help="Run podman-compose, or talk to the podman service socket directly "
+        "(default: $NBS_PODS_BACKEND or compose)",
+    )
+    resume_parser.add_argument(
+        "--trace",
+        metavar="FILE",
+        help="Record a timeline of the bring-up as Chrome trace JSON and print a summary",
+    )
+    resume_parser.set_defaults(func=cmd_resume)
+
     demo_parser = subparsers.add_parser("demo", help="Start demo services")
+    demo_parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=None,
+        help="Maximum number of services to start concurrently "
+        "(default: $NBS_PODS_JOBS or 4)",
+    )
+    demo_parser.add_argument(
+        "--no-wait",
+        action="store_true",
+        help="Do not wait for readiness probes before starting dependent services",
+    )
+    demo_parser.add_argument(
+        "--backend",
+        choices=["compose", "api"],
+        default=None,
+        help="Run podman-compose, or talk to the podman service socket directly "
+        "(default: $NBS_PODS_BACKEND or compose)",
+    )
+    demo_parser.add_argument(
+        "--trace",
+        metavar="FILE",
+        help="Record a timeline of the bring-up as Chrome trace JSON and print a summary",
+    )
+    demo_parser.add_argument(
+        "--profile",
+        default=None,
+        help="Resource profile preset to apply, or 'none' "
+        "(default: $NBS_PODS_PROFILE or the profile set in resources.yml)",
+    )
+    demo_parser.add_argument(
+        "--kafka-profile",
+        default=None,
+        help="Kafka producer/broker profile preset to apply, or 'none' "
+        "(default: $NBS_PODS_KAFKA_PROFILE or the profile set in kafka-profiles.yml)",
+    )
+    demo_parser.add_argument(
+        "--mongo-profile",
+        default=None,
+        help="Mongo cache/storage profile preset to apply, or 'none' "
+        "(default: $NBS_PODS_MONGO_PROFILE or the profile set in mongo-profiles.yml)",
+    )
+    demo_parser.add_argument(
+        "--shared",
+        action="store_true",
+        help="Share one bluesky-services stack with other beamlines on this host "
+        "(default: $NBS_PODS_SHARED)",
+    )
     demo_parser.set_defaults(func=cmd_demo)
 
+    build_parser = subparsers.add_parser(
+        "build", help="Build container images, skipping those that are up to date"
+    )
+    build_parser.add_argument(
+        "images",
+        nargs="*",
+        help="Images to build, with the images they are built on (default: all)",
+    )
+    build_parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=None,
+        help="Maximum number of images to build concurrently "
+        "(default: $NBS_PODS_JOBS or 4)",
+    )
+    build_parser.add_argument(
+        "--registry",
+        default="localhost/",
+        help="Prefix of the image names, matching NBS_IMAGE_REG (default: localhost/)",
+    )
+    build_parser.add_argument(
+        "--build-arg",
+        action="append",
+        metavar="NAME=VALUE",
+        help="Build argument, e.g. CAPROTO_REF=<commit>; part of the image hash",
+    )
+    build_parser.add_argument(
+        "--context",
+        default=None,
+        help="Directory containing images/ (default: the nbs-pods source checkout)",
+    )
+    build_parser.add_argument(
+        "--shared-envs",
+        action="store_true",
+        help="Build the service images on one image holding all pixi environments, "
+        "so that their common packages are stored once",
+    )
+    build_parser.add_argument(
+        "--force", action="store_true", help="Build images even if they are up to date"
+    )
+    build_parser.add_argument(
+        "--no-cache", action="store_true", help="Do not use cached layers when building"
+    )
+    build_parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Print what would be built without building",
+    )
+    build_parser.set_defaults(func=cmd_build)
+
+    pull_parser = subparsers.add_parser(
+        "pull", help="Pull the images of services that are missing or outdated"
+    )
+    pull_parser.add_argument(
+        "services", nargs="*", help="Services whose images to pull (default: all)"
+    )
+    pull_parser.add_argument(
+        "--dev", nargs="*", help="Services to pull development mode images for", default=[]
+    )
+    pull_parser.add_argument("--hold", action="store_true", help="Resolve compose files with hold mode")
+    pull_parser.add_argument("--ignore-override", action="store_true", help="Ignore override files")
+    pull_parser.add_argument(
+        "-v", "--verbose", action="store_true", help="Verbose output, including podman pull output"
+    )
+    pull_parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=None,
+        help="Maximum number of images to pull concurrently "
+        "(default: $NBS_PODS_JOBS or 4)",
+    )
+    pull_parser.set_defaults(func=cmd_pull)
+
+    status_parser = subparsers.add_parser(
+        "status", help="Show running services and their resource usage"
+    )
+    top_parser = subparsers.add_parser(
+        "top", help="Show the resource usage of running services, refreshed periodically"
+    )
+    for monitor_parser in (status_parser, top_parser):
+        monitor_parser.add_argument(
+            "--containers", action="store_true", help="Show every container below its service"
+        )
+        monitor_parser.add_argument(
+            "--json",
+            metavar="FILE",
+            help="Append each sample to FILE as a line of JSON",
+        )
+    top_parser.add_argument(
+        "-n",
+        "--interval",
+        type=float,
+        default=2.0,
+        help="Seconds between samples (default: 2)",
+    )
+    top_parser.add_argument(
+        "--count", type=int, default=None, help="Stop after this many samples"
+    )
+    status_parser.set_defaults(func=cmd_status, count=1, interval=0)
+    top_parser.set_defaults(func=cmd_status)
+
+    bench_parser = subparsers.add_parser(
+        "bench",
+        help="Benchmark the document pipeline of bluesky-services with synthetic runs",
+    )
+    bench_parser.add_argument("--runs", type=int, default=3, help="Number of runs (default: 3)")
+    bench_parser.add_argument(
+        "--events", type=int, default=1000, help="Events per run (default: 1000)"
+    )
+    bench_parser.add_argument(
+        "--rate",
+        type=float,
+        default=0,
+        help="Events per second to emit, 0 for as fast as possible (default: 0)",
+    )
+    bench_parser.add_argument(
+        "--fields", type=int, default=4, help="Data fields per event (default: 4)"
+    )
+    bench_parser.add_argument(
+        "--shape",
+        default="scalar",
+        help="Shape of every field, e.g. 1024 or 512x512 (default: scalar)",
+    )
+    bench_parser.add_argument(
+        "--page-size",
+        type=int,
+        default=1,
+        help="Events per EventPage, 1 to emit Event documents (default: 1)",
+    )
+    bench_parser.add_argument(
+        "--paths",
+        nargs="+",
+        choices=["zmq_proxy", "zmq_proxy2", "kafka", "storage", "tiled"],
+        help="Paths to time (default: all that are running)",
+    )
+    bench_parser.add_argument(
+        "--timeout",
+        type=float,
+        default=60,
+        help="Seconds to wait for documents to arrive (default: 60)",
+    )
+    bench_parser.add_argument("--label", help="Label recorded in the report")
+    bench_parser.add_argument(
+        "--keep", action="store_true", help="Keep the benchmark runs in Mongo"
+    )
+    bench_parser.add_argument(
+        "--json", metavar="FILE", help="Append the report to FILE as a line of JSON"
+    )
+    bench_parser.set_defaults(func=cmd_bench)
+
+    metrics_parser = subparsers.add_parser(
+        "metrics",
+        help="Show document rates, Kafka lag, the queue and database load from the metrics service",
+    )
+    metrics_parser.add_argument(
+        "-n",
+        "--interval",
+        type=float,
+        default=5.0,
+        help="Seconds between samples (default: 5)",
+    )
+    metrics_parser.add_argument(
+        "--count", type=int, default=None, help="Stop after this many samples"
+    )
+    metrics_parser.add_argument(
+        "--url",
+        help="Metrics endpoint (default: $NBS_PODS_METRICS_URL or http://localhost:9464/metrics)",
+    )
+    metrics_parser.add_argument(
+        "--raw", action="store_true", help="Print the metrics in the Prometheus text format"
+    )
+    metrics_parser.set_defaults(func=cmd_metrics)
+
+    logs_parser = subparsers.add_parser(
+        "logs", help="Show the logs of all containers of services, merged and prefixed"
+    )
+    logs_parser.add_argument(
+        "services", nargs="*", help="Services whose logs to show (default: all)"
+    )
+    logs_parser.add_argument(
+        "-f", "--follow", action="store_true", help="Keep printing new lines until interrupted"
+    )
+    logs_parser.add_argument(
+        "--tail", type=int, default=None, help="Show only the last N lines of every service"
+    )
+    logs_parser.add_argument("--grep", metavar="REGEX", help="Show only lines matching REGEX")
+    logs_parser.add_argument(
+        "--level",
+        choices=LOG_LEVELS,
+        help="Show only lines of this level or above; lines without a level "
+        "belong to the line before them",
+    )
+    logs_parser.add_argument(
+        "--since", help="Show lines after this time, e.g. 10m, 2h or 2024-05-01T14:00"
+    )
+    logs_parser.add_argument(
+        "--until", help="Show lines before this time, e.g. 5m or 2024-05-01T15:00"
+    )
+    logs_parser.add_argument(
+        "--no-color", action="store_true", help="Do not color the container prefixes"
+    )
+    logs_parser.set_defaults(func=cmd_logs)
+
+    test_parser = subparsers.add_parser(
+        "test",
+        help="Run the test variants of services concurrently, each in an isolated project",
+    )
+    test_parser.add_argument(
+        "services",
+        nargs="*",
+        help="Services to test (default: all with a docker-compose.test.yml)",
+    )
+    test_parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=None,
+        help="Maximum number of tests to run concurrently (default: $NBS_PODS_JOBS or 4)",
+    )
+    test_parser.add_argument(
+        "--timeout",
+        type=float,
+        default=None,
+        help="Seconds after which a test is stopped and counts as failed",
+    )
+    test_parser.add_argument("--junit", metavar="FILE", help="Write the report to FILE as JUnit XML")
+    test_parser.add_argument("--json", metavar="FILE", help="Write the report to FILE as JSON")
+    test_parser.add_argument(
+        "--keep",
+        action="store_true",
+        help="Keep the tests' containers, networks and compose files for inspection",
+    )
+    test_parser.add_argument("--ignore-override", action="store_true", help="Ignore override files")
+    test_parser.set_defaults(func=cmd_test)
+
     list_parser = subparsers.add_parser("list", help="List available services")
     list_parser.set_defaults(func=cmd_list)
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     if not args.command:
         parser.print_help()
         sys.exit(1)
 
-    args.func(args)
+    if getattr(args, "profile", None):
+        os.environ[PROFILE_ENV] = args.profile
+    if getattr(args, "kafka_profile", None):
+        os.environ[KAFKA_PROFILE_ENV] = args.kafka_profile
+    if getattr(args, "mongo_profile", None):
+        os.environ[MONGO_PROFILE_ENV] = args.mongo_profile
+    if getattr(args, "shared", False):
+        os.environ[SHARED_ENV] = "1"
+
+    trace_file = getattr(args, "trace", None)
+    if not trace_file:
+        args.func(args)
+        return
+
+    from nbs_pods import trace
+
+    trace.enable_tracing()
+    try:
+        with span(f"nbs-pods {args.command}", "cli"):
+            args.func(args)
+    finally:
+        trace.add_podman_events()
+        trace.write_trace(trace_file)
+        trace.print_summary()
+        print(f"\nTrace written to {trace_file}")
 
 
 if __name__ == "__main__":
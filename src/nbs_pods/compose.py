@@ -1,9 +1,22 @@
 """Docker compose file resolution and chaining."""
 
+import os
+import re
 from pathlib import Path
 
-from nbs_pods.config import get_beamline_pods_dir, get_nbs_pods_dir
 from nbs_pods.display import detect_display_protocol
+from nbs_pods.index import get_base_file_name, resolve_compose_file
+from nbs_pods.kafka import KAFKA_KEY, write_kafka_override
+from nbs_pods.mongo import MONGO_KEY, write_mongo_override
+from nbs_pods.resources import RESOURCES_KEY, write_resource_override
+from nbs_pods.shared import (
+    SHARED_KEY,
+    SHARED_SERVICE,
+    get_beamline_namespace,
+    is_shared_mode,
+    write_shared_override,
+)
+from nbs_pods.trace import span
 
 
 def get_compose_file(service, verbose=False, gui_services=["gui", "viewer"]):
@@ -20,50 +33,19 @@ def get_compose_file(service, verbose=False, gui_services=["gui", "viewer"]):
     Path | None
         Path to compose file, or None if not found
     """
-    beamline_pods_dir = get_beamline_pods_dir()
-    nbs_pods_dir = get_nbs_pods_dir()
-
-    compose_file = None
-
+    display_protocol = None
     if service in gui_services:
-        display_protocol = detect_display_protocol()
+        with span("detect display protocol", "display", service):
+            display_protocol = detect_display_protocol()
         print(f"Detected display protocol: {display_protocol}", flush=True)
 
-        beamline_file = (
-            beamline_pods_dir
-            / "compose"
-            / service
-            / f"docker-compose.{display_protocol}.yml"
-        )
-        if verbose:
-            print(f"Checking beamline file: {beamline_file}", flush=True)
-        if beamline_file.exists():
-            compose_file = beamline_file
-        else:
-            if verbose:
-                print(f"Beamline file not found, checking nbs file", flush=True)
-            nbs_file = (
-                nbs_pods_dir
-                / "compose"
-                / service
-                / f"docker-compose.{display_protocol}.yml"
-            )
-            if nbs_file.exists():
-                compose_file = nbs_file
-
-    if compose_file is None:
-        beamline_file = beamline_pods_dir / "compose" / service / "docker-compose.yml"
-        if verbose:
-            print(f"Checking beamline file: {beamline_file}", flush=True)
-        if beamline_file.exists():
-            compose_file = beamline_file
-        else:
-            if verbose:
-                print(f"Beamline file not found, checking nbs file", flush=True)
-            nbs_file = nbs_pods_dir / "compose" / service / "docker-compose.yml"
-            if nbs_file.exists():
-                compose_file = nbs_file
+    file_name = get_base_file_name(service, gui_services, display_protocol)
+    if file_name is None:
+        return None
 
+    compose_file = Path(resolve_compose_file(service, file_name))
+    if verbose:
+        print(f"Resolved base file: {compose_file}", flush=True)
     return compose_file
 
 
@@ -81,24 +63,13 @@ def get_compose_override(service, key="override",verbose=False):
     Path | None
         Path to override file, or None if not found
     """
-    beamline_pods_dir = get_beamline_pods_dir()
-    nbs_pods_dir = get_nbs_pods_dir()
+    override_file = resolve_compose_file(service, f"docker-compose.{key}.yml")
+    if override_file is None:
+        return None
 
-    beamline_file = (
-        beamline_pods_dir / "compose" / service / f"docker-compose.{key}.yml"
-    )
     if verbose:
-        print(f"Checking beamline file: {beamline_file}", flush=True)
-    if beamline_file.exists():
-        return beamline_file
-
-    nbs_file = nbs_pods_dir / "compose" / service / f"docker-compose.{key}.yml"
-    if verbose:
-        print(f"Checking nbs file: {nbs_file}", flush=True)
-    if nbs_file.exists():
-        return nbs_file
-
-    return None
+        print(f"Resolved {key} file: {override_file}", flush=True)
+    return Path(override_file)
 
 
 def build_compose_file_string(service, verbose=False, gui_services=["gui", "viewer"], override_keys=["override"]):
@@ -109,8 +80,11 @@ def build_compose_file_string(service, verbose=False, gui_services=["gui", "view
     ----------
     service : str
         Service name
-    dev_mode : bool
-        Whether to include development file
+    override_keys : list[str]
+        Override keys, in the order their files are applied; 'shared'
+        applies the multi-beamline namespacing, 'kafka' the active Kafka
+        profile, 'mongo' the active Mongo profile and 'resources' the
+        active resource profile
 
     Returns
     -------
@@ -120,7 +94,8 @@ def build_compose_file_string(service, verbose=False, gui_services=["gui", "view
     Raises
     ------
     RuntimeError
-        If no compose file found for service
+        If no compose file found for service, or the Kafka, Mongo or
+        resource profile is invalid
     """
     compose_file = get_compose_file(service, verbose, gui_services)
     if compose_file is None:
@@ -129,8 +104,351 @@ def build_compose_file_string(service, verbose=False, gui_services=["gui", "view
     compose_files = [compose_file]
 
     for key in override_keys:
-        override_file = get_compose_override(service, key=key, verbose=verbose)
+        if key == RESOURCES_KEY:
+            # Generated from the active resource profile, not a compose file
+            override_file = write_resource_override(
+                service, ":".join(str(f) for f in compose_files)
+            )
+        elif key == KAFKA_KEY:
+            # Generated from the active Kafka profile, not a compose file
+            override_file = write_kafka_override(
+                service, ":".join(str(f) for f in compose_files)
+            )
+        elif key == MONGO_KEY:
+            # Generated from the active Mongo profile, not a compose file
+            override_file = write_mongo_override(
+                service, ":".join(str(f) for f in compose_files)
+            )
+        elif key == SHARED_KEY:
+            # Generated in multi-beamline mode, not a compose file
+            override_file = write_shared_override(
+                service, ":".join(str(f) for f in compose_files)
+            )
+        else:
+            override_file = get_compose_override(service, key=key, verbose=verbose)
         if override_file:
             compose_files.append(override_file)
 
     return ":".join(str(f) for f in compose_files)
+
+
+def load_compose_file(compose_file):
+    """
+    Load a compose file.
+
+    Parameters
+    ----------
+    compose_file : Path | str
+        Path to compose file
+
+    Returns
+    -------
+    dict
+        Parsed compose document (empty if the file is empty)
+    """
+    import yaml
+
+    with open(compose_file, encoding="utf-8") as f:
+        return yaml.safe_load(f) or {}
+
+
+def get_nbs_pods_extension(compose_doc):
+    """
+    Get the nbs-pods extension section of a compose document.
+
+    nbs-pods specific settings live under the top-level ``x-nbs-pods`` key,
+    which compose tools ignore, e.g.::
+
+        x-nbs-pods:
+          depends_on:
+            - bluesky-services
+
+    Parameters
+    ----------
+    compose_doc : dict
+        Parsed compose document
+
+    Returns
+    -------
+    dict
+        The ``x-nbs-pods`` section, or an empty dict
+    """
+    return compose_doc.get("x-nbs-pods") or {}
+
+
+def get_compose_project(compose_file_string):
+    """
+    Get the compose project name podman-compose uses for a compose chain.
+
+    Parameters
+    ----------
+    compose_file_string : str
+        Colon-separated compose file paths
+
+    Returns
+    -------
+    str
+        COMPOSE_PROJECT_NAME if set, otherwise the normalized name of the
+        directory containing the first compose file; in multi-beamline
+        mode, prefixed with the beamline name for all but bluesky-services
+    """
+    if project := os.getenv("COMPOSE_PROJECT_NAME"):
+        return project
+    first_file = Path(compose_file_string.split(":")[0])
+    project = re.sub(r"[^a-z0-9_-]", "", first_file.parent.name.lower())
+    if project != SHARED_SERVICE and is_shared_mode():
+        return f"{get_beamline_namespace()}-{project}"
+    return project
+
+
+# Service keys whose list entries are merged by key rather than appended
+_KEYED_LIST_FIELDS = {"environment", "labels", "extra_hosts", "sysctls", "ulimits"}
+# Service keys whose list entries are merged by container path
+_MOUNT_FIELDS = {"volumes", "devices"}
+# Service keys whose list entries are appended without duplicates
+_UNIQUE_LIST_FIELDS = {
+    "ports",
+    "expose",
+    "dns",
+    "dns_search",
+    "cap_add",
+    "cap_drop",
+    "external_links",
+    "tmpfs",
+    "security_opt",
+    "env_file",
+}
+
+
+def _as_mapping(value, separator="="):
+    """Normalize a compose list-or-mapping field (e.g. environment) to a dict."""
+    if isinstance(value, dict):
+        return dict(value)
+    mapping = {}
+    for item in value or []:
+        if separator is None:
+            mapping[str(item)] = None
+            continue
+        key, sep, val = str(item).partition(separator)
+        mapping[key] = val if sep else None
+    return mapping
+
+
+def _mount_target(mount):
+    """Get the container path of a short- or long-syntax volume/device entry."""
+    if isinstance(mount, dict):
+        return mount.get("target")
+    parts = str(mount).split(":")
+    return parts[1] if len(parts) > 1 else parts[0]
+
+
+def _merge_service(base, override):
+    """Merge one service definition over another, following compose rules."""
+    merged = dict(base)
+    for key, value in override.items():
+        if key not in merged:
+            merged[key] = value
+        elif key in _KEYED_LIST_FIELDS:
+            merged[key] = {**_as_mapping(merged[key]), **_as_mapping(value)}
+        elif key in _MOUNT_FIELDS:
+            mounts = {_mount_target(m): m for m in merged[key] or []}
+            mounts.update({_mount_target(m): m for m in value or []})
+            merged[key] = list(mounts.values())
+        elif key in _UNIQUE_LIST_FIELDS or key in ("networks", "depends_on"):
+            if isinstance(merged[key], dict) or isinstance(value, dict):
+                merged[key] = {
+                    **_as_mapping(merged[key], separator=None),
+                    **_as_mapping(value, separator=None),
+                }
+            else:
+                existing = list(merged[key] or [])
+                if not isinstance(value, list):
+                    value = [value]
+                merged[key] = existing + [v for v in value if v not in existing]
+        elif isinstance(merged[key], dict) and isinstance(value, dict):
+            merged[key] = _merge_mapping(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+def _merge_mapping(base, override):
+    """Recursively merge two mappings, values from ``override`` winning."""
+    merged = dict(base)
+    for key, value in override.items():
+        if isinstance(merged.get(key), dict) and isinstance(value, dict):
+            merged[key] = _merge_mapping(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+def merge_compose_documents(compose_docs):
+    """
+    Merge a chain of compose documents the way ``COMPOSE_FILE`` chains are.
+
+    Later documents take precedence. Mappings are merged recursively,
+    scalars such as ``image`` and ``command`` are replaced, ``environment``
+    and ``labels`` are merged by key, ``volumes`` and ``devices`` by
+    container path, and lists such as ``ports`` are appended.
+
+    Parameters
+    ----------
+    compose_docs : list[dict]
+        Parsed compose documents, base document first
+
+    Returns
+    -------
+    dict
+        Merged compose document
+    """
+    merged = {}
+    for compose_doc in compose_docs:
+        for key, value in compose_doc.items():
+            if key == "services":
+                services = merged.setdefault("services", {})
+                for name, service in (value or {}).items():
+                    services[name] = _merge_service(services.get(name, {}), service or {})
+            elif isinstance(merged.get(key), dict) and isinstance(value, dict):
+                merged[key] = _merge_mapping(merged[key], value)
+            else:
+                merged[key] = value
+    return merged
+
+
+def resolve_relative_paths(compose_doc, project_dir):
+    """
+    Make relative host paths in a compose document absolute.
+
+    Compose resolves relative paths against the project directory, which
+    is lost once a document is moved into a merged file elsewhere.
+
+    Parameters
+    ----------
+    compose_doc : dict
+        Parsed compose document, modified in place
+    project_dir : Path
+        Directory relative paths are resolved against
+
+    Returns
+    -------
+    dict
+        The same compose document
+    """
+    project_dir = Path(project_dir)
+
+    def resolve(path, bare_relative=False):
+        # Short volume syntax needs a leading "." for relative bind mounts,
+        # env_file and build contexts are relative unless absolute
+        path = str(path)
+        if path.startswith(".") or (
+            bare_relative
+            and not os.path.isabs(path)
+            and not path.startswith(("$", "~"))
+            and "://" not in path
+        ):
+            return str((project_dir / path).resolve())
+        return path
+
+    for service in (compose_doc.get("services") or {}).values():
+        volumes = []
+        for volume in service.get("volumes") or []:
+            if isinstance(volume, dict):
+                if volume.get("type", "volume") == "bind" and "source" in volume:
+                    volume = dict(volume, source=resolve(volume["source"]))
+            else:
+                source, sep, rest = str(volume).partition(":")
+                volume = resolve(source) + sep + rest
+            volumes.append(volume)
+        if volumes:
+            service["volumes"] = volumes
+
+        env_file = service.get("env_file")
+        if isinstance(env_file, str):
+            service["env_file"] = resolve(env_file, bare_relative=True)
+        elif isinstance(env_file, list):
+            service["env_file"] = [resolve(f, bare_relative=True) for f in env_file]
+
+        build = service.get("build")
+        if isinstance(build, str):
+            service["build"] = resolve(build, bare_relative=True)
+        elif isinstance(build, dict) and "context" in build:
+            build["context"] = resolve(build["context"], bare_relative=True)
+    return compose_doc
+
+
+def load_compose_chain(compose_file_string):
+    """
+    Load and merge all compose files of a chain in-process.
+
+    Parameters
+    ----------
+    compose_file_string : str
+        Colon-separated compose file paths, as built by
+        ``build_compose_file_string``
+
+    Returns
+    -------
+    dict
+        Merged compose document with relative paths made absolute
+    """
+    compose_files = compose_file_string.split(":")
+    merged = merge_compose_documents([load_compose_file(f) for f in compose_files])
+    return resolve_relative_paths(merged, Path(compose_files[0]).parent)
+
+
+_INTERPOLATION_PATTERN = re.compile(
+    r"\$(?:(?P<escaped>\$)|\{(?P<braced>[A-Za-z_][A-Za-z0-9_]*)"
+    r"(?:(?P<op>:?[-?])(?P<arg>[^}]*))?\}|(?P<named>[A-Za-z_][A-Za-z0-9_]*))"
+)
+
+
+def interpolate(value, env):
+    """
+    Substitute environment variables in a compose value, as compose does.
+
+    Supports ``$VAR``, ``${VAR}``, ``${VAR:-default}``, ``${VAR-default}``,
+    ``${VAR:?error}``, ``${VAR?error}`` and ``$$`` escapes, recursing into
+    lists and mappings.
+
+    Parameters
+    ----------
+    value : Any
+        Compose value
+    env : dict
+        Environment to substitute from
+
+    Returns
+    -------
+    Any
+        Value with variables substituted
+
+    Raises
+    ------
+    RuntimeError
+        If a ``?`` variable is missing
+    """
+    if isinstance(value, dict):
+        return {key: interpolate(val, env) for key, val in value.items()}
+    if isinstance(value, list):
+        return [interpolate(val, env) for val in value]
+    if not isinstance(value, str):
+        return value
+
+    def substitute(match):
+        if match.group("escaped"):
+            return "$"
+        name = match.group("braced") or match.group("named")
+        op = match.group("op")
+        current = env.get(name)
+        if op in (":-", ":?"):
+            missing = not current
+        else:
+            missing = current is None
+        if not missing or op is None:
+            return current or ""
+        if op.endswith("-"):
+            return match.group("arg")
+        raise RuntimeError(match.group("arg") or f"Variable {name} is not set")
+
+    return _INTERPOLATION_PATTERN.sub(substitute, value)
@@ -1,6 +1,8 @@
 """Configuration and path resolution."""
 
+import json
 import os
+import threading
 from pathlib import Path
 
 
@@ -8,22 +10,17 @@ def get_nbs_pods_dir():
     """
     Get the nbs-pods package data directory.
 
-    Uses importlib.resources to find the installed package location,
-    which works for both regular and editable installs.
+    The compose/ and config/ directories are package data next to this
+    module, so the module location works for both regular and editable
+    installs without the import cost of importlib.resources.
 
     Returns
     -------
     Path
         nbs-pods package directory containing compose/, config/, etc.
     """
-    try:
-        from importlib import resources
-
-        return Path(resources.files("nbs_pods"))
-    except (ImportError, AttributeError):
-        # Fallback for older Python or when resources.files not available
-        # __file__ is nbs_pods/config.py, so parent is nbs_pods/
-        return Path(__file__).parent
+    # __file__ is nbs_pods/config.py, so parent is nbs_pods/
+    return Path(__file__).resolve().parent
 
 
 def get_beamline_pods_dir():
@@ -65,3 +62,177 @@ def get_beamline_name():
         return dir_name[:-5]
 
     return dir_name
+
+
+def get_cache_dir():
+    """
+    Get the nbs-pods cache directory for the current beamline.
+
+    Returns
+    -------
+    Path
+        ``$XDG_CACHE_HOME/nbs-pods/<beamline>`` (created if missing)
+    """
+    cache_home = os.getenv("XDG_CACHE_HOME") or Path.home() / ".cache"
+    cache_dir = Path(cache_home) / "nbs-pods" / get_beamline_name()
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    return cache_dir
+
+
+def get_state_dir():
+    """
+    Get the nbs-pods state directory for the current beamline.
+
+    Returns
+    -------
+    Path
+        ``$XDG_STATE_HOME/nbs-pods/<beamline>`` (created if missing)
+    """
+    state_home = os.getenv("XDG_STATE_HOME") or Path.home() / ".local" / "state"
+    state_dir = Path(state_home) / "nbs-pods" / get_beamline_name()
+    state_dir.mkdir(parents=True, exist_ok=True)
+    return state_dir
+
+
+def get_shared_state_dir():
+    """
+    Get the nbs-pods state directory shared by all beamlines of the host.
+
+    Returns
+    -------
+    Path
+        ``$XDG_STATE_HOME/nbs-pods/shared`` (created if missing)
+    """
+    state_home = os.getenv("XDG_STATE_HOME") or Path.home() / ".local" / "state"
+    shared_dir = Path(state_home) / "nbs-pods" / "shared"
+    shared_dir.mkdir(parents=True, exist_ok=True)
+    return shared_dir
+
+
+def get_profile_files(file_name):
+    """
+    Get the profile files of a kind, lowest precedence first.
+
+    Parameters
+    ----------
+    file_name : str
+        Name of the profile file, e.g. ``kafka-profiles.yml``
+
+    Returns
+    -------
+    list[Path]
+        Existing files of that name in nbs-pods' ``config/`` and in the
+        beamline pods directory
+    """
+    candidates = [
+        get_nbs_pods_dir() / "config" / file_name,
+        get_beamline_pods_dir() / file_name,
+    ]
+    files = []
+    for path in candidates:
+        if path.is_file() and path.resolve() not in [f.resolve() for f in files]:
+            files.append(path)
+    return files
+
+
+def load_profile_files(file_name, kind):
+    """
+    Load the presets of the profile files of a kind and the active preset.
+
+    A beamline preset replaces a shipped preset of the same name.
+
+    Parameters
+    ----------
+    file_name : str
+        Name of the profile file, e.g. ``kafka-profiles.yml``
+    kind : str
+        Kind of profiles in error messages, e.g. 'Kafka'
+
+    Returns
+    -------
+    tuple[dict, str | None]
+        (presets, active) where ``active`` is the ``profile`` named by the
+        highest-precedence file that names one
+
+    Raises
+    ------
+    RuntimeError
+        If a file is not a valid profile file
+    """
+    presets = {}
+    active = None
+    files = get_profile_files(file_name)
+    if not files:
+        return presets, active
+    import yaml
+
+    for path in files:
+        try:
+            with open(path, encoding="utf-8") as f:
+                document = yaml.safe_load(f) or {}
+        except (OSError, yaml.YAMLError) as e:
+            raise RuntimeError(f"Could not read {kind} profiles from {path}: {e}")
+        if not isinstance(document, dict) or not isinstance(document.get("presets", {}), dict):
+            raise RuntimeError(f"{path} must contain a 'presets' mapping")
+        presets.update(document.get("presets") or {})
+        active = document.get("profile", active)
+    return presets, active
+
+
+def write_file(path, text):
+    """
+    Write a text file atomically.
+
+    The text goes to a temporary file next to ``path`` that is unique to the
+    writing process and thread, and replaces ``path`` in one step. Services
+    started in parallel write the same generated files, and readers never
+    see a partial file.
+
+    Parameters
+    ----------
+    path : Path
+        File to write; its directory is created if missing
+    text : str
+        Contents
+
+    Returns
+    -------
+    Path
+        The written file
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = path.with_name(
+        f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp"
+    )
+    try:
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp_file, path)
+    except BaseException:
+        tmp_file.unlink(missing_ok=True)
+        raise
+    return path
+
+
+def write_json(path, document, indent=2):
+    """
+    Write a document to a file atomically.
+
+    Generated compose files and configuration are written as JSON, which is
+    valid YAML and does not need the yaml module to write.
+
+    Parameters
+    ----------
+    path : Path
+        File to write; its directory is created if missing
+    document : dict
+        Document to write
+    indent : int, optional
+        Indentation, None for compact JSON
+
+    Returns
+    -------
+    Path
+        The written file
+    """
+    return write_file(path, json.dumps(document, indent=indent))
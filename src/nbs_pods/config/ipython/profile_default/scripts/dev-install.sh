@@ -0,0 +1,18 @@
+#!/usr/bin/bash
+# Install source trees in editable mode. Editable installs pick up source
+# changes by themselves, so a tree is only reinstalled when its packaging
+# metadata changed since it was installed into this environment.
+set -e
+set -o xtrace
+stamp_dir="${CONDA_PREFIX:?no environment is active}/var/nbs-pods-dev"
+mkdir -p "$stamp_dir"
+for src in "$@"; do
+    name=$(basename "$src")
+    hash=$(cd "$src" && cat pyproject.toml setup.py setup.cfg 2>/dev/null | sha256sum | cut -d' ' -f1)
+    if [ "$(cat "$stamp_dir/$name" 2>/dev/null)" = "$hash" ]; then
+        echo "$name: packaging metadata unchanged, skipping install"
+        continue
+    fi
+    pip install --no-deps -e "$src"
+    echo "$hash" > "$stamp_dir/$name"
+done
@@ -1,6 +1,5 @@
 #!/usr/bin/bash
 set -e
 set -o xtrace
-pip install -e /usr/local/src/xraygui/nbs-gui
-$(dirname "$0")/gui-start.sh
-
+$(dirname "$0")/dev-install.sh /usr/local/src/xraygui/nbs-gui
+exec $(dirname "$0")/gui-start.sh
@@ -1,4 +1,4 @@
 #!/usr/bin/bash
 set -e
 set -o xtrace
-nbs-gui --profile default
\ No newline at end of file
+exec nbs-gui --profile default
\ No newline at end of file
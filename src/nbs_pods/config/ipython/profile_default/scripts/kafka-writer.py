@@ -0,0 +1,361 @@
+"""Write bluesky documents from Kafka to Mongo in batches.
+
+Consumes the RunEngine document topic in a consumer group and stores the
+documents in the ``mongo_normalized`` layout that Tiled serves. Events and
+datums, which make up nearly all documents of a fast scan, are buffered and
+written with bulk inserts once ``--batch-size`` documents are pending or
+``--flush-interval`` seconds have passed. Start, descriptor and resource
+documents are written right away, and a run's pending documents are
+written before its stop document.
+
+Offsets are committed after the documents consumed up to them are stored,
+so documents are written at least once; inserts are keyed by uid, so
+documents written twice (after a restart, or by the RunEngine's own Tiled
+writer) are ignored. With ``KAFKA_WRITER_ENABLED=1`` in the queueserver's
+and bsui's environment, the RunEngine stops inserting documents itself and
+this writer is the only one. While storage lags, at most ``--max-pending-bytes`` of
+documents are buffered; the consumer is paused when the buffer is full or
+a write fails, and resumed once the buffer is written.
+
+Several writers can run in the same consumer group, up to one per
+partition of the topic. Documents are keyed by run uid, so all documents
+of a run are read, in order, by the writer that owns its partition.
+
+The bootstrap servers and consumer properties (``consumer_config``) are
+read from the bluesky ``kafka.yml``. Every setting can be given as a
+command-line option or as the environment variable shown in ``--help``.
+"""
+
+import argparse
+import os
+import signal
+import sys
+import time
+
+from pipeline_common import env_default, get_profile_uri, load_kafka_config, make_log
+
+# Document name -> collection of the mongo_normalized layout
+COLLECTIONS = {
+    "start": "run_start",
+    "descriptor": "event_descriptor",
+    "resource": "resource",
+    "datum": "datum",
+    "event": "event",
+    "stop": "run_stop",
+}
+# Written in this order, so that no document references one not yet stored
+# and a run's stop document comes after all of its events
+FLUSH_ORDER = ("run_start", "event_descriptor", "resource", "datum", "event", "run_stop")
+BATCHED = ("event", "event_page", "datum", "datum_page")
+DUPLICATE_KEY = 11000
+
+log = make_log("kafka-writer")
+
+
+class MongoStore:
+    """Bulk writes of documents to a ``mongo_normalized`` database."""
+
+    def __init__(self, uri):
+        import pymongo
+
+        self._pymongo = pymongo
+        client = pymongo.MongoClient(uri)
+        self.db = client.get_default_database()
+        for collection in FLUSH_ORDER:
+            key = "datum_id" if collection == "datum" else "uid"
+            try:
+                self.db[collection].create_index(key, unique=True)
+            except pymongo.errors.OperationFailure as e:
+                # e.g. documents already stored twice; inserts are not deduplicated then
+                log(f"could not create unique index on {collection}.{key}: {e}")
+
+    def insert(self, collection, documents):
+        """
+        Insert documents, ignoring those already stored.
+
+        Returns
+        -------
+        int
+            Number of documents inserted
+        """
+        if not documents:
+            return 0
+        try:
+            result = self.db[collection].insert_many(documents, ordered=False)
+            return len(result.inserted_ids)
+        except self._pymongo.errors.BulkWriteError as e:
+            errors = e.details.get("writeErrors", [])
+            if any(error.get("code") != DUPLICATE_KEY for error in errors):
+                raise
+            return e.details.get("nInserted", 0)
+
+
+class Batcher:
+    """Buffer of documents waiting to be written, with write statistics."""
+
+    def __init__(self, store, batch_size, flush_interval, max_pending_bytes):
+        import event_model
+
+        self._event_model = event_model
+        self.store = store
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending_bytes = max_pending_bytes
+        self.pending = {collection: [] for collection in FLUSH_ORDER}
+        self.pending_count = 0
+        self.pending_bytes = 0
+        self.last_flush = time.monotonic()
+        self.stats = {"documents": 0, "written": 0, "flushes": 0, "flush_seconds": 0.0, "skipped": 0}
+
+    def add(self, name, doc, size):
+        """
+        Buffer a document.
+
+        Returns
+        -------
+        bool
+            Whether the document should be written right away rather than
+            with the next batch
+        """
+        self.stats["documents"] += 1
+        doc.pop("_id", None)
+        # Array data arrives as numpy arrays, which BSON cannot encode
+        doc = self._event_model.sanitize_doc(doc)
+        if name == "event_page":
+            documents = list(self._event_model.unpack_event_page(doc))
+        elif name == "datum_page":
+            documents = list(self._event_model.unpack_datum_page(doc))
+        elif name in COLLECTIONS:
+            documents = [doc]
+        else:
+            self.stats["skipped"] += 1
+            return False
+        collection = COLLECTIONS[name.replace("_page", "")]
+        self.pending[collection].extend(documents)
+        self.pending_count += len(documents)
+        self.pending_bytes += size
+        return name not in BATCHED
+
+    @property
+    def full(self):
+        return self.pending_count >= self.batch_size or self.pending_bytes >= self.max_pending_bytes
+
+    @property
+    def due(self):
+        return self.pending_count > 0 and time.monotonic() - self.last_flush >= self.flush_interval
+
+    def flush(self):
+        """Write all pending documents; they stay pending if a write fails."""
+        if self.pending_count:
+            start = time.monotonic()
+            for collection in FLUSH_ORDER:
+                self.stats["written"] += self.store.insert(collection, self.pending[collection])
+                self.pending[collection] = []
+            self.stats["flushes"] += 1
+            self.stats["flush_seconds"] += time.monotonic() - start
+        self.clear()
+
+    def clear(self):
+        """Drop the pending documents, e.g. when Kafka redelivers them elsewhere."""
+        for documents in self.pending.values():
+            documents.clear()
+        self.pending_count = 0
+        self.pending_bytes = 0
+        self.last_flush = time.monotonic()
+
+    def report(self, elapsed):
+        """Log and reset the statistics of the last ``elapsed`` seconds."""
+        stats = self.stats
+        flushes = stats["flushes"]
+        mean_flush = stats["flush_seconds"] / flushes * 1000 if flushes else 0.0
+        log(
+            f"{stats['documents'] / elapsed:.0f} docs/s, {stats['written'] / elapsed:.0f} writes/s, "
+            f"{flushes} flushes ({mean_flush:.1f} ms mean), "
+            f"{self.pending_bytes / 1e6:.1f} MB pending, {stats['skipped']} skipped"
+        )
+        self.stats = dict.fromkeys(stats, 0)
+        self.stats["flush_seconds"] = 0.0
+
+
+def decode(value):
+    """Decode a bluesky-kafka message into (name, doc)."""
+    import msgpack
+    import msgpack_numpy
+
+    name, doc = msgpack.unpackb(value, object_hook=msgpack_numpy.decode, strict_map_key=False)
+    return name, doc
+
+
+def run(args):
+    from confluent_kafka import Consumer, KafkaException
+
+    store = MongoStore(args.mongo_uri or get_profile_uri(args.tiled_profile))
+    batcher = Batcher(store, args.batch_size, args.flush_interval, args.max_pending_bytes)
+    kafka_config = load_kafka_config(args.kafka_config)
+    bootstrap_servers = args.bootstrap_servers or ",".join(
+        kafka_config.get("bootstrap_servers") or ["kafka:29092"]
+    )
+    consumer = Consumer(
+        dict(
+            kafka_config.get("consumer_config") or {},
+            **{
+                "bootstrap.servers": bootstrap_servers,
+                "group.id": args.group,
+                "enable.auto.commit": False,
+                "auto.offset.reset": "earliest",
+            },
+        )
+    )
+    uncommitted = False
+
+    def commit():
+        nonlocal uncommitted
+        if uncommitted:
+            consumer.commit(asynchronous=False)
+            uncommitted = False
+
+    def flush_with_backpressure():
+        """Flush, pausing consumption and retrying while storage fails."""
+        delay = 0.5
+        paused = False
+        while True:
+            try:
+                batcher.flush()
+                commit()
+                break
+            except Exception as e:  # storage errors are retried, not fatal
+                if not paused:
+                    consumer.pause(consumer.assignment())
+                    paused = True
+                log(f"write failed, retrying in {delay:.1f} s: {e}")
+                deadline = time.monotonic() + delay
+                while time.monotonic() < deadline:
+                    # Keep polling so the group does not consider us dead
+                    consumer.poll(min(0.5, args.flush_interval))
+                delay = min(delay * 2, 30.0)
+        if paused:
+            consumer.resume(consumer.assignment())
+
+    def on_revoke(consumer, partitions):
+        # Uncommitted documents are redelivered to the partitions' new owner
+        try:
+            batcher.flush()
+            commit()
+        except Exception as e:
+            log(f"dropping pending documents on rebalance: {e}")
+            batcher.clear()
+
+    running = True
+
+    def stop(signum, frame):
+        nonlocal running
+        running = False
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    consumer.subscribe(args.topics, on_revoke=on_revoke)
+    log(
+        f"consuming {', '.join(args.topics)} as {args.group}, batch size {args.batch_size}, "
+        f"flush interval {args.flush_interval} s, max pending {args.max_pending_bytes / 1e6:.0f} MB"
+    )
+    last_report = time.monotonic()
+    try:
+        while running:
+            message = consumer.poll(args.flush_interval)
+            if message is not None:
+                if message.error():
+                    raise KafkaException(message.error())
+                try:
+                    name, doc = decode(message.value())
+                except Exception as e:
+                    log(f"skipping undecodable message at offset {message.offset()}: {e}")
+                    continue
+                urgent = batcher.add(name, doc, len(message.value()))
+                uncommitted = True
+                if urgent or batcher.full:
+                    flush_with_backpressure()
+            if batcher.due:
+                flush_with_backpressure()
+            now = time.monotonic()
+            if args.stats_interval and now - last_report >= args.stats_interval:
+                batcher.report(now - last_report)
+                last_report = now
+    finally:
+        try:
+            batcher.flush()
+            commit()
+        except Exception as e:
+            log(f"could not write pending documents on exit, they are redelivered: {e}")
+        consumer.close()
+
+
+def main(argv=None):
+    acronym = os.getenv("NBS_BEAMLINE_ACRONYM", "nbs")
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--topics",
+        nargs="+",
+        default=env_default("KAFKA_WRITER_TOPICS", f"{acronym}.bluesky.runengine.documents").split(","),
+        help="Document topics (KAFKA_WRITER_TOPICS, comma-separated)",
+    )
+    parser.add_argument(
+        "--kafka-config",
+        default=env_default("KAFKA_WRITER_CONFIG", "/etc/bluesky/kafka.yml"),
+        help="bluesky Kafka configuration file (KAFKA_WRITER_CONFIG)",
+    )
+    parser.add_argument(
+        "--bootstrap-servers",
+        default=env_default("KAFKA_WRITER_BOOTSTRAP_SERVERS", None),
+        help="Kafka bootstrap servers (KAFKA_WRITER_BOOTSTRAP_SERVERS), "
+        "defaults to those of the Kafka configuration",
+    )
+    parser.add_argument(
+        "--group",
+        default=env_default("KAFKA_WRITER_GROUP", f"{acronym}-kafka-writer"),
+        help="Consumer group (KAFKA_WRITER_GROUP)",
+    )
+    parser.add_argument(
+        "--mongo-uri",
+        default=env_default("KAFKA_WRITER_MONGO_URI", None),
+        help="Mongo database to write to (KAFKA_WRITER_MONGO_URI), "
+        "defaults to the database of the Tiled profile",
+    )
+    parser.add_argument(
+        "--tiled-profile",
+        default=env_default("KAFKA_WRITER_TILED_PROFILE", "nbs"),
+        help="Tiled profile whose database is written to (KAFKA_WRITER_TILED_PROFILE)",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=env_default("KAFKA_WRITER_BATCH_SIZE", 1000, int),
+        help="Events and datums per bulk insert (KAFKA_WRITER_BATCH_SIZE)",
+    )
+    parser.add_argument(
+        "--flush-interval",
+        type=float,
+        default=env_default("KAFKA_WRITER_FLUSH_INTERVAL", 0.5, float),
+        help="Seconds before a partial batch is written (KAFKA_WRITER_FLUSH_INTERVAL)",
+    )
+    parser.add_argument(
+        "--max-pending-bytes",
+        type=int,
+        default=env_default("KAFKA_WRITER_MAX_PENDING_BYTES", 64 * 1024 * 1024, int),
+        help="Buffered message bytes at which consumption waits for storage "
+        "(KAFKA_WRITER_MAX_PENDING_BYTES)",
+    )
+    parser.add_argument(
+        "--stats-interval",
+        type=float,
+        default=env_default("KAFKA_WRITER_STATS_INTERVAL", 10.0, float),
+        help="Seconds between throughput reports, 0 to disable (KAFKA_WRITER_STATS_INTERVAL)",
+    )
+    args = parser.parse_args(argv)
+    if args.batch_size < 1 or args.flush_interval <= 0 or args.max_pending_bytes < 1:
+        parser.error("batch size, flush interval and max pending bytes must be positive")
+    run(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,140 @@
+"""Publish RunEngine documents to Kafka, keyed by run uid.
+
+nslsii's publisher gives every document of an IPython session the same
+message key, so the whole session lands on one partition of the document
+topic and a consumer group can never read it with more than one consumer.
+This publisher keys every document by the uid of the run it belongs to
+instead: Kafka keeps the documents of a run in order on one partition,
+while different runs are spread over all partitions of the topic.
+
+The bootstrap servers, producer properties (``runengine_producer_config``)
+and ``abort_run_on_kafka_exception`` are read from the bluesky
+``kafka.yml``, like nslsii does. Messages are msgpack-encoded
+``(name, doc)`` pairs, as bluesky-kafka consumers expect.
+"""
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+KAFKA_CONFIG = "/etc/bluesky/kafka.yml"
+
+
+class RunKeyedPublisher:
+    """
+    RunEngine callback that publishes documents keyed by their run uid.
+
+    Parameters
+    ----------
+    topic : str
+        Document topic
+    bootstrap_servers : str
+        Comma-separated Kafka bootstrap servers
+    producer_config : dict, optional
+        librdkafka producer properties
+    abort_run_on_kafka_exception : bool
+        Whether a failed publish raises into the RunEngine, aborting the run
+    """
+
+    def __init__(self, topic, bootstrap_servers, producer_config=None,
+                 abort_run_on_kafka_exception=False):
+        from confluent_kafka import Producer
+
+        self.topic = topic
+        self.abort_run_on_kafka_exception = abort_run_on_kafka_exception
+        self._producer = Producer(
+            dict(producer_config or {}, **{"bootstrap.servers": bootstrap_servers})
+        )
+        # Descriptor, resource and stream resource uid -> run uid, for the
+        # documents that only reference those
+        self._runs = {}
+
+    def get_run_uid(self, name, doc):
+        """
+        Get the uid of the run a document belongs to.
+
+        Returns
+        -------
+        str | None
+            Run uid, or None for documents of an unknown run
+        """
+        if name == "start":
+            return doc["uid"]
+        if name in ("descriptor", "resource", "stream_resource"):
+            run_uid = doc.get("run_start")
+            if run_uid is not None:
+                self._runs[doc["uid"]] = run_uid
+            return run_uid
+        if name == "stop":
+            return doc["run_start"]
+        if name in ("event", "event_page"):
+            return self._runs.get(doc["descriptor"])
+        if name in ("datum", "datum_page"):
+            return self._runs.get(doc["resource"])
+        if name == "stream_datum":
+            return self._runs.get(doc["stream_resource"])
+        return None
+
+    def _forget_run(self, run_uid):
+        self._runs = {uid: run for uid, run in self._runs.items() if run != run_uid}
+
+    def __call__(self, name, doc):
+        import msgpack
+        import msgpack_numpy
+
+        run_uid = self.get_run_uid(name, doc)
+        try:
+            self._producer.produce(
+                self.topic,
+                key=run_uid,
+                value=msgpack.packb((name, doc), default=msgpack_numpy.encode),
+                on_delivery=self._on_delivery,
+            )
+            # Serve delivery callbacks of earlier messages
+            self._producer.poll(0)
+            if name == "stop":
+                self._forget_run(run_uid)
+                self._producer.flush()
+        except Exception:
+            if self.abort_run_on_kafka_exception:
+                raise
+            logger.exception("Failed to publish %s document to %s", name, self.topic)
+
+    def _on_delivery(self, err, msg):
+        if err is not None:
+            logger.error("Failed to deliver document to %s: %s", self.topic, err)
+
+    def flush(self, timeout=None):
+        """Wait until all published documents are delivered."""
+        return self._producer.flush() if timeout is None else self._producer.flush(timeout)
+
+
+def subscribe_kafka_publisher(RE, beamline_name, config_file=KAFKA_CONFIG):
+    """
+    Subscribe a run-keyed Kafka publisher to a RunEngine.
+
+    Parameters
+    ----------
+    RE : bluesky.RunEngine
+        RunEngine to publish the documents of
+    beamline_name : str
+        Beamline acronym; documents go to ``<beamline_name>.bluesky.runengine.documents``
+    config_file : str
+        bluesky Kafka configuration file
+
+    Returns
+    -------
+    tuple[RunKeyedPublisher, int]
+        The publisher and its RunEngine subscription token
+    """
+    import yaml
+
+    with open(config_file, encoding="utf-8") as f:
+        config = yaml.safe_load(f) or {}
+    publisher = RunKeyedPublisher(
+        f"{beamline_name}.bluesky.runengine.documents",
+        ",".join(config.get("bootstrap_servers") or ["kafka:29092"]),
+        config.get("runengine_producer_config"),
+        config.get("abort_run_on_kafka_exception", False),
+    )
+    return publisher, RE.subscribe(publisher)
@@ -0,0 +1,543 @@
+"""Benchmark the bluesky-services document pipeline with synthetic runs.
+
+Emits synthetic runs, shaped by the options, the way a RunEngine does. The
+documents go to both ZMQ proxies and, keyed by run uid, to the Kafka
+document topic. Each document is timed until it arrives on every path it
+takes:
+
+- ``zmq_proxy``, ``zmq_proxy2``: received from the proxy's subscriber port
+- ``kafka``: consumed from the topic by a consumer group of its own
+- ``storage``: events stored in Mongo by kafka-writer
+- ``tiled``: the run, with its stop document, served by Tiled
+
+The report gives the emitted and sustained throughput of every path, with
+the p50/p99/max latency from emit to arrival. For storage it also gives
+the write amplification: bytes Mongo stored and wrote to disk per byte of
+msgpack-encoded documents. The storage and Tiled paths need kafka-writer
+to be running. Benchmark runs are marked with ``purpose: nbs-pods bench``
+and are deleted from Mongo afterwards unless ``--keep`` is given.
+
+The report is printed to stdout as JSON; progress goes to stderr.
+"""
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+
+from pipeline_common import get_profile_uri, load_kafka_config, make_log
+
+BENCH_PURPOSE = "nbs-pods bench"
+ZMQ_PREFIX = b"nbs-pods-bench"
+ZMQ_PROXIES = {
+    "zmq_proxy": ("zmq_proxy:4567", "zmq_proxy:5678"),
+    "zmq_proxy2": ("zmq_proxy2:5577", "zmq_proxy2:5578"),
+}
+PATHS = ("zmq_proxy", "zmq_proxy2", "kafka", "storage", "tiled")
+POLL_INTERVAL = 0.01
+
+log = make_log("bench", sys.stderr)
+
+
+def get_key(name, doc):
+    """Identify a document across paths; an EventPage by its first event."""
+    if name == "event_page":
+        return doc["uid"][0]
+    return doc.get("uid")
+
+
+def count_events(name, doc):
+    if name == "event_page":
+        return len(doc["uid"])
+    return 1 if name == "event" else 0
+
+
+def percentiles(values):
+    """Summarize latencies in milliseconds."""
+    if not values:
+        return None
+    values = sorted(values)
+
+    def at(fraction):
+        return values[min(len(values) - 1, int(fraction * len(values)))] * 1000
+
+    return {"p50": at(0.5), "p99": at(0.99), "max": values[-1] * 1000, "count": len(values)}
+
+
+class Recorder:
+    """Arrival times of the documents of one path."""
+
+    def __init__(self, emitted):
+        self.emitted = emitted
+        self.latencies = []
+        self.received = 0
+        self.events = 0
+        self.last = None
+        self._lock = threading.Lock()
+
+    def record(self, key, events, now=None):
+        now = time.monotonic() if now is None else now
+        emitted = self.emitted.get(key)
+        if emitted is None:
+            # Not a document of this benchmark
+            return
+        with self._lock:
+            self.latencies.append(now - emitted)
+            self.received += 1
+            self.events += events
+            self.last = now
+
+    def summary(self, first_emit):
+        elapsed = self.last - first_emit if self.last is not None else None
+        return {
+            "received": self.received,
+            "events": self.events,
+            "events_per_s": self.events / elapsed if elapsed else None,
+            "latency_ms": percentiles(self.latencies),
+        }
+
+
+class RunFactory:
+    """Synthetic documents of configurable shape."""
+
+    def __init__(self, fields, shape, page_size, metadata):
+        import numpy as np
+
+        self.fields = [f"bench_{i}" for i in range(fields)]
+        self.shape = list(shape)
+        self.page_size = page_size
+        self.metadata = metadata
+        # Random, so compressing producers do not get an easy ride; reused
+        # by every event so generating data does not limit the event rate
+        rng = np.random.default_rng()
+        self.values = {
+            field: rng.random(self.shape) if self.shape else float(rng.random())
+            for field in self.fields
+        }
+
+    def start(self):
+        return {
+            "uid": str(uuid.uuid4()),
+            "time": time.time(),
+            "scan_id": 0,
+            "plan_name": "nbs-pods-bench",
+            "purpose": BENCH_PURPOSE,
+            **self.metadata,
+        }
+
+    def descriptor(self, start):
+        return {
+            "uid": str(uuid.uuid4()),
+            "run_start": start["uid"],
+            "time": time.time(),
+            "name": "primary",
+            "data_keys": {
+                field: {
+                    "source": "nbs-pods-bench",
+                    "dtype": "array" if self.shape else "number",
+                    "shape": self.shape,
+                    "object_name": "bench",
+                }
+                for field in self.fields
+            },
+            "object_keys": {"bench": self.fields},
+            "configuration": {},
+            "hints": {"bench": {"fields": self.fields}},
+        }
+
+    def events(self, descriptor, first_seq_num, count):
+        """Get ``count`` events, as one EventPage unless pages are 1 event."""
+        now = time.time()
+        seq_nums = list(range(first_seq_num, first_seq_num + count))
+        if self.page_size == 1:
+            return "event", {
+                "uid": str(uuid.uuid4()),
+                "descriptor": descriptor["uid"],
+                "time": now,
+                "seq_num": seq_nums[0],
+                "data": dict(self.values),
+                "timestamps": dict.fromkeys(self.fields, now),
+                "filled": {},
+            }
+        return "event_page", {
+            "uid": [str(uuid.uuid4()) for _ in seq_nums],
+            "descriptor": descriptor["uid"],
+            "time": [now] * count,
+            "seq_num": seq_nums,
+            "data": {field: [value] * count for field, value in self.values.items()},
+            "timestamps": {field: [now] * count for field in self.fields},
+            "filled": {},
+        }
+
+    def stop(self, start, num_events):
+        return {
+            "uid": str(uuid.uuid4()),
+            "run_start": start["uid"],
+            "time": time.time(),
+            "exit_status": "success",
+            "reason": "",
+            "num_events": {"primary": num_events},
+        }
+
+
+class ZmqPath:
+    """Publish to a ZMQ proxy and time documents from its subscriber port."""
+
+    def __init__(self, name, recorder, inbound, outbound):
+        from bluesky.callbacks.zmq import Publisher
+
+        self.name = name
+        self.recorder = recorder
+        self.outbound = outbound
+        self.publisher = Publisher(inbound, prefix=ZMQ_PREFIX)
+        self._dispatcher = None
+        self._ready = threading.Event()
+        self._thread = threading.Thread(target=self._receive, daemon=True)
+        self._thread.start()
+        self._ready.wait(10)
+
+    def _receive(self):
+        from bluesky.callbacks.zmq import RemoteDispatcher
+
+        # The dispatcher's event loop must belong to this thread
+        self._dispatcher = RemoteDispatcher(self.outbound, prefix=ZMQ_PREFIX)
+        self._dispatcher.subscribe(
+            lambda name, doc: self.recorder.record(get_key(name, doc), count_events(name, doc))
+        )
+        self._ready.set()
+        self._dispatcher.start()
+
+    def __call__(self, name, doc):
+        self.publisher(name, doc)
+
+    def close(self):
+        if self._dispatcher is not None:
+            self._dispatcher.loop.call_soon_threadsafe(self._dispatcher.stop)
+
+
+class KafkaPath:
+    """Publish to the document topic and time documents consumed from it."""
+
+    def __init__(self, recorder, topic, kafka_config):
+        from confluent_kafka import Consumer
+
+        from kafka_publisher import RunKeyedPublisher
+
+        bootstrap_servers = ",".join(kafka_config.get("bootstrap_servers") or ["kafka:29092"])
+        self.recorder = recorder
+        self.publisher = RunKeyedPublisher(
+            topic, bootstrap_servers, kafka_config.get("runengine_producer_config")
+        )
+        self.consumer = Consumer(
+            dict(
+                kafka_config.get("consumer_config") or {},
+                **{
+                    "bootstrap.servers": bootstrap_servers,
+                    "group.id": f"nbs-pods-bench-{uuid.uuid4()}",
+                    "auto.offset.reset": "latest",
+                    "enable.auto.commit": False,
+                },
+            )
+        )
+        self._assigned = threading.Event()
+        self.consumer.subscribe([topic], on_assign=lambda consumer, partitions: self._assigned.set())
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._receive, daemon=True)
+        self._thread.start()
+        if not self._assigned.wait(30):
+            raise SystemExit(f"bench: no partitions of {topic} were assigned; is Kafka running?")
+
+    def _receive(self):
+        import msgpack
+        import msgpack_numpy
+
+        while not self._stopping.is_set():
+            message = self.consumer.poll(0.1)
+            if message is None or message.error():
+                continue
+            now = time.monotonic()
+            name, doc = msgpack.unpackb(
+                message.value(), object_hook=msgpack_numpy.decode, strict_map_key=False
+            )
+            self.recorder.record(get_key(name, doc), count_events(name, doc), now)
+        self.consumer.close()
+
+    def __call__(self, name, doc):
+        self.publisher(name, doc)
+
+    def close(self):
+        self.publisher.flush()
+        self._stopping.set()
+        self._thread.join(5)
+
+
+class StoragePath:
+    """Poll Mongo for the events and runs kafka-writer has stored."""
+
+    def __init__(self, events_recorder, runs_recorder, mongo_uri, tiled_url):
+        import pymongo
+
+        self.db = pymongo.MongoClient(mongo_uri).get_default_database()
+        self.events_recorder = events_recorder
+        self.runs_recorder = runs_recorder
+        self.tiled_url = tiled_url
+        # descriptor uid -> [(seq_num, key, emitted)] of events not yet stored
+        self.pending_events = {}
+        # run uid -> still waiting for Tiled
+        self.pending_runs = set()
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._poll, daemon=True)
+        self._thread.start()
+
+    def add_events(self, descriptor_uid, key, seq_nums):
+        with self._lock:
+            self.pending_events.setdefault(descriptor_uid, []).extend((seq_num, key) for seq_num in seq_nums)
+
+    def add_run(self, run_uid):
+        with self._lock:
+            self.pending_runs.add(run_uid)
+
+    @property
+    def done(self):
+        with self._lock:
+            return not any(self.pending_events.values()) and not self.pending_runs
+
+    def _poll(self):
+        while not self._stopping.is_set():
+            with self._lock:
+                descriptors = [uid for uid, pending in self.pending_events.items() if pending]
+                runs = list(self.pending_runs)
+            for descriptor_uid in descriptors:
+                latest = self.db.event.find_one(
+                    {"descriptor": descriptor_uid}, {"seq_num": 1}, sort=[("seq_num", -1)]
+                )
+                if latest is None:
+                    continue
+                now = time.monotonic()
+                with self._lock:
+                    pending = self.pending_events[descriptor_uid]
+                    stored = [entry for entry in pending if entry[0] <= latest["seq_num"]]
+                    self.pending_events[descriptor_uid] = [e for e in pending if e[0] > latest["seq_num"]]
+                for _, key in stored:
+                    self.events_recorder.record(key, 1, now)
+            for run_uid in runs:
+                if self._run_visible(run_uid):
+                    self.runs_recorder.record(run_uid, 0)
+                    with self._lock:
+                        self.pending_runs.discard(run_uid)
+            time.sleep(POLL_INTERVAL)
+
+    def _run_visible(self, run_uid):
+        """Whether Tiled serves the run with its stop document."""
+        import urllib.error
+        import urllib.request
+
+        try:
+            with urllib.request.urlopen(f"{self.tiled_url}{run_uid}", timeout=5) as response:
+                metadata = json.load(response)["data"]["attributes"]["metadata"]
+        except (urllib.error.URLError, OSError, KeyError, ValueError):
+            return False
+        return metadata.get("stop") is not None
+
+    def stats(self):
+        """Get the database's stored bytes and the bytes Mongo wrote to disk."""
+        # Checkpoint, so that the bytes written include the latest writes
+        self.db.client.admin.command("fsync")
+        db_stats = self.db.command("dbstats")
+        server_status = self.db.client.admin.command("serverStatus")
+        block_manager = server_status.get("wiredTiger", {}).get("block-manager", {})
+        return {
+            "stored": db_stats.get("dataSize", 0) + db_stats.get("indexSize", 0),
+            "written": block_manager.get("bytes written", 0),
+        }
+
+    def delete_runs(self, run_uids):
+        """Delete the benchmark runs."""
+        descriptors = [
+            doc["uid"] for doc in self.db.event_descriptor.find({"run_start": {"$in": run_uids}}, {"uid": 1})
+        ]
+        self.db.event.delete_many({"descriptor": {"$in": descriptors}})
+        self.db.event_descriptor.delete_many({"run_start": {"$in": run_uids}})
+        self.db.run_stop.delete_many({"run_start": {"$in": run_uids}})
+        self.db.run_start.delete_many({"uid": {"$in": run_uids}})
+
+    def close(self):
+        self._stopping.set()
+        self._thread.join(5)
+
+
+def get_metadata_url(tiled_url, tiled_path):
+    """Get the URL that run uids are appended to for their Tiled metadata."""
+    url = f"{tiled_url.rstrip('/')}/api/v1/metadata/"
+    tiled_path = tiled_path.strip("/")
+    return f"{url}{tiled_path}/" if tiled_path else url
+
+
+def run(args):
+    import msgpack
+    import msgpack_numpy
+
+    paths = set(args.paths)
+    emitted = {}
+    # Tiled-visible latency counts from the stop document, by run uid
+    stops_emitted = {}
+    recorders = {
+        path: Recorder(stops_emitted if path == "tiled" else emitted) for path in PATHS if path in paths
+    }
+    senders = []
+    storage = None
+    for name, (inbound, outbound) in ZMQ_PROXIES.items():
+        if name in paths:
+            senders.append(ZmqPath(name, recorders[name], inbound, outbound))
+    if "kafka" in paths or "storage" in paths or "tiled" in paths:
+        kafka_recorder = recorders.get("kafka") or Recorder({})
+        senders.append(KafkaPath(kafka_recorder, args.topic, load_kafka_config(args.kafka_config)))
+    if "storage" in paths or "tiled" in paths:
+        storage = StoragePath(
+            recorders.get("storage") or Recorder({}),
+            recorders.get("tiled") or Recorder({}),
+            args.mongo_uri or get_profile_uri(args.tiled_profile),
+            get_metadata_url(args.tiled_url, args.tiled_path),
+        )
+        stats_before = storage.stats()
+    # Let ZMQ subscriptions reach the proxies before publishing
+    time.sleep(args.settle)
+
+    factory = RunFactory(args.fields, args.shape, args.page_size, {"bench_label": args.label} if args.label else {})
+    counts = {"runs": 0, "documents": 0, "events": 0, "payload_bytes": 0}
+    run_uids = []
+
+    def emit(name, doc):
+        counts["documents"] += 1
+        counts["payload_bytes"] += len(msgpack.packb((name, doc), default=msgpack_numpy.encode))
+        emitted[get_key(name, doc)] = time.monotonic()
+        for send in senders:
+            send(name, doc)
+
+    log(
+        f"{args.runs} runs of {args.events} events, {args.fields} fields of shape "
+        f"{args.shape or 'scalar'}, {args.page_size} events per page, "
+        f"{'unpaced' if not args.rate else f'{args.rate:g} events/s'}"
+    )
+    first_emit = time.monotonic()
+    for _ in range(args.runs):
+        start = factory.start()
+        run_uids.append(start["uid"])
+        emit("start", start)
+        descriptor = factory.descriptor(start)
+        emit("descriptor", descriptor)
+        run_start_time = time.monotonic()
+        seq_num = 1
+        while seq_num <= args.events:
+            count = min(args.page_size, args.events - seq_num + 1)
+            if args.rate:
+                # Emit at the requested event rate
+                delay = run_start_time + (seq_num - 1) / args.rate - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            name, doc = factory.events(descriptor, seq_num, count)
+            if storage is not None:
+                storage.add_events(descriptor["uid"], get_key(name, doc), range(seq_num, seq_num + count))
+            emit(name, doc)
+            counts["events"] += count
+            seq_num += count
+        stop = factory.stop(start, args.events)
+        emit("stop", stop)
+        if storage is not None:
+            stops_emitted[start["uid"]] = emitted[stop["uid"]]
+            storage.add_run(start["uid"])
+        counts["runs"] += 1
+    last_emit = time.monotonic()
+    for sender in senders:
+        if isinstance(sender, KafkaPath):
+            sender.publisher.flush()
+    log(f"emitted {counts['documents']} documents in {last_emit - first_emit:.2f} s, waiting for arrival")
+
+    deadline = time.monotonic() + args.timeout
+    while time.monotonic() < deadline:
+        delivered = all(
+            recorders[path].received >= counts["documents"]
+            for path in ("zmq_proxy", "zmq_proxy2", "kafka") if path in recorders
+        )
+        if delivered and (storage is None or storage.done):
+            break
+        time.sleep(0.1)
+    else:
+        log(f"timed out after {args.timeout:g} s; documents not arrived by then count as lost")
+
+    report = {
+        "config": {
+            key: getattr(args, key)
+            for key in ("runs", "events", "fields", "shape", "page_size", "rate", "topic", "label")
+        },
+        **counts,
+        "emit_seconds": last_emit - first_emit,
+        "emitted_events_per_s": counts["events"] / (last_emit - first_emit) if last_emit > first_emit else None,
+        "paths": {path: recorder.summary(first_emit) for path, recorder in recorders.items()},
+    }
+    if storage is not None:
+        stats_after = storage.stats()
+        payload = counts["payload_bytes"] or 1
+        report["amplification"] = {
+            "stored_bytes": stats_after["stored"] - stats_before["stored"],
+            "written_bytes": stats_after["written"] - stats_before["written"],
+            "stored_per_payload": (stats_after["stored"] - stats_before["stored"]) / payload,
+            "written_per_payload": (stats_after["written"] - stats_before["written"]) / payload,
+        }
+        if not args.keep:
+            storage.delete_runs(run_uids)
+        storage.close()
+    for sender in senders:
+        sender.close()
+    return report
+
+
+def parse_shape(value):
+    if value in ("", "0", "scalar"):
+        return []
+    try:
+        shape = [int(size) for size in value.lower().split("x")]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid shape '{value}', e.g. 1024 or 512x512")
+    if any(size < 1 for size in shape):
+        raise argparse.ArgumentTypeError(f"invalid shape '{value}', e.g. 1024 or 512x512")
+    return shape
+
+
+def main(argv=None):
+    acronym = os.getenv("NBS_BEAMLINE_ACRONYM", "nbs")
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--runs", type=int, default=3, help="Number of runs")
+    parser.add_argument("--events", type=int, default=1000, help="Events per run")
+    parser.add_argument("--rate", type=float, default=0, help="Events per second, 0 for as fast as possible")
+    parser.add_argument("--fields", type=int, default=4, help="Data fields per event")
+    parser.add_argument(
+        "--shape", type=parse_shape, default=[], help="Shape of every field, e.g. 1024 or 512x512 (default: scalar)"
+    )
+    parser.add_argument("--page-size", type=int, default=1, help="Events per EventPage, 1 for Event documents")
+    parser.add_argument(
+        "--paths", nargs="+", choices=PATHS, default=list(PATHS), help="Paths to time (default: all)"
+    )
+    parser.add_argument("--topic", default=f"{acronym}.bluesky.runengine.documents", help="Kafka document topic")
+    parser.add_argument("--kafka-config", default="/etc/bluesky/kafka.yml", help="bluesky Kafka configuration file")
+    parser.add_argument("--mongo-uri", default=None, help="Mongo database kafka-writer writes to")
+    parser.add_argument("--tiled-profile", default="nbs", help="Tiled profile of the database, without --mongo-uri")
+    parser.add_argument("--tiled-url", default="http://tiled_server:8000", help="Tiled server")
+    parser.add_argument("--tiled-path", default="", help="Path of the catalog on the Tiled server")
+    parser.add_argument("--timeout", type=float, default=60, help="Seconds to wait for documents to arrive")
+    parser.add_argument("--settle", type=float, default=1.0, help="Seconds for subscriptions to settle")
+    parser.add_argument("--label", default=None, help="Label recorded in the report and the runs")
+    parser.add_argument("--keep", action="store_true", help="Keep the benchmark runs in Mongo")
+    args = parser.parse_args(argv)
+    if args.runs < 1 or args.events < 1 or args.fields < 1 or args.page_size < 1 or args.rate < 0:
+        parser.error("runs, events, fields and page size must be positive, and rate not negative")
+
+    print(json.dumps(run(args)), flush=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,578 @@
+"""Export metrics of the document pipeline in the Prometheus text format.
+
+Every ``--interval`` seconds the services of bluesky-services and the
+queueserver are scraped, and the result is served on ``/metrics``:
+
+- ``zmq``: the ``/metrics`` of the ZMQ proxies, passed through unchanged
+  (messages received, forwarded and dropped)
+- ``kafka``: end offsets of the document topics and, for every consumer
+  group reading them, the committed offsets and the lag behind the end
+- ``queueserver``: queue and history length, manager and RunEngine state,
+  and the durations of the plans in the history, from the RE Manager's
+  control address
+- ``redis``: ``INFO`` of every Redis server (commands processed, clients,
+  memory)
+- ``mongo``: ``serverStatus`` of Mongo (operations, connections, cache)
+
+Counters are totals; rates (documents/s, operations/s) are computed by
+whatever reads them, e.g. ``nbs-pods metrics`` or Prometheus' ``rate()``.
+A source that cannot be reached does not stop the others: its
+``nbs_scrape_up`` is 0 and the error is logged once until it recovers.
+
+The bootstrap servers and consumer properties are read from the bluesky
+``kafka.yml``. Every setting can be given as a command-line option or as
+the environment variable shown in ``--help``.
+"""
+
+import argparse
+import os
+import sys
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from pipeline_common import env_default, load_kafka_config, make_log
+
+SOURCES = ("zmq", "kafka", "queueserver", "redis", "mongo")
+# Upper bounds, in seconds, of the plan duration histogram
+PLAN_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, 7200)
+MONGO_OPCOUNTERS = ("insert", "query", "update", "delete", "getmore", "command")
+
+log = make_log("pipeline-metrics")
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (
+        (key, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for key, value in labels.items()
+    )
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+
+class Metrics:
+    """Samples of one scrape, grouped by metric family."""
+
+    def __init__(self):
+        self.families = {}
+
+    def add(self, name, kind, help_text, value, **labels):
+        family = self.families.setdefault(name, (kind, help_text, []))
+        family[2].append((labels, value))
+
+    def render(self):
+        """Render the samples in the Prometheus text format."""
+        lines = []
+        for name, (kind, help_text, samples) in self.families.items():
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+            for labels, value in samples:
+                # Histograms are made of _bucket, _sum and _count series
+                suffix = labels.get("_suffix", "")
+                labels = {k: v for k, v in labels.items() if k != "_suffix"}
+                lines.append(f"{name}{suffix}{format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+class ZmqScraper:
+    """Pass through the metrics of the ZMQ proxies."""
+
+    def __init__(self, urls, timeout):
+        self.urls = urls
+        self.timeout = timeout
+
+    def scrape(self, metrics):
+        texts = []
+        errors = []
+        for url in self.urls:
+            try:
+                with urllib.request.urlopen(url, timeout=self.timeout) as response:
+                    texts.append(response.read().decode())
+            except OSError as e:
+                errors.append(f"{url}: {e}")
+        if errors and not texts:
+            raise RuntimeError("; ".join(errors))
+        return "".join(texts)
+
+
+class KafkaScraper:
+    """End offsets of the document topics and the lag of their consumer groups."""
+
+    def __init__(self, bootstrap_servers, client_config, topics, ignore_groups, timeout):
+        from confluent_kafka import Consumer
+        from confluent_kafka.admin import AdminClient
+
+        config = dict(client_config, **{"bootstrap.servers": bootstrap_servers})
+        self.admin = AdminClient(config)
+        self.consumer = Consumer(
+            dict(config, **{"group.id": "nbs-pods-metrics", "enable.auto.commit": False})
+        )
+        self.topics = topics
+        self.ignore_groups = ignore_groups
+        self.timeout = timeout
+
+    def get_end_offsets(self):
+        from confluent_kafka import TopicPartition
+
+        offsets = {}
+        cluster = self.consumer.list_topics(timeout=self.timeout)
+        for topic in self.topics:
+            if topic not in cluster.topics:
+                continue
+            for partition in cluster.topics[topic].partitions:
+                _, high = self.consumer.get_watermark_offsets(
+                    TopicPartition(topic, partition), timeout=self.timeout
+                )
+                offsets[(topic, partition)] = high
+        return offsets
+
+    def get_groups(self):
+        listing = self.admin.list_consumer_groups(request_timeout=self.timeout).result()
+        return sorted(
+            group.group_id
+            for group in listing.valid
+            if not group.group_id.startswith(tuple(self.ignore_groups))
+        )
+
+    def get_committed(self, group, partitions):
+        from confluent_kafka import ConsumerGroupTopicPartitions, TopicPartition
+
+        request = ConsumerGroupTopicPartitions(
+            group, [TopicPartition(topic, partition) for topic, partition in partitions]
+        )
+        # One group per request
+        futures = self.admin.list_consumer_group_offsets([request], request_timeout=self.timeout)
+        result = futures[group].result()
+        return {
+            (tp.topic, tp.partition): tp.offset
+            for tp in result.topic_partitions
+            if tp.offset >= 0
+        }
+
+    def scrape(self, metrics):
+        end_offsets = self.get_end_offsets()
+        for topic in self.topics:
+            total = sum(high for (t, _), high in end_offsets.items() if t == topic)
+            metrics.add(
+                "nbs_kafka_topic_messages_total",
+                "counter",
+                "Messages written to the topic (sum of the partitions' end offsets)",
+                total,
+                topic=topic,
+            )
+            metrics.add(
+                "nbs_kafka_topic_partitions",
+                "gauge",
+                "Partitions of the topic",
+                sum(1 for t, _ in end_offsets if t == topic),
+                topic=topic,
+            )
+        if not end_offsets:
+            return ""
+        for group in self.get_groups():
+            committed = self.get_committed(group, end_offsets)
+            for topic in {t for t, _ in committed}:
+                partitions = [key for key in committed if key[0] == topic]
+                metrics.add(
+                    "nbs_kafka_consumer_group_messages_total",
+                    "counter",
+                    "Messages of the topic the consumer group has committed",
+                    sum(committed[key] for key in partitions),
+                    group=group,
+                    topic=topic,
+                )
+                metrics.add(
+                    "nbs_kafka_consumer_group_lag",
+                    "gauge",
+                    "Messages of the topic the consumer group has not committed yet",
+                    sum(max(0, end_offsets[key] - committed[key]) for key in partitions),
+                    group=group,
+                    topic=topic,
+                )
+        return ""
+
+
+class QueueserverScraper:
+    """Queue, state and plan durations from the RE Manager."""
+
+    def __init__(self, control_address, timeout):
+        from bluesky_queueserver_api.zmq import REManagerAPI
+
+        self.api = REManagerAPI(zmq_control_addr=control_address, timeout_recv=timeout)
+        self.history_uid = None
+        self.plans = None
+
+    def summarize_history(self, items):
+        """Count the plans of the history by exit status and duration."""
+        counts = {}
+        buckets = [0] * len(PLAN_BUCKETS)
+        total = 0.0
+        finished = 0
+        last = None
+        for item in items:
+            result = item.get("result") or {}
+            status = result.get("exit_status") or "unknown"
+            counts[status] = counts.get(status, 0) + 1
+            start, stop = result.get("time_start"), result.get("time_stop")
+            if start is None or stop is None:
+                continue
+            duration = max(0.0, stop - start)
+            for i, bound in enumerate(PLAN_BUCKETS):
+                if duration <= bound:
+                    buckets[i] += 1
+            total += duration
+            finished += 1
+            last = duration
+        return {"counts": counts, "buckets": buckets, "sum": total, "count": finished, "last": last}
+
+    def scrape(self, metrics):
+        status = self.api.status()
+        if status.get("plan_history_uid") != self.history_uid or self.plans is None:
+            history = self.api.history_get()
+            self.plans = self.summarize_history(history.get("items") or [])
+            self.history_uid = history.get("plan_history_uid")
+        metrics.add(
+            "nbs_qserver_queue_items", "gauge", "Plans in the queue", status.get("items_in_queue", 0)
+        )
+        metrics.add(
+            "nbs_qserver_history_items",
+            "gauge",
+            "Plans in the history",
+            status.get("items_in_history", 0),
+        )
+        metrics.add(
+            "nbs_qserver_plan_running",
+            "gauge",
+            "Whether a plan is running",
+            int(bool(status.get("running_item_uid"))),
+        )
+        metrics.add(
+            "nbs_qserver_worker_environment",
+            "gauge",
+            "Whether the worker environment is open",
+            int(bool(status.get("worker_environment_exists"))),
+        )
+        metrics.add(
+            "nbs_qserver_state",
+            "gauge",
+            "States of the RE Manager and its RunEngine",
+            1,
+            manager_state=status.get("manager_state") or "unknown",
+            re_state=status.get("re_state") or "none",
+        )
+        for exit_status, count in sorted(self.plans["counts"].items()):
+            metrics.add(
+                "nbs_qserver_history_plans",
+                "gauge",
+                "Plans in the history by exit status",
+                count,
+                exit_status=exit_status,
+            )
+        name = "nbs_qserver_plan_duration_seconds"
+        help_text = "Durations of the plans in the history"
+        for bound, count in zip(PLAN_BUCKETS, self.plans["buckets"]):
+            metrics.add(name, "histogram", help_text, count, _suffix="_bucket", le=bound)
+        metrics.add(name, "histogram", help_text, self.plans["count"], _suffix="_bucket", le="+Inf")
+        metrics.add(name, "histogram", help_text, f"{self.plans['sum']:.3f}", _suffix="_sum")
+        metrics.add(name, "histogram", help_text, self.plans["count"], _suffix="_count")
+        if self.plans["last"] is not None:
+            metrics.add(
+                "nbs_qserver_last_plan_duration_seconds",
+                "gauge",
+                "Duration of the last plan in the history",
+                f"{self.plans['last']:.3f}",
+            )
+        return ""
+
+
+class RedisScraper:
+    """``INFO`` of the Redis servers."""
+
+    def __init__(self, addresses, timeout):
+        import redis
+
+        self.clients = {}
+        for address in addresses:
+            host, _, port = address.partition(":")
+            self.clients[address] = redis.Redis(
+                host=host, port=int(port or 6379), socket_timeout=timeout, socket_connect_timeout=timeout
+            )
+
+    def scrape(self, metrics):
+        errors = []
+        for address, client in self.clients.items():
+            try:
+                info = client.info()
+            except Exception as e:
+                errors.append(f"{address}: {e}")
+                continue
+            for name, kind, help_text, key in (
+                ("nbs_redis_commands_processed_total", "counter", "Commands processed", "total_commands_processed"),
+                ("nbs_redis_connected_clients", "gauge", "Connected clients", "connected_clients"),
+                ("nbs_redis_used_memory_bytes", "gauge", "Memory used by the data", "used_memory"),
+                ("nbs_redis_keys", "gauge", "Keys in all databases", None),
+            ):
+                if key is None:
+                    value = sum(db.get("keys", 0) for n, db in info.items() if n.startswith("db"))
+                else:
+                    value = info.get(key, 0)
+                metrics.add(name, kind, help_text, value, instance=address)
+        if len(errors) == len(self.clients):
+            raise RuntimeError("; ".join(errors))
+        return ""
+
+
+class MongoScraper:
+    """``serverStatus`` of Mongo."""
+
+    def __init__(self, uri, timeout):
+        import pymongo
+
+        self.client = pymongo.MongoClient(uri, serverSelectionTimeoutMS=int(timeout * 1000))
+
+    def scrape(self, metrics):
+        status = self.client.admin.command("serverStatus")
+        opcounters = status.get("opcounters") or {}
+        for operation in MONGO_OPCOUNTERS:
+            metrics.add(
+                "nbs_mongo_operations_total",
+                "counter",
+                "Operations since Mongo started",
+                int(opcounters.get(operation, 0)),
+                type=operation,
+            )
+        document = (status.get("metrics") or {}).get("document") or {}
+        for operation in ("inserted", "returned", "updated", "deleted"):
+            metrics.add(
+                "nbs_mongo_documents_total",
+                "counter",
+                "Documents by operation since Mongo started",
+                int(document.get(operation, 0)),
+                type=operation,
+            )
+        metrics.add(
+            "nbs_mongo_connections",
+            "gauge",
+            "Open client connections",
+            int((status.get("connections") or {}).get("current", 0)),
+        )
+        cache = (status.get("wiredTiger") or {}).get("cache") or {}
+        if cache:
+            metrics.add(
+                "nbs_mongo_cache_used_bytes",
+                "gauge",
+                "Data in the WiredTiger cache",
+                int(cache.get("bytes currently in the cache", 0)),
+            )
+            metrics.add(
+                "nbs_mongo_cache_max_bytes",
+                "gauge",
+                "Size of the WiredTiger cache",
+                int(cache.get("maximum bytes configured", 0)),
+            )
+        return ""
+
+
+class Exporter:
+    """Scrape the sources periodically and keep the latest result."""
+
+    def __init__(self, args):
+        self.args = args
+        self.scrapers = {}
+        self.errors = {}
+        self.text = ""
+        self.lock = threading.Lock()
+
+    def get_scraper(self, source):
+        """Create the scraper of a source on first use, so a missing client library only fails its source."""
+        if source not in self.scrapers:
+            args = self.args
+            if source == "zmq":
+                scraper = ZmqScraper(args.zmq_proxies, args.timeout)
+            elif source == "kafka":
+                kafka_config = load_kafka_config(args.kafka_config)
+                bootstrap_servers = args.bootstrap_servers or ",".join(
+                    kafka_config.get("bootstrap_servers") or ["kafka:29092"]
+                )
+                scraper = KafkaScraper(
+                    bootstrap_servers,
+                    kafka_config.get("consumer_config") or {},
+                    args.topics,
+                    args.ignore_groups,
+                    args.timeout,
+                )
+            elif source == "queueserver":
+                scraper = QueueserverScraper(args.qserver_address, args.timeout)
+            elif source == "redis":
+                scraper = RedisScraper(args.redis, args.timeout)
+            else:
+                scraper = MongoScraper(args.mongo_uri, args.timeout)
+            self.scrapers[source] = scraper
+        return self.scrapers[source]
+
+    def scrape(self):
+        metrics = Metrics()
+        passthrough = []
+        for source in self.args.sources:
+            start = time.monotonic()
+            try:
+                passthrough.append(self.get_scraper(source).scrape(metrics))
+                up = 1
+                if source in self.errors:
+                    log(f"{source} recovered")
+                    del self.errors[source]
+            except Exception as e:
+                up = 0
+                error = f"{type(e).__name__}: {e}"
+                if self.errors.get(source) != error:
+                    log(f"could not scrape {source}: {error}")
+                self.errors[source] = error
+            metrics.add(
+                "nbs_scrape_up", "gauge", "Whether the source was scraped", up, source=source
+            )
+            metrics.add(
+                "nbs_scrape_duration_seconds",
+                "gauge",
+                "Seconds the scrape of the source took",
+                f"{time.monotonic() - start:.3f}",
+                source=source,
+            )
+        metrics.add(
+            "nbs_scrape_timestamp_seconds", "gauge", "Time of the last scrape", f"{time.time():.3f}"
+        )
+        with self.lock:
+            self.text = metrics.render() + "".join(passthrough)
+
+    def render(self):
+        with self.lock:
+            return self.text
+
+
+def serve_metrics(exporter, port):
+    """Serve ``/metrics`` in a background thread."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = exporter.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("0.0.0.0", port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def run(args):
+    exporter = Exporter(args)
+    exporter.scrape()
+    serve_metrics(exporter, args.port)
+    log(f"serving {', '.join(args.sources)} on port {args.port}, every {args.interval:g} s")
+    while True:
+        time.sleep(args.interval)
+        exporter.scrape()
+
+
+def env_list(name, default):
+    return [item.strip() for item in env_default(name, default).split(",") if item.strip()]
+
+
+def main(argv=None):
+    acronym = os.getenv("NBS_BEAMLINE_ACRONYM", "nbs")
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=env_default("METRICS_PORT", 9464, int),
+        help="Port of the /metrics endpoint (METRICS_PORT)",
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=env_default("METRICS_INTERVAL", 5.0, float),
+        help="Seconds between scrapes (METRICS_INTERVAL)",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=env_default("METRICS_TIMEOUT", 2.0, float),
+        help="Seconds to wait for a source to answer (METRICS_TIMEOUT)",
+    )
+    parser.add_argument(
+        "--sources",
+        nargs="+",
+        choices=SOURCES,
+        default=env_list("METRICS_SOURCES", ",".join(SOURCES)),
+        help="Sources to scrape (METRICS_SOURCES, comma-separated)",
+    )
+    parser.add_argument(
+        "--zmq-proxies",
+        nargs="+",
+        default=env_list(
+            "METRICS_ZMQ_PROXIES", "http://zmq_proxy:9100/metrics,http://zmq_proxy2:9100/metrics"
+        ),
+        help="Metrics endpoints of the ZMQ proxies (METRICS_ZMQ_PROXIES, comma-separated)",
+    )
+    parser.add_argument(
+        "--topics",
+        nargs="+",
+        default=env_list("METRICS_KAFKA_TOPICS", f"{acronym}.bluesky.runengine.documents"),
+        help="Document topics (METRICS_KAFKA_TOPICS, comma-separated)",
+    )
+    parser.add_argument(
+        "--kafka-config",
+        default=env_default("METRICS_KAFKA_CONFIG", "/etc/bluesky/kafka.yml"),
+        help="bluesky Kafka configuration file (METRICS_KAFKA_CONFIG)",
+    )
+    parser.add_argument(
+        "--bootstrap-servers",
+        default=env_default("METRICS_KAFKA_BOOTSTRAP_SERVERS", None),
+        help="Kafka bootstrap servers (METRICS_KAFKA_BOOTSTRAP_SERVERS), "
+        "defaults to those of the Kafka configuration",
+    )
+    parser.add_argument(
+        "--ignore-groups",
+        nargs="*",
+        default=env_list("METRICS_KAFKA_IGNORE_GROUPS", "nbs-pods-bench-,nbs-pods-metrics"),
+        help="Prefixes of consumer groups not to report "
+        "(METRICS_KAFKA_IGNORE_GROUPS, comma-separated)",
+    )
+    parser.add_argument(
+        "--qserver-address",
+        default=env_default(
+            "METRICS_QSERVER_CONTROL_ADDRESS",
+            env_default("QSERVER_ZMQ_CONTROL_ADDRESS", "tcp://queueserver:60615"),
+        ),
+        help="Control address of the RE Manager (METRICS_QSERVER_CONTROL_ADDRESS)",
+    )
+    parser.add_argument(
+        "--redis",
+        nargs="+",
+        default=env_list("METRICS_REDIS", "redis:6379,redisInfo:60737"),
+        help="Redis servers as host:port (METRICS_REDIS, comma-separated)",
+    )
+    parser.add_argument(
+        "--mongo-uri",
+        default=env_default("METRICS_MONGO_URI", "mongodb://mongo:27017"),
+        help="Mongo server (METRICS_MONGO_URI)",
+    )
+    args = parser.parse_args(argv)
+    if args.interval <= 0 or args.timeout <= 0:
+        parser.error("interval and timeout must be positive")
+    try:
+        run(args)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    sys.exit(main())
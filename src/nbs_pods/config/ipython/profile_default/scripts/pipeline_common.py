@@ -0,0 +1,68 @@
+"""Helpers shared by the document pipeline scripts.
+
+``kafka-writer.py``, ``pipeline-bench.py`` and ``pipeline-metrics.py`` run
+from this directory, so they import this module directly.
+"""
+
+import os
+import sys
+
+
+def make_log(prefix, file=None):
+    """
+    Get a function that prints a message prefixed with the script's name.
+
+    Parameters
+    ----------
+    prefix : str
+        Name put before every message
+    file : file, optional
+        Stream to print to, default stdout
+
+    Returns
+    -------
+    callable
+        ``log(message)``
+    """
+
+    def log(message):
+        print(f"{prefix}: {message}", file=file, flush=True)
+
+    return log
+
+
+def env_default(name, default, convert=str):
+    """Get an environment variable converted with ``convert``, or ``default`` if unset or empty."""
+    value = os.getenv(name)
+    return default if value in (None, "") else convert(value)
+
+
+def load_kafka_config(path):
+    """Load the bluesky Kafka configuration, or an empty one if it is missing."""
+    import yaml
+
+    try:
+        with open(path, encoding="utf-8") as f:
+            return yaml.safe_load(f) or {}
+    except FileNotFoundError:
+        return {}
+
+
+def get_profile_uri(profile, profile_dir="/etc/tiled/profiles"):
+    """Get the Mongo URI of the first tree of a Tiled profile."""
+    import glob
+
+    import yaml
+
+    for path in sorted(glob.glob(os.path.join(profile_dir, "*.yml"))):
+        with open(path, encoding="utf-8") as f:
+            profiles = yaml.safe_load(f) or {}
+        if profile not in profiles:
+            continue
+        for settings in profiles[profile].values():
+            for tree in (settings or {}).get("trees") or []:
+                uri = (tree.get("args") or {}).get("uri", "")
+                if uri.startswith("mongodb://"):
+                    return uri
+    program = os.path.basename(sys.argv[0])
+    raise SystemExit(f"{program}: no Mongo tree in Tiled profile '{profile}' in {profile_dir}")
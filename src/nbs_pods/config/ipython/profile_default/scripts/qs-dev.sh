@@ -1,6 +1,5 @@
 #!/usr/bin/bash
 set -e
 set -o xtrace
-pip install -e /usr/local/src/xraygui/nbs-core
-pip install -e /usr/local/src/xraygui/nbs-bl
-$(dirname "$0")/qs-start.sh
\ No newline at end of file
+$(dirname "$0")/dev-install.sh /usr/local/src/xraygui/nbs-core /usr/local/src/xraygui/nbs-bl
+exec $(dirname "$0")/qs-start.sh
\ No newline at end of file
@@ -1,4 +1,4 @@
 #!/usr/bin/bash
 set -e
 set -o xtrace
-start-re-manager --redis-addr redis:6379 --zmq-publish-console ON --use-ipython-kernel ON --ipython-kernel-ip auto --startup-profile default
\ No newline at end of file
+exec start-re-manager --redis-addr redis:6379 ${QS_REDIS_NAME_PREFIX:+--redis-name-prefix "$QS_REDIS_NAME_PREFIX"} --zmq-publish-console ON --use-ipython-kernel ON --ipython-kernel-ip auto --startup-profile default
\ No newline at end of file
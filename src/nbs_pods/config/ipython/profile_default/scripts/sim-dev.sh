@@ -1,6 +1,5 @@
 #!/usr/bin/bash
 set -e
 set -o xtrace
-pip install git+https://github.com/cjtitus/caproto.git@no_macros
-pip install -e /usr/local/src/xraygui/nbs-sim
-$(dirname "$0")/sim-start.sh
\ No newline at end of file
+$(dirname "$0")/dev-install.sh /usr/local/src/xraygui/nbs-sim
+exec $(dirname "$0")/sim-start.sh
\ No newline at end of file
@@ -1,5 +1,5 @@
 #!/usr/bin/bash
 set -e
 set -o xtrace
-pip install -e /usr/local/src/xraygui/nbs-viewer
-$(dirname "$0")/viewer-start.sh
\ No newline at end of file
+$(dirname "$0")/dev-install.sh /usr/local/src/xraygui/nbs-viewer
+exec $(dirname "$0")/viewer-start.sh
\ No newline at end of file
@@ -1,4 +1,4 @@
 #!/usr/bin/bash
 set -e
 set -o xtrace
-nbs-viewer -f /usr/local/share/ipython/profile_default/startup/viewer_config.toml -d
\ No newline at end of file
+exec nbs-viewer -f /usr/local/share/ipython/profile_default/startup/viewer_config.toml -d
@@ -1,17 +1,40 @@
+import os
+import sys
+from types import SimpleNamespace
+
 import nslsii
+from databroker import Broker
 from nbs_bl.configuration import load_and_configure_everything
 from bluesky.plan_stubs import mv as _mv, mvr as _mvr
 
 load_and_configure_everything()
 
+# Set by nbs-pods to namespace the Kafka topic of a shared bluesky-services
+beamline_acronym = os.environ.get("NBS_BEAMLINE_ACRONYM", "nbs")
+
+# Broker (Tiled profile) name; in shared mode the profile is rewritten to
+# point at the beamline's own databases
+db = Broker.named("nbs")
+
+# configure_base subscribes the broker's insert to the RunEngine. When the
+# kafka-writer service stores the documents from Kafka, hand it a broker
+# that inserts nothing, so documents are not written twice and storage is
+# off the acquisition path.
+kafka_writer_enabled = os.environ.get("KAFKA_WRITER_ENABLED", "").lower() in ("1", "true", "yes", "on")
 nslsii.configure_base(
     get_ipython().user_ns,
-    "nbs",
-    publish_documents_with_kafka=True,
+    SimpleNamespace(insert=lambda name, doc: None) if kafka_writer_enabled else db,
+    # Published below, keyed by run uid instead of by session
+    publish_documents_with_kafka=False,
     bec=False,
     pbar=False,
 )
 
+sys.path.insert(0, "/opt/nbs-pods/scripts")
+from kafka_publisher import subscribe_kafka_publisher  # noqa: E402
+
+kafka_publisher, _ = subscribe_kafka_publisher(RE, beamline_acronym)
+
 
 def mv(*args, group=None, **kwargs):
     yield from _mv(*args, group=group, **kwargs)
@@ -0,0 +1,73 @@
+// Create the indexes that databroker's mongo_normalized tree (and Tiled's
+// search on it) relies on, so queries do not scan whole collections.
+//
+// Run by the mongo-init container of bluesky-services with mongosh. Indexes
+// are created in every database named in MONGO_INDEX_DATABASES and in every
+// existing database with a run_start collection. MONGO_INDEX_FIELDS lists
+// additional start document fields to index, e.g.
+// "proposal.proposal_id,sample_name". Creating an index that exists is a
+// no-op, so this runs on every start.
+
+const INDEXES = {
+  run_start: [
+    [{ uid: 1 }, { unique: true }],
+    [{ time: -1 }, {}],
+    [{ scan_id: -1 }, {}],
+  ],
+  run_stop: [
+    [{ uid: 1 }, { unique: true }],
+    [{ run_start: 1 }, {}],
+  ],
+  event_descriptor: [
+    [{ uid: 1 }, { unique: true }],
+    [{ run_start: 1, time: 1 }, {}],
+  ],
+  event: [
+    [{ uid: 1 }, { unique: true }],
+    [{ descriptor: 1, seq_num: 1 }, {}],
+    [{ descriptor: 1, time: 1 }, {}],
+  ],
+  resource: [
+    [{ uid: 1 }, { unique: true }],
+    [{ run_start: 1 }, {}],
+  ],
+  datum: [
+    [{ datum_id: 1 }, { unique: true }],
+    [{ resource: 1 }, {}],
+  ],
+};
+
+function split(value) {
+  return (value || "").split(",").map((s) => s.trim()).filter((s) => s);
+}
+
+const databases = new Set(split(process.env.MONGO_INDEX_DATABASES));
+for (const info of db.adminCommand({ listDatabases: 1 }).databases) {
+  if (db.getSiblingDB(info.name).getCollectionNames().includes("run_start")) {
+    databases.add(info.name);
+  }
+}
+
+const runStartIndexes = INDEXES.run_start.concat(
+  split(process.env.MONGO_INDEX_FIELDS).map((field) => [{ [field]: 1 }, {}])
+);
+
+let failed = 0;
+for (const name of databases) {
+  const database = db.getSiblingDB(name);
+  for (const [collection, indexes] of Object.entries(INDEXES)) {
+    for (const [keys, options] of collection === "run_start" ? runStartIndexes : indexes) {
+      try {
+        database.getCollection(collection).createIndex(keys, options);
+      } catch (e) {
+        // e.g. a unique index over documents stored twice
+        print(`${name}.${collection} ${JSON.stringify(keys)}: ${e.message}`);
+        failed += 1;
+      }
+    }
+  }
+  print(`Indexed ${name}`);
+}
+if (failed) {
+  quit(1);
+}
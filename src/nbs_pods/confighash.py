@@ -0,0 +1,186 @@
+"""Per-container configuration hashes for incremental restarts.
+
+Every container started by nbs-pods is labelled with a hash of its merged,
+interpolated compose definition and of the configuration files it
+bind-mounts from a ``config/`` directory. On restart, only containers whose
+hash changed are recreated.
+"""
+
+import fnmatch
+import json
+import os
+
+from nbs_pods.compose import interpolate, load_compose_chain
+from nbs_pods.config import (
+    get_beamline_pods_dir,
+    get_cache_dir,
+    get_nbs_pods_dir,
+    get_shared_state_dir,
+    write_json,
+)
+from nbs_pods.shared import is_shared_mode
+
+CONFIG_HASH_LABEL = "io.nbs-pods.config-hash"
+# Files written at runtime into mounted config directories, e.g. by the RE
+# Manager and IPython kernel in IPYTHONDIR; they are not configuration, and
+# hashing them would recreate the container on every restart
+RUNTIME_DIRS = {".pixi", "__pycache__", ".ipynb_checkpoints", "security", "pid", "log", "db"}
+RUNTIME_FILES = (
+    "*.sqlite",
+    "*.sqlite-journal",
+    "*.sqlite-wal",
+    "*.sqlite-shm",
+    "*.pyc",
+    "*.tmp",
+    "existing_plans_and_devices.yaml",
+)
+
+
+def get_config_roots():
+    """
+    Get the directories whose bind-mounted contents are part of the hash.
+
+    Returns
+    -------
+    list[str]
+        ``config/`` of the beamline pods directory and of nbs-pods, and in
+        multi-beamline mode the generated shared configuration
+    """
+    roots = {str(get_beamline_pods_dir() / "config"), str(get_nbs_pods_dir() / "config")}
+    if is_shared_mode():
+        roots.add(str(get_shared_state_dir()))
+    return sorted(roots)
+
+
+def _get_bind_sources(definition):
+    """Get the host paths a compose service definition bind-mounts."""
+    sources = []
+    for volume in definition.get("volumes") or []:
+        if isinstance(volume, dict):
+            if volume.get("type", "volume") == "bind" and volume.get("source"):
+                sources.append(volume["source"])
+        else:
+            source, sep, _ = str(volume).partition(":")
+            if sep and source.startswith("/"):
+                sources.append(source)
+    env_file = definition.get("env_file") or []
+    sources.extend([env_file] if isinstance(env_file, str) else env_file)
+    return sources
+
+
+def _hash_path(digest, path):
+    """
+    Feed the names and contents of a file or directory tree to a digest.
+
+    Files and directories in a tree that match RUNTIME_FILES and
+    RUNTIME_DIRS are skipped; a file mounted by itself is always hashed.
+    """
+    if os.path.isfile(path):
+        digest.update(path.encode() + b"\0")
+        with open(path, "rb") as f:
+            digest.update(f.read())
+        return
+    for root, dirs, files in os.walk(path):
+        dirs[:] = sorted(name for name in dirs if name not in RUNTIME_DIRS)
+        for name in sorted(files):
+            if not any(fnmatch.fnmatch(name, pattern) for pattern in RUNTIME_FILES):
+                _hash_path(digest, os.path.join(root, name))
+
+
+def hash_service_definition(definition, config_roots):
+    """
+    Hash a compose service definition and the config files it mounts.
+
+    Parameters
+    ----------
+    definition : dict
+        Interpolated compose service definition
+    config_roots : list[str]
+        Only bind mounts inside these directories are hashed by content;
+        other mounts (data directories, source trees) only by path
+
+    Returns
+    -------
+    str
+        Hex digest
+    """
+    import hashlib
+
+    digest = hashlib.sha256(json.dumps(definition, sort_keys=True, default=str).encode())
+    for source in _get_bind_sources(definition):
+        source = os.path.realpath(source)
+        if any(source == root or source.startswith(root + os.sep) for root in config_roots):
+            _hash_path(digest, source)
+    return digest.hexdigest()
+
+
+def compute_config_hashes(compose_file_string, env):
+    """
+    Compute the configuration hash of every container in a compose chain.
+
+    Parameters
+    ----------
+    compose_file_string : str
+        Colon-separated compose file chain
+    env : dict
+        Environment used for variable interpolation
+
+    Returns
+    -------
+    dict[str, str]
+        Mapping of compose service name to hash
+    """
+    compose_doc = interpolate(load_compose_chain(compose_file_string), env)
+    config_roots = [os.path.realpath(root) for root in get_config_roots()]
+    return {
+        name: hash_service_definition(definition, config_roots)
+        for name, definition in (compose_doc.get("services") or {}).items()
+    }
+
+
+def write_hash_override(service, hashes):
+    """
+    Write a compose override that labels each container with its hash.
+
+    Parameters
+    ----------
+    service : str
+        nbs-pods service name
+    hashes : dict[str, str]
+        Mapping of compose service name to hash
+
+    Returns
+    -------
+    Path
+        Path to the override file, to be appended to the compose chain
+    """
+    override = {
+        "services": {
+            name: {"labels": {CONFIG_HASH_LABEL: value}} for name, value in hashes.items()
+        }
+    }
+    return write_json(get_cache_dir() / "config-hash" / f"{service}.yml", override)
+
+
+def get_changed_containers(hashes, running_labels):
+    """
+    Find the containers that have to be recreated.
+
+    Parameters
+    ----------
+    hashes : dict[str, str]
+        Mapping of compose service name to its current hash
+    running_labels : dict[str, dict]
+        Mapping of compose service name to the labels of its existing
+        container
+
+    Returns
+    -------
+    list[str]
+        Compose service names that are missing or whose hash changed
+    """
+    return [
+        name
+        for name, value in hashes.items()
+        if (running_labels.get(name) or {}).get(CONFIG_HASH_LABEL) != value
+    ]
@@ -0,0 +1,285 @@
+"""Cached index of compose files for service discovery and resolution.
+
+The index records which ``docker-compose*.yml`` files exist in every service
+directory of the nbs-pods and beamline pods compose trees, so resolving a
+service's compose chain is a dictionary lookup instead of a cascade of
+filesystem probes. It is persisted in the cache directory and rebuilt when
+the modification time of any scanned directory changes, which happens
+whenever a compose file is added, removed or renamed.
+"""
+
+import json
+import os
+import zlib
+
+from nbs_pods.config import (
+    get_beamline_pods_dir,
+    get_cache_dir,
+    get_nbs_pods_dir,
+    write_json,
+)
+
+INDEX_VERSION = 1
+
+# Fallback when the nbs-pods compose directory is missing
+BASE_SERVICES = [
+    "bluesky-services",
+    "queueserver",
+    "gui",
+    "sim",
+    "viewer",
+]
+
+_indexes = {}
+
+
+def _scan_compose_dir(compose_dir, mtimes):
+    """
+    List the compose files in every service directory of a compose tree.
+
+    Parameters
+    ----------
+    compose_dir : str
+        Compose directory to scan
+    mtimes : dict[str, int]
+        Updated with the modification time of every scanned directory
+
+    Returns
+    -------
+    dict[str, list[str]]
+        Mapping of service directory name to its compose file names
+    """
+    services = {}
+    try:
+        mtimes[compose_dir] = os.stat(compose_dir).st_mtime_ns
+        entries = list(os.scandir(compose_dir))
+    except FileNotFoundError:
+        mtimes[compose_dir] = None
+        return services
+
+    for entry in entries:
+        if not entry.is_dir():
+            continue
+        mtimes[entry.path] = entry.stat().st_mtime_ns
+        services[entry.name] = sorted(
+            name
+            for name in os.listdir(entry.path)
+            if name.startswith("docker-compose") and name.endswith(".yml")
+        )
+    return services
+
+
+def build_index(beamline_pods_dir, nbs_pods_dir):
+    """
+    Build the compose index with one scan of both compose trees.
+
+    Parameters
+    ----------
+    beamline_pods_dir : Path
+        Beamline pods directory
+    nbs_pods_dir : Path
+        nbs-pods package directory
+
+    Returns
+    -------
+    dict
+        Index with the scanned files and directory modification times
+    """
+    mtimes = {}
+    nbs_compose_dir = str(nbs_pods_dir / "compose")
+    beamline_compose_dir = str(beamline_pods_dir / "compose")
+
+    index = {
+        "version": INDEX_VERSION,
+        "beamline_pods_dir": str(beamline_pods_dir),
+        "nbs_pods_dir": str(nbs_pods_dir),
+        "nbs": _scan_compose_dir(nbs_compose_dir, mtimes),
+        "beamline": {},
+        "beamline_subdir": {},
+    }
+    if beamline_pods_dir != nbs_pods_dir:
+        index["beamline"] = _scan_compose_dir(beamline_compose_dir, mtimes)
+        if "beamline" in index["beamline"]:
+            index["beamline_subdir"] = _scan_compose_dir(
+                os.path.join(beamline_compose_dir, "beamline"), mtimes
+            )
+    index["mtimes"] = mtimes
+    return index
+
+
+def _is_current(index):
+    """Check that no directory in the index changed since it was built."""
+    for path, mtime in index["mtimes"].items():
+        try:
+            if os.stat(path).st_mtime_ns != mtime:
+                return False
+        except FileNotFoundError:
+            if mtime is not None:
+                return False
+    return True
+
+
+def _get_index_file(beamline_pods_dir, nbs_pods_dir):
+    key = zlib.crc32(f"{beamline_pods_dir}:{nbs_pods_dir}".encode())
+    return get_cache_dir() / f"compose-index-{key:08x}.json"
+
+
+def get_index():
+    """
+    Get the compose index for the current beamline and nbs-pods directories.
+
+    The index is loaded from the cache file if it is still current,
+    otherwise rebuilt and written back. It is validated once per process.
+
+    Returns
+    -------
+    dict
+        Compose index
+    """
+    beamline_pods_dir = get_beamline_pods_dir()
+    nbs_pods_dir = get_nbs_pods_dir()
+    key = (str(beamline_pods_dir), str(nbs_pods_dir))
+    if key in _indexes:
+        return _indexes[key]
+
+    index_file = _get_index_file(beamline_pods_dir, nbs_pods_dir)
+    index = None
+    try:
+        with open(index_file, encoding="utf-8") as f:
+            index = json.load(f)
+        if (
+            index.get("version") != INDEX_VERSION
+            or index.get("beamline_pods_dir") != key[0]
+            or index.get("nbs_pods_dir") != key[1]
+            or not _is_current(index)
+        ):
+            index = None
+    except (OSError, ValueError):
+        index = None
+
+    if index is None:
+        index = build_index(beamline_pods_dir, nbs_pods_dir)
+        try:
+            write_json(index_file, index, indent=None)
+        except OSError:
+            # The cache is an optimization; a read-only cache dir is fine
+            pass
+
+    _indexes[key] = index
+    return index
+
+
+def resolve_compose_file(service, file_name, index=None):
+    """
+    Find the winning compose file for a service, beamline before nbs-pods.
+
+    Parameters
+    ----------
+    service : str
+        Service name
+    file_name : str
+        Compose file name, e.g. ``docker-compose.override.yml``
+    index : dict, optional
+        Compose index, defaults to ``get_index()``
+
+    Returns
+    -------
+    str | None
+        Path to the compose file, or None if neither tree has it
+    """
+    if index is None:
+        index = get_index()
+    if file_name in index["beamline"].get(service, []):
+        return os.path.join(index["beamline_pods_dir"], "compose", service, file_name)
+    if file_name in index["nbs"].get(service, []):
+        return os.path.join(index["nbs_pods_dir"], "compose", service, file_name)
+    return None
+
+
+def get_base_file_name(service, gui_services, display_protocol):
+    """
+    Get the name of the base compose file that wins for a service.
+
+    Parameters
+    ----------
+    service : str
+        Service name
+    gui_services : list[str]
+        Services with display protocol specific compose files
+    display_protocol : str
+        'wayland' or 'x11'
+
+    Returns
+    -------
+    str | None
+        Compose file name, or None if no base file exists
+    """
+    index = get_index()
+    if service in gui_services:
+        file_name = f"docker-compose.{display_protocol}.yml"
+        if resolve_compose_file(service, file_name, index):
+            return file_name
+    if resolve_compose_file(service, "docker-compose.yml", index):
+        return "docker-compose.yml"
+    return None
+
+
+def get_base_services():
+    """
+    Get the services provided by nbs-pods.
+
+    Returns
+    -------
+    list[str]
+        Sorted service names
+    """
+    index = get_index()
+    services = sorted(name for name, files in index["nbs"].items() if files)
+    return services if services else list(BASE_SERVICES)
+
+
+def get_beamline_services():
+    """
+    Get the services only provided by the beamline pods directory.
+
+    Returns
+    -------
+    list[str]
+        Sorted service names
+    """
+    index = get_index()
+    if index["beamline_pods_dir"] == index["nbs_pods_dir"]:
+        return []
+
+    base_services = set(get_base_services())
+    services = [
+        name
+        for name, files in index["beamline"].items()
+        if files and name not in base_services
+    ]
+    for name, files in index["beamline_subdir"].items():
+        if "docker-compose.yml" in files and name not in services:
+            services.append(name)
+    return sorted(services)
+
+
+def get_gui_services():
+    """
+    Get the services with display protocol specific compose files.
+
+    Returns
+    -------
+    list[str]
+        Sorted service names
+    """
+    index = get_index()
+    if index["beamline_pods_dir"] == index["nbs_pods_dir"]:
+        return []
+
+    services = ["gui", "viewer"]
+    for name, files in index["beamline"].items():
+        if name in services:
+            continue
+        if "docker-compose.x11.yml" in files or "docker-compose.wayland.yml" in files:
+            services.append(name)
+    return sorted(services)
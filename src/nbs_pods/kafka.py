@@ -0,0 +1,253 @@
+"""Kafka profiles: producer, consumer and broker settings as an override layer.
+
+Presets are read from ``kafka-profiles.yml`` in the beamline pods directory
+and from the defaults shipped in nbs-pods' ``config/kafka-profiles.yml``; a
+beamline preset replaces a shipped preset of the same name. A preset sets
+librdkafka properties of the RunEngine's producer and of consumers, and
+server properties of the broker::
+
+    profile: high-throughput    # active preset, unless NBS_PODS_KAFKA_PROFILE is set
+    presets:
+      high-throughput:
+        producer:
+          compression.type: lz4
+          linger.ms: 20
+        consumer:
+          fetch.max.bytes: 67108864
+        broker:
+          message.max.bytes: 16777216
+        max_message_bytes: 16777216
+        partitions: 4
+
+``max_message_bytes`` sets the largest document that can be published
+consistently on the producer, the broker and its replica fetchers, and the
+consumers, so a large EventPage is not accepted by one and rejected by
+another. ``partitions`` sets the partition count of the document topic,
+which bounds how many consumers of one group (e.g. kafka-writer replicas)
+read it in parallel; NBS_KAFKA_PARTITIONS overrides it. Partitions are
+only ever added to an existing topic, never removed.
+
+The producer and consumer settings are merged into a generated copy of
+``kafka.yml``, which is mounted at ``/etc/bluesky/kafka.yml`` in every
+service on the bluesky-services network; the broker settings become
+``KAFKA_CFG_*`` environment variables of the ``kafka`` container.
+"""
+
+import os
+
+from nbs_pods.config import (
+    get_beamline_pods_dir,
+    get_cache_dir,
+    get_nbs_pods_dir,
+    load_profile_files,
+    write_json,
+)
+
+KAFKA_KEY = "kafka"
+KAFKA_PROFILE_ENV = "NBS_PODS_KAFKA_PROFILE"
+KAFKA_PARTITIONS_ENV = "NBS_KAFKA_PARTITIONS"
+KAFKA_CONTAINER = "kafka"
+KAFKA_SETUP_CONTAINER = "kafka-setup"
+KAFKA_CONFIG_TARGET = "/etc/bluesky/kafka.yml"
+# Network key of the services that talk to the broker
+KAFKA_NETWORK = "bluesky-services_bluesky"
+PROFILE_SECTIONS = ("producer", "consumer", "broker", "max_message_bytes", "partitions")
+
+
+def load_kafka_profiles():
+    """
+    Load the Kafka presets and the configured active preset.
+
+    Returns
+    -------
+    tuple[dict, str | None]
+        (presets, active), see ``load_profile_files``
+    """
+    return load_profile_files("kafka-profiles.yml", "Kafka")
+
+
+def get_active_kafka_profile():
+    """
+    Get the Kafka preset to apply.
+
+    Returns
+    -------
+    dict | None
+        Settings of the preset named by NBS_PODS_KAFKA_PROFILE, or by the
+        ``profile`` of the profile files; None if no preset (or 'none') is
+        selected
+
+    Raises
+    ------
+    RuntimeError
+        If the preset does not exist or has unknown sections
+    """
+    presets, profile = load_kafka_profiles()
+    profile = os.getenv(KAFKA_PROFILE_ENV, profile)
+    if not profile or profile == "none":
+        return None
+    if profile not in presets:
+        raise RuntimeError(
+            f"Unknown Kafka profile '{profile}'; available: {', '.join(presets) or 'none'}"
+        )
+    settings = presets[profile] or {}
+    unknown = set(settings) - set(PROFILE_SECTIONS)
+    if unknown:
+        raise RuntimeError(
+            f"Unknown section {', '.join(sorted(unknown))} in Kafka profile '{profile}'; "
+            f"use {', '.join(PROFILE_SECTIONS)}"
+        )
+    return settings
+
+
+def get_client_settings(settings):
+    """
+    Get the librdkafka properties of the producer and consumers.
+
+    Parameters
+    ----------
+    settings : dict
+        Preset from ``get_active_kafka_profile``
+
+    Returns
+    -------
+    tuple[dict, dict]
+        (producer, consumer) properties
+    """
+    producer = dict(settings.get("producer") or {})
+    consumer = dict(settings.get("consumer") or {})
+    max_bytes = settings.get("max_message_bytes")
+    if max_bytes:
+        producer.setdefault("message.max.bytes", int(max_bytes))
+        # A consumer must be able to fetch the largest message in one go
+        consumer.setdefault("fetch.max.bytes", max(int(max_bytes), 52428800))
+        consumer.setdefault("max.partition.fetch.bytes", int(max_bytes))
+    return producer, consumer
+
+
+def get_topic_partitions(settings=None):
+    """
+    Get the partition count of the document topic.
+
+    Parameters
+    ----------
+    settings : dict, optional
+        Preset from ``get_active_kafka_profile``
+
+    Returns
+    -------
+    int
+        NBS_KAFKA_PARTITIONS if set, else the preset's ``partitions``, else 1
+
+    Raises
+    ------
+    RuntimeError
+        If the partition count is not a positive integer
+    """
+    value = os.getenv(KAFKA_PARTITIONS_ENV) or (settings or {}).get("partitions") or 1
+    try:
+        partitions = int(value)
+    except (TypeError, ValueError):
+        partitions = 0
+    if partitions < 1:
+        raise RuntimeError(f"Kafka partition count must be a positive integer, not '{value}'")
+    return partitions
+
+
+def get_broker_environment(settings):
+    """
+    Get the broker container environment of a preset.
+
+    Server properties become bitnami ``KAFKA_CFG_*`` variables, e.g.
+    ``message.max.bytes`` becomes ``KAFKA_CFG_MESSAGE_MAX_BYTES``.
+
+    Parameters
+    ----------
+    settings : dict
+        Preset from ``get_active_kafka_profile``
+
+    Returns
+    -------
+    dict[str, str]
+        Environment variables
+    """
+    broker = dict(settings.get("broker") or {})
+    max_bytes = settings.get("max_message_bytes")
+    if max_bytes:
+        broker.setdefault("message.max.bytes", int(max_bytes))
+        broker.setdefault("replica.fetch.max.bytes", int(max_bytes))
+    if settings.get("partitions"):
+        # Topics created on first use get as many partitions
+        broker.setdefault("num.partitions", get_topic_partitions(settings))
+    return {
+        "KAFKA_CFG_" + key.upper().replace(".", "_").replace("-", "_"): str(value)
+        for key, value in broker.items()
+    }
+
+
+def write_kafka_config(producer, consumer):
+    """
+    Write the beamline's ``kafka.yml`` with the profile's client settings.
+
+    The beamline's ``config/bluesky/kafka.yml`` is used as the base if it
+    exists, otherwise nbs-pods' own.
+
+    Returns
+    -------
+    Path
+        Path to the generated file
+    """
+    import yaml
+
+    base_file = get_beamline_pods_dir() / "config" / "bluesky" / "kafka.yml"
+    if not base_file.is_file():
+        base_file = get_nbs_pods_dir() / "config" / "bluesky" / "kafka.yml"
+    with open(base_file, encoding="utf-8") as f:
+        config = yaml.safe_load(f) or {}
+    config["runengine_producer_config"] = dict(config.get("runengine_producer_config") or {}, **producer)
+    config["consumer_config"] = dict(config.get("consumer_config") or {}, **consumer)
+    return write_json(get_cache_dir() / KAFKA_KEY / "kafka.yml", config)
+
+
+def write_kafka_override(service, compose_file_string):
+    """
+    Write the Kafka profile override layer of a service.
+
+    Parameters
+    ----------
+    service : str
+        nbs-pods service name
+    compose_file_string : str
+        Colon-separated compose file chain the layer is chained after
+
+    Returns
+    -------
+    Path | None
+        Path to the override file, or None if no preset is active or the
+        service neither runs the broker nor uses it
+    """
+    settings = get_active_kafka_profile()
+    if settings is None:
+        return None
+    from nbs_pods.compose import load_compose_chain
+
+    compose_doc = load_compose_chain(compose_file_string)
+    containers = compose_doc.get("services") or {}
+    services = {}
+    if KAFKA_CONTAINER in containers:
+        environment = get_broker_environment(settings)
+        if environment:
+            services[KAFKA_CONTAINER] = {
+                "environment": [f"{key}={value}" for key, value in environment.items()]
+            }
+    if KAFKA_SETUP_CONTAINER in containers and settings.get("partitions"):
+        services[KAFKA_SETUP_CONTAINER] = {
+            "environment": [f"{KAFKA_PARTITIONS_ENV}={get_topic_partitions(settings)}"]
+        }
+    if KAFKA_NETWORK in (compose_doc.get("networks") or {}):
+        config_file = write_kafka_config(*get_client_settings(settings))
+        for name in containers:
+            services[name] = {"volumes": [f"{config_file}:{KAFKA_CONFIG_TARGET}:ro"]}
+    if not services:
+        return None
+    return write_json(get_cache_dir() / KAFKA_KEY / f"{service}.yml", {"services": services})
@@ -0,0 +1,676 @@
+"""Container logs of services, for ``nbs-pods logs``.
+
+Logs are read with ``podman logs --timestamps``, one process per container,
+all driven by one asyncio event loop; output is read in large chunks and
+written in batches, so a chatty container (e.g. the queueserver console)
+costs little. Every line read is also appended to a bounded log of the
+service in the nbs-pods state directory, which ``nbs-pods stop`` fills up
+before it removes the containers, so the logs of a failed start or test
+run survive ``down``. The log of a service keeps up to
+``NBS_PODS_LOG_BUFFER_MB`` megabytes (default 16) in two segments: when the
+current segment reaches half of that, it replaces the previous one.
+"""
+
+import fcntl
+import heapq
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+
+from nbs_pods.config import get_state_dir, write_json
+from nbs_pods.podman import PROJECT_LABEL
+from nbs_pods.stack import SERVICE_LABEL as STACK_SERVICE_LABEL
+
+LOGS_KEY = "logs"
+LOG_BUFFER_ENV = "NBS_PODS_LOG_BUFFER_MB"
+DEFAULT_LOG_BUFFER_MB = 16
+LEVELS = ("debug", "info", "warning", "error", "critical")
+# Seconds between batched writes while following
+FLUSH_INTERVAL = 0.2
+# Entries read before they are written, when not following
+MAX_PENDING = 10000
+READ_SIZE = 64 * 1024
+COLORS = (36, 33, 32, 35, 34, 91, 96, 93)
+
+_TIMESTAMP_RE = re.compile(
+    r"^(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(?:\.(\d+))?(Z|[+-]\d\d:?\d\d)? "
+)
+_LEVEL_RE = re.compile(r"\b(DEBUG|INFO|WARN|WARNING|ERROR|CRITICAL|FATAL|Traceback)\b")
+_LEVEL_NAMES = {"WARN": "warning", "FATAL": "critical", "Traceback": "error"}
+_DURATION_RE = re.compile(r"^(\d+(?:\.\d+)?)([smhd])$")
+_DURATION_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+
+def get_log_dir():
+    """
+    Get the directory of the services' logs.
+
+    Returns
+    -------
+    Path
+        ``logs`` in the beamline's nbs-pods state directory (created if missing)
+    """
+    log_dir = get_state_dir() / LOGS_KEY
+    log_dir.mkdir(exist_ok=True)
+    return log_dir
+
+
+def get_buffer_size():
+    """
+    Get the size of a service's log.
+
+    Returns
+    -------
+    int
+        Bytes, from NBS_PODS_LOG_BUFFER_MB
+
+    Raises
+    ------
+    RuntimeError
+        If NBS_PODS_LOG_BUFFER_MB is not a positive number
+    """
+    value = os.getenv(LOG_BUFFER_ENV, str(DEFAULT_LOG_BUFFER_MB))
+    try:
+        size = float(value)
+    except ValueError:
+        size = 0
+    if size <= 0:
+        raise RuntimeError(f"{LOG_BUFFER_ENV} must be a positive number of megabytes, not '{value}'")
+    return int(size * 1024 * 1024)
+
+
+def parse_timestamp(text):
+    """
+    Parse the RFC 3339 timestamp ``podman logs --timestamps`` puts before a line.
+
+    Parameters
+    ----------
+    text : str
+        Log line with its timestamp
+
+    Returns
+    -------
+    tuple[float, str] | None
+        (Unix time, rest of the line), or None if the line has no timestamp
+    """
+    match = _TIMESTAMP_RE.match(text)
+    if not match:
+        return None
+    seconds, fraction, zone = match.groups()
+    zone = "+00:00" if zone in (None, "Z") else zone
+    try:
+        moment = datetime.fromisoformat(seconds + zone).timestamp()
+    except ValueError:
+        return None
+    if fraction:
+        moment += float(f"0.{fraction}")
+    return moment, text[match.end():]
+
+
+def parse_time(value, now=None):
+    """
+    Parse a point in time given as a duration before now or as a date.
+
+    Parameters
+    ----------
+    value : str
+        Duration such as ``30s``, ``10m``, ``2h`` or ``1d``, or an ISO 8601
+        date and time in local time unless it has a zone
+    now : float, optional
+        Unix time durations are taken back from, defaults to now
+
+    Returns
+    -------
+    float
+        Unix time
+
+    Raises
+    ------
+    RuntimeError
+        If the value is neither
+    """
+    match = _DURATION_RE.match(value.strip())
+    if match:
+        now = time.time() if now is None else now
+        return now - float(match.group(1)) * _DURATION_UNITS[match.group(2)]
+    try:
+        return datetime.fromisoformat(value.strip()).timestamp()
+    except ValueError:
+        raise RuntimeError(
+            f"Invalid time '{value}'; use a duration such as 10m or a date such as 2024-05-01T14:00"
+        )
+
+
+def detect_level(message):
+    """Get the level of a log line from the first level name in it, if any."""
+    match = _LEVEL_RE.search(message)
+    if not match:
+        return None
+    return _LEVEL_NAMES.get(match.group(1), match.group(1).lower())
+
+
+class LogBuffer:
+    """Bounded on-disk log of one service, in two segments."""
+
+    def __init__(self, service, max_bytes=None):
+        log_dir = get_log_dir()
+        self.service = service
+        self.max_bytes = max_bytes or get_buffer_size()
+        self.path = log_dir / f"{service}.log"
+        self.previous_path = log_dir / f"{service}.log.1"
+        self.cursor_path = log_dir / f"{service}.json"
+        self.lock_path = log_dir / f"{service}.lock"
+
+    @contextmanager
+    def lock(self):
+        """Hold the lock serializing writers of the log, e.g. ``logs -f`` and ``stop``."""
+        with open(self.lock_path, "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def get_cursors(self):
+        """
+        Get the time of the last line kept of every container.
+
+        Returns
+        -------
+        dict[str, float]
+            Mapping of container name to Unix time
+        """
+        try:
+            with open(self.cursor_path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def append(self, entries):
+        """
+        Append log lines that are newer than the ones kept.
+
+        Parameters
+        ----------
+        entries : list[tuple[float, str, str]]
+            (Unix time, container, message) of each line
+
+        Returns
+        -------
+        list[tuple[float, str, str]]
+            The lines appended
+        """
+        if not entries:
+            return []
+        with self.lock():
+            cursors = self.get_cursors()
+            kept = [entry for entry in entries if entry[0] > cursors.get(entry[1], 0)]
+            if not kept:
+                return []
+            lines = [f"{moment:.6f}\t{container}\t{message}\n" for moment, container, message in kept]
+            # A batch larger than a segment keeps only its newest lines
+            size = 0
+            first = len(lines)
+            while first and size + len(lines[first - 1]) <= self.max_bytes // 2:
+                first -= 1
+                size += len(lines[first])
+            with open(self.path, "a", encoding="utf-8", errors="replace") as f:
+                f.writelines(lines[first:])
+                size = f.tell()
+            if size >= self.max_bytes // 2:
+                os.replace(self.path, self.previous_path)
+            for moment, container, _ in kept:
+                if moment > cursors.get(container, 0):
+                    cursors[container] = moment
+            write_json(self.cursor_path, cursors, indent=None)
+        return kept
+
+    def read(self):
+        """
+        Read the lines kept, oldest first.
+
+        Yields
+        ------
+        tuple[float, str, str]
+            (Unix time, container, message)
+        """
+        for path in (self.previous_path, self.path):
+            try:
+                f = open(path, encoding="utf-8", errors="replace")
+            except FileNotFoundError:
+                continue
+            with f:
+                for line in f:
+                    moment, _, rest = line.rstrip("\n").partition("\t")
+                    container, _, message = rest.partition("\t")
+                    try:
+                        yield float(moment), container, message
+                    except ValueError:
+                        continue
+
+
+def get_service_containers(services):
+    """
+    Get the containers of services, including those that are not running.
+
+    Containers are mapped to services by their compose project, using the
+    compose chains recorded when the services were started, or by the
+    stack service label in whole-stack mode.
+
+    Parameters
+    ----------
+    services : list[str]
+        Service names
+
+    Returns
+    -------
+    dict[str, list[str]]
+        Mapping of service name to container names
+    """
+    from nbs_pods.monitor import get_service_projects
+
+    projects = get_service_projects(services)
+    command = ["podman", "ps", "-a", "--format", "json", "--filter", f"label={PROJECT_LABEL}"]
+    result = subprocess.run(command, capture_output=True, text=True)
+    containers = {service: [] for service in services}
+    if result.returncode != 0 or not result.stdout.strip():
+        return containers
+    for container in json.loads(result.stdout):
+        labels = container.get("Labels") or {}
+        names = container.get("Names") or []
+        service = labels.get(STACK_SERVICE_LABEL)
+        if service is None:
+            service = (projects.get(labels.get(PROJECT_LABEL)) or {}).get("service")
+        if service in containers and names:
+            containers[service].append(names[0])
+    return containers
+
+
+def get_first_line_time(container, since=None):
+    """
+    Get the time of the first line a container logged.
+
+    Only the first line is read; ``podman logs`` is stopped after it.
+
+    Parameters
+    ----------
+    container : str
+        Container name
+    since : float, optional
+        Unix time before which lines are ignored
+
+    Returns
+    -------
+    float | None
+        Unix time, or None if the container logged nothing or its logs
+        cannot be read
+    """
+    command = ["podman", "logs", "--timestamps"]
+    if since:
+        command += ["--since", f"{since:.6f}"]
+    command.append(container)
+    try:
+        process = subprocess.Popen(
+            command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+        )
+    except OSError:
+        return None
+    try:
+        for line in process.stdout:
+            parsed = parse_timestamp(line.decode("utf-8", "replace").rstrip("\r\n"))
+            if parsed is not None:
+                return parsed[0]
+        return None
+    finally:
+        process.kill()
+        process.wait()
+        process.stdout.close()
+
+
+def get_project_container_names(project):
+    """
+    Get the names of all containers of a compose project.
+
+    Parameters
+    ----------
+    project : str
+        Compose project name
+
+    Returns
+    -------
+    list[str]
+        Container names, including containers that are not running
+    """
+    command = [
+        "podman", "ps", "-a", "--format", "{{.Names}}",
+        "--filter", f"label={PROJECT_LABEL}={project}",
+    ]
+    result = subprocess.run(command, capture_output=True, text=True)
+    if result.returncode != 0:
+        return []
+    return result.stdout.split()
+
+
+class LogSink:
+    """Collect the lines read from the containers and write them in batches."""
+
+    def __init__(self, containers, show=None):
+        self.buffers = {service: LogBuffer(service) for service in containers}
+        self.services = {
+            container: service for service, names in containers.items() for container in names
+        }
+        self.pending = {service: [] for service in containers}
+        self.count = 0
+        self.appended = 0
+        self.show = show
+
+    def add(self, container, lines):
+        service = self.services[container]
+        pending = self.pending[service]
+        for line in lines:
+            parsed = parse_timestamp(line.decode("utf-8", "replace").rstrip("\r"))
+            if parsed is not None:
+                pending.append((parsed[0], container, parsed[1]))
+        self.count += len(lines)
+        if self.show is None and self.count >= MAX_PENDING:
+            self.flush()
+
+    def flush(self):
+        """Append the pending lines to the services' logs, and show the new ones."""
+        shown = []
+        for service, pending in self.pending.items():
+            if not pending:
+                continue
+            pending.sort()
+            kept = self.buffers[service].append(pending)
+            self.pending[service] = []
+            self.appended += len(kept)
+            if self.show is not None:
+                shown.extend((moment, service, container, message) for moment, container, message in kept)
+        self.count = 0
+        if shown:
+            shown.sort()
+            self.show(shown)
+
+
+async def _read_container(container, sink, since, follow):
+    import asyncio
+
+    command = ["podman", "logs", "--timestamps"]
+    if follow:
+        command.append("--follow")
+    if since:
+        command += ["--since", f"{since:.6f}"]
+    command.append(container)
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *command,
+            stdin=subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+        )
+    except OSError:
+        return
+    rest = b""
+    try:
+        while True:
+            chunk = await process.stdout.read(READ_SIZE)
+            if not chunk:
+                break
+            lines = (rest + chunk).split(b"\n")
+            rest = lines.pop()
+            sink.add(container, lines)
+        if rest:
+            sink.add(container, [rest])
+        await process.wait()
+    finally:
+        if process.returncode is None:
+            process.terminate()
+            await process.wait()
+
+
+async def _read_logs(sink, follow):
+    import asyncio
+
+    cursors = {}
+    for buffer in sink.buffers.values():
+        cursors.update(buffer.get_cursors())
+    readers = [
+        asyncio.ensure_future(_read_container(container, sink, cursors.get(container), follow))
+        for container in sink.services
+    ]
+    if not readers:
+        return
+    if not follow:
+        await asyncio.gather(*readers)
+        sink.flush()
+        return
+    try:
+        while not all(reader.done() for reader in readers):
+            await asyncio.sleep(FLUSH_INTERVAL)
+            sink.flush()
+    finally:
+        for reader in readers:
+            reader.cancel()
+        await asyncio.gather(*readers, return_exceptions=True)
+        sink.flush()
+
+
+def capture_logs(containers):
+    """
+    Append the lines the containers logged since the last capture to their services' logs.
+
+    Parameters
+    ----------
+    containers : dict[str, list[str]]
+        Mapping of service name to container names
+
+    Returns
+    -------
+    int
+        Lines appended; containers whose logs cannot be read are skipped
+    """
+    import asyncio
+
+    sink = LogSink(containers)
+    asyncio.run(_read_logs(sink, follow=False))
+    return sink.appended
+
+
+def capture_api_logs(containers):
+    """
+    Append the lines the containers logged since the last capture, read through the podman API.
+
+    Parameters
+    ----------
+    containers : dict[str, list[str]]
+        Mapping of service name to container names
+
+    Returns
+    -------
+    int
+        Lines appended; containers whose logs cannot be read are skipped
+    """
+    from nbs_pods.podman_api import PodmanAPIError, get_client
+
+    client = get_client()
+    sink = LogSink(containers)
+    cursors = {}
+    for buffer in sink.buffers.values():
+        cursors.update(buffer.get_cursors())
+    for container in sink.services:
+        try:
+            lines = client.container_logs(container, since=cursors.get(container))
+        except PodmanAPIError:
+            continue
+        sink.add(container, lines)
+    sink.flush()
+    return sink.appended
+
+
+def keep_logs(service, project, backend="compose"):
+    """
+    Keep the logs of a project's containers before they are removed.
+
+    Parameters
+    ----------
+    service : str
+        nbs-pods service name
+    project : str
+        Compose project of the service
+    backend : str
+        'compose' to read the logs with the podman CLI, 'api' to read them
+        through the podman REST API
+    """
+    try:
+        if backend == "api":
+            from nbs_pods.podman_api import get_client
+
+            names = [
+                container["Names"][0]
+                for container in get_client().list_containers({PROJECT_LABEL: project})
+                if container.get("Names")
+            ]
+            capture_api_logs({service: names})
+        else:
+            capture_logs({service: get_project_container_names(project)})
+    except (OSError, RuntimeError) as e:
+        print(f"Warning: could not keep the logs of {service}: {e}\n", end="", file=sys.stderr, flush=True)
+
+
+class LogFilter:
+    """Select log lines by time window, level and pattern."""
+
+    def __init__(self, pattern=None, level=None, since=None, until=None):
+        self.pattern = re.compile(pattern) if pattern else None
+        self.level = LEVELS.index(level) if level else None
+        self.since = since
+        self.until = until
+        # Level of the last line of each container; lines without a level
+        # (e.g. of a traceback) belong to the line before them
+        self.levels = {}
+
+    def matches(self, moment, container, message):
+        if self.level is not None:
+            level = detect_level(message) or self.levels.get(container)
+            self.levels[container] = level
+            if level is None or LEVELS.index(level) < self.level:
+                return False
+        if self.since is not None and moment < self.since:
+            return False
+        if self.until is not None and moment > self.until:
+            return False
+        return self.pattern is None or self.pattern.search(message) is not None
+
+
+class LogPrinter:
+    """Write log lines prefixed by their container, colored by service."""
+
+    def __init__(self, services, containers, color):
+        self.colors = {service: COLORS[i % len(COLORS)] for i, service in enumerate(services)}
+        self.width = max((len(name) for name in containers), default=0)
+        self.color = color
+
+    def format(self, service, container, message):
+        prefix = f"{container.ljust(self.width)} |"
+        if self.color:
+            prefix = f"\033[{self.colors.get(service, 0)}m{prefix}\033[0m"
+        return f"{prefix} {message}\n"
+
+    def write(self, lines):
+        sys.stdout.write("".join(lines))
+        sys.stdout.flush()
+
+
+def show_logs(services, follow=False, tail=None, pattern=None, level=None, since=None, until=None, color=None):
+    """
+    Print the logs of services, merged in time order, and optionally follow them.
+
+    The lines the running containers logged since the last capture are
+    appended to the services' logs first, so containers that were removed
+    by ``nbs-pods stop`` are shown as well.
+
+    Parameters
+    ----------
+    services : list[str]
+        Service names
+    follow : bool
+        Whether to keep printing new lines until interrupted
+    tail : int, optional
+        Number of matching lines to show of every service's past logs
+    pattern : str, optional
+        Regular expression lines must match
+    level : str, optional
+        Lowest level of the lines to show, one of ``LEVELS``
+    since, until : str, optional
+        Time window of the lines to show, as durations before now or dates
+    color : bool, optional
+        Whether to color the prefixes, defaults to whether stdout is a
+        terminal and NO_COLOR is not set
+
+    Raises
+    ------
+    RuntimeError
+        If an option is invalid
+    """
+    import asyncio
+
+    if follow and until:
+        raise RuntimeError("--until cannot be combined with --follow")
+    if tail is not None and tail < 0:
+        raise RuntimeError("--tail must not be negative")
+    try:
+        log_filter = LogFilter(
+            pattern,
+            level,
+            parse_time(since) if since else None,
+            parse_time(until) if until else None,
+        )
+    except re.error as e:
+        raise RuntimeError(f"Invalid pattern '{pattern}': {e}")
+    if color is None:
+        color = sys.stdout.isatty() and not os.getenv("NO_COLOR")
+
+    containers = get_service_containers(services)
+    capture_logs(containers)
+
+    # Past lines, merged in time order across services
+    history = {}
+    for service in services:
+        buffer = LogBuffer(service)
+        lines = deque(maxlen=tail) if tail is not None else []
+        for moment, container, message in buffer.read():
+            if log_filter.matches(moment, container, message):
+                lines.append((moment, service, container, message))
+        history[service] = lines
+    # Containers removed since their lines were kept are shown as well
+    names = {container for lines in history.values() for _, _, container, _ in lines}
+    names.update(name for service_names in containers.values() for name in service_names)
+    printer = LogPrinter(services, names, color)
+    batch = []
+    for _, service, container, message in heapq.merge(*history.values()):
+        batch.append(printer.format(service, container, message))
+        if len(batch) >= MAX_PENDING:
+            printer.write(batch)
+            batch = []
+    printer.write(batch)
+    if not follow:
+        return
+
+    def show(entries):
+        printer.write([
+            printer.format(service, container, message)
+            for moment, service, container, message in entries
+            if log_filter.matches(moment, container, message)
+        ])
+
+    try:
+        asyncio.run(_read_logs(LogSink(containers, show), follow=True))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,347 @@
+"""Pipeline metrics of the ``metrics`` service, for ``nbs-pods metrics``.
+
+The ``metrics`` service (``pipeline-metrics.py`` of the nbs-pods scripts)
+scrapes the ZMQ proxies, Kafka, the queueserver, Redis and Mongo, and serves
+the result in the Prometheus text format. Its counters are totals; rates are
+computed here from two samples, using the exporter's scrape timestamps so
+that they cover the interval between the exporter's scrapes rather than
+between our requests.
+"""
+
+import os
+import re
+import urllib.error
+import urllib.request
+
+from nbs_pods.monitor import format_size
+
+METRICS_URL_ENV = "NBS_PODS_METRICS_URL"
+DEFAULT_METRICS_PORT = 9464
+TIMESTAMP_METRIC = "nbs_scrape_timestamp_seconds"
+
+_SAMPLE_RE = re.compile(r"^([a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{(.*)\})?\s+(\S+)")
+_LABEL_RE = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)="((?:[^"\\]|\\.)*)"')
+
+
+def get_metrics_url():
+    """
+    Get the URL of the metrics service.
+
+    Returns
+    -------
+    str
+        NBS_PODS_METRICS_URL, or the service's published port on localhost
+    """
+    default = f"http://localhost:{os.getenv('METRICS_PORT', DEFAULT_METRICS_PORT)}/metrics"
+    return os.getenv(METRICS_URL_ENV, default)
+
+
+def fetch_metrics(url, timeout=5):
+    """
+    Fetch the metrics text of the metrics service.
+
+    Parameters
+    ----------
+    url : str
+        Metrics endpoint
+    timeout : float
+        Seconds to wait for an answer
+
+    Returns
+    -------
+    str
+        Metrics in the Prometheus text format
+
+    Raises
+    ------
+    RuntimeError
+        If the endpoint cannot be reached
+    """
+    try:
+        with urllib.request.urlopen(url, timeout=timeout) as response:
+            return response.read().decode()
+    except (OSError, urllib.error.URLError) as e:
+        raise RuntimeError(
+            f"Could not fetch metrics from {url}: {e}; is the metrics service running?"
+        )
+
+
+def parse_metrics(text):
+    """
+    Parse metrics in the Prometheus text format.
+
+    Parameters
+    ----------
+    text : str
+        Metrics text
+
+    Returns
+    -------
+    dict[str, list[tuple[dict, float]]]
+        Mapping of series name to its (labels, value) samples
+    """
+    metrics = {}
+    for line in text.splitlines():
+        if not line or line.startswith("#"):
+            continue
+        match = _SAMPLE_RE.match(line)
+        if not match:
+            continue
+        name, labels, value = match.groups()
+        try:
+            value = float(value)
+        except ValueError:
+            continue
+        labels = {
+            key: label.replace('\\"', '"').replace("\\n", "\n").replace("\\\\", "\\")
+            for key, label in _LABEL_RE.findall(labels or "")
+        }
+        metrics.setdefault(name, []).append((labels, value))
+    return metrics
+
+
+def get_scrape_time(metrics):
+    """
+    Get the time the exporter took a sample.
+
+    Parameters
+    ----------
+    metrics : dict
+        Parsed metrics from ``parse_metrics``
+
+    Returns
+    -------
+    float
+        Unix time of the exporter's scrape, 0 if it is not reported
+    """
+    return _values(metrics, TIMESTAMP_METRIC).get((), 0)
+
+
+def _values(metrics, name, *keys):
+    """Map the label values named by ``keys`` to the samples of a series."""
+    return {
+        tuple(labels.get(key, "") for key in keys): value
+        for labels, value in metrics.get(name, [])
+    }
+
+
+def _rate(current, previous, interval, key):
+    if previous is None or not interval or key not in previous:
+        return None
+    # A counter that went down was reset, e.g. by a restart
+    return max(0.0, current[key] - previous[key]) / interval
+
+
+def summarize(metrics, previous=None):
+    """
+    Summarize a sample of the metrics, with rates since a previous sample.
+
+    Parameters
+    ----------
+    metrics : dict
+        Parsed metrics from ``parse_metrics``
+    previous : dict, optional
+        Parsed metrics of an earlier scrape of the exporter
+
+    Returns
+    -------
+    dict
+        Rows of the ``zmq``, ``kafka_topics``, ``kafka_groups``,
+        ``queueserver``, ``redis`` and ``mongo`` sections, the rate
+        ``interval`` in seconds (None without a previous sample) and the
+        scrape sources that are ``down``
+    """
+    interval = None
+    if previous is not None:
+        now, then = get_scrape_time(metrics), get_scrape_time(previous)
+        interval = now - then if now > then else None
+
+    def rates(name, *keys):
+        current = _values(metrics, name, *keys)
+        before = _values(previous, name, *keys) if previous is not None else None
+        return current, {key: _rate(current, before, interval, key) for key in current}
+
+    summary = {"interval": interval}
+
+    received, received_rate = rates("zmq_proxy_messages_received_total", "proxy")
+    dropped, dropped_rate = rates("zmq_proxy_messages_dropped_total", "proxy")
+    subscribers = _values(metrics, "zmq_proxy_subscribers", "proxy")
+    summary["zmq"] = [
+        {
+            "proxy": key[0],
+            "received_per_s": received_rate[key],
+            "dropped_per_s": dropped_rate.get(key),
+            "dropped": dropped.get(key, 0),
+            "subscribers": subscribers.get(key, 0),
+        }
+        for key in sorted(received)
+    ]
+
+    _, topic_rate = rates("nbs_kafka_topic_messages_total", "topic")
+    partitions = _values(metrics, "nbs_kafka_topic_partitions", "topic")
+    summary["kafka_topics"] = [
+        {"topic": key[0], "messages_per_s": rate, "partitions": partitions.get(key, 0)}
+        for key, rate in sorted(topic_rate.items())
+    ]
+    _, consumed_rate = rates("nbs_kafka_consumer_group_messages_total", "group", "topic")
+    lag = _values(metrics, "nbs_kafka_consumer_group_lag", "group", "topic")
+    summary["kafka_groups"] = [
+        {"group": key[0], "topic": key[1], "messages_per_s": consumed_rate.get(key), "lag": value}
+        for key, value in sorted(lag.items())
+    ]
+
+    queueserver = {}
+    for labels, _ in metrics.get("nbs_qserver_state", []):
+        queueserver["manager_state"] = labels.get("manager_state")
+        queueserver["re_state"] = labels.get("re_state")
+    if queueserver:
+        plans = _values(metrics, "nbs_qserver_plan_duration_seconds_count").get((), 0)
+        total = _values(metrics, "nbs_qserver_plan_duration_seconds_sum").get((), 0)
+        queueserver.update(
+            queue=_values(metrics, "nbs_qserver_queue_items").get((), 0),
+            running=bool(_values(metrics, "nbs_qserver_plan_running").get((), 0)),
+            history=_values(metrics, "nbs_qserver_history_items").get((), 0),
+            failed=_values(metrics, "nbs_qserver_history_plans", "exit_status").get(("failed",), 0),
+            last_plan_s=_values(metrics, "nbs_qserver_last_plan_duration_seconds").get(()),
+            mean_plan_s=total / plans if plans else None,
+        )
+    summary["queueserver"] = queueserver
+
+    _, commands_rate = rates("nbs_redis_commands_processed_total", "instance")
+    clients = _values(metrics, "nbs_redis_connected_clients", "instance")
+    memory = _values(metrics, "nbs_redis_used_memory_bytes", "instance")
+    summary["redis"] = [
+        {
+            "instance": key[0],
+            "ops_per_s": rate,
+            "clients": clients.get(key, 0),
+            "memory": memory.get(key, 0),
+        }
+        for key, rate in sorted(commands_rate.items())
+    ]
+
+    _, operations_rate = rates("nbs_mongo_operations_total", "type")
+    mongo = {}
+    if operations_rate:
+        mongo = {f"{key[0]}_per_s": rate for key, rate in operations_rate.items()}
+        mongo["connections"] = _values(metrics, "nbs_mongo_connections").get((), 0)
+        mongo["cache_used"] = _values(metrics, "nbs_mongo_cache_used_bytes").get(())
+        mongo["cache_max"] = _values(metrics, "nbs_mongo_cache_max_bytes").get(())
+    summary["mongo"] = mongo
+
+    summary["down"] = sorted(
+        key[0] for key, up in _values(metrics, "nbs_scrape_up", "source").items() if not up
+    )
+    return summary
+
+
+def _format_rate(rate):
+    return "-" if rate is None else f"{rate:.1f}"
+
+
+def _format_seconds(seconds):
+    if seconds is None:
+        return "-"
+    if seconds < 60:
+        return f"{seconds:.1f} s"
+    return f"{int(seconds // 60)}m{int(seconds % 60):02d}s"
+
+
+def _table(rows):
+    """Align rows of cells; the first column is left-aligned, the others right."""
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    return [
+        "  ".join(
+            cell.ljust(width) if i < 1 else cell.rjust(width)
+            for i, (cell, width) in enumerate(zip(row, widths))
+        ).rstrip()
+        for row in rows
+    ]
+
+
+def format_metrics(summary):
+    """
+    Format a metrics summary as tables.
+
+    Parameters
+    ----------
+    summary : dict
+        Summary from ``summarize``
+
+    Returns
+    -------
+    str
+        Summary text
+    """
+    interval = summary["interval"]
+    lines = [
+        f"Rates over the last {interval:.1f} s" if interval else "Rates: waiting for a second sample"
+    ]
+    if summary["zmq"]:
+        rows = [("PROXY", "DOCS/S", "DROPPED/S", "DROPPED", "SUBSCRIBERS")]
+        for row in summary["zmq"]:
+            rows.append((
+                row["proxy"],
+                _format_rate(row["received_per_s"]),
+                _format_rate(row["dropped_per_s"]),
+                f"{row['dropped']:.0f}",
+                f"{row['subscribers']:.0f}",
+            ))
+        lines += [""] + _table(rows)
+    if summary["kafka_topics"] or summary["kafka_groups"]:
+        rows = [("TOPIC / CONSUMER GROUP", "DOCS/S", "LAG")]
+        for row in summary["kafka_topics"]:
+            rows.append((
+                f"{row['topic']} ({row['partitions']:.0f} partitions)",
+                _format_rate(row["messages_per_s"]),
+                "",
+            ))
+            for group in summary["kafka_groups"]:
+                if group["topic"] == row["topic"]:
+                    rows.append((
+                        f"  {group['group']}",
+                        _format_rate(group["messages_per_s"]),
+                        f"{group['lag']:.0f}",
+                    ))
+        lines += [""] + _table(rows)
+    queueserver = summary["queueserver"]
+    if queueserver:
+        lines += [
+            "",
+            f"Queueserver: {queueserver['manager_state']}, RunEngine {queueserver['re_state']}; "
+            f"{queueserver['queue']:.0f} queued"
+            + (", plan running" if queueserver["running"] else ""),
+            f"  History: {queueserver['history']:.0f} plans ({queueserver['failed']:.0f} failed), "
+            f"last {_format_seconds(queueserver['last_plan_s'])}, "
+            f"mean {_format_seconds(queueserver['mean_plan_s'])}",
+        ]
+    if summary["redis"]:
+        rows = [("REDIS", "OPS/S", "CLIENTS", "MEMORY")]
+        for row in summary["redis"]:
+            rows.append((
+                row["instance"],
+                _format_rate(row["ops_per_s"]),
+                f"{row['clients']:.0f}",
+                format_size(row["memory"]),
+            ))
+        lines += [""] + _table(rows)
+    mongo = summary["mongo"]
+    if mongo:
+        rows = [("MONGO", "INSERT/S", "QUERY/S", "UPDATE/S", "GETMORE/S", "COMMAND/S", "CONNS", "CACHE")]
+        cache = "-"
+        if mongo.get("cache_used") is not None:
+            cache = f"{format_size(mongo['cache_used'])} / {format_size(mongo.get('cache_max') or 0)}"
+        rows.append((
+            "mongo",
+            _format_rate(mongo.get("insert_per_s")),
+            _format_rate(mongo.get("query_per_s")),
+            _format_rate(mongo.get("update_per_s")),
+            _format_rate(mongo.get("getmore_per_s")),
+            _format_rate(mongo.get("command_per_s")),
+            f"{mongo['connections']:.0f}",
+            cache,
+        ))
+        lines += [""] + _table(rows)
+    if summary["down"]:
+        lines += ["", f"Not reachable: {', '.join(summary['down'])}"]
+    return "\n".join(lines)
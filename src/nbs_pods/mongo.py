@@ -0,0 +1,185 @@
+"""Mongo profiles: WiredTiger cache, storage and indexes as an override layer.
+
+Presets are read from ``mongo-profiles.yml`` in the beamline pods directory
+and from the defaults shipped in nbs-pods' ``config/mongo-profiles.yml``; a
+beamline preset replaces a shipped preset of the same name. A preset tunes
+the ``mongo`` container of bluesky-services::
+
+    profile: archive            # active preset, unless NBS_PODS_MONGO_PROFILE is set
+    presets:
+      archive:
+        cache_size_gb: 4
+        block_compressor: zstd
+        volume: archive
+        index_fields:
+          - proposal.proposal_id
+          - sample_name
+
+``cache_size_gb`` sizes the WiredTiger cache, which otherwise takes half of
+the host's memory regardless of the container's. ``block_compressor`` sets
+the compression of new collections. ``volume`` keeps the database in a
+host directory, so it survives ``nbs-pods stop``; a relative path is taken
+relative to the beamline's nbs-pods state directory. ``index_fields`` are
+start document fields indexed in addition to the ones databroker queries
+by, which ``mongo-init`` creates on every start.
+"""
+
+import os
+from pathlib import Path
+
+from nbs_pods.config import get_cache_dir, get_state_dir, load_profile_files, write_json
+
+MONGO_KEY = "mongo"
+MONGO_PROFILE_ENV = "NBS_PODS_MONGO_PROFILE"
+MONGO_CONTAINER = "mongo"
+MONGO_INIT_CONTAINER = "mongo-init"
+MONGO_DATA_TARGET = "/data/db"
+PROFILE_SECTIONS = ("cache_size_gb", "block_compressor", "volume", "index_fields")
+BLOCK_COMPRESSORS = ("none", "snappy", "zlib", "zstd")
+
+
+def load_mongo_profiles():
+    """
+    Load the Mongo presets and the configured active preset.
+
+    Returns
+    -------
+    tuple[dict, str | None]
+        (presets, active), see ``load_profile_files``
+    """
+    return load_profile_files("mongo-profiles.yml", "Mongo")
+
+
+def get_active_mongo_profile():
+    """
+    Get the Mongo preset to apply.
+
+    Returns
+    -------
+    dict | None
+        Settings of the preset named by NBS_PODS_MONGO_PROFILE, or by the
+        ``profile`` of the profile files; None if no preset (or 'none') is
+        selected
+
+    Raises
+    ------
+    RuntimeError
+        If the preset does not exist or has invalid settings
+    """
+    presets, profile = load_mongo_profiles()
+    profile = os.getenv(MONGO_PROFILE_ENV, profile)
+    if not profile or profile == "none":
+        return None
+    if profile not in presets:
+        raise RuntimeError(
+            f"Unknown Mongo profile '{profile}'; available: {', '.join(presets) or 'none'}"
+        )
+    settings = presets[profile] or {}
+    unknown = set(settings) - set(PROFILE_SECTIONS)
+    if unknown:
+        raise RuntimeError(
+            f"Unknown setting {', '.join(sorted(unknown))} in Mongo profile '{profile}'; "
+            f"use {', '.join(PROFILE_SECTIONS)}"
+        )
+    compressor = settings.get("block_compressor")
+    if compressor is not None and compressor not in BLOCK_COMPRESSORS:
+        raise RuntimeError(
+            f"Unknown block_compressor '{compressor}' in Mongo profile '{profile}'; "
+            f"use {', '.join(BLOCK_COMPRESSORS)}"
+        )
+    if settings.get("cache_size_gb") is not None and float(settings["cache_size_gb"]) < 0.25:
+        raise RuntimeError(f"cache_size_gb of Mongo profile '{profile}' must be at least 0.25")
+    return settings
+
+
+def get_mongod_arguments(settings):
+    """
+    Get the ``mongod`` options of a preset.
+
+    Parameters
+    ----------
+    settings : dict
+        Preset from ``get_active_mongo_profile``
+
+    Returns
+    -------
+    list[str]
+        Options; the mongo image runs ``mongod`` with them
+    """
+    arguments = []
+    if settings.get("cache_size_gb") is not None:
+        arguments += ["--wiredTigerCacheSizeGB", str(settings["cache_size_gb"])]
+    if settings.get("block_compressor") is not None:
+        arguments += ["--wiredTigerCollectionBlockCompressor", settings["block_compressor"]]
+    return arguments
+
+
+def get_data_dir(settings):
+    """
+    Get the host directory of a preset's database, creating it if missing.
+
+    Parameters
+    ----------
+    settings : dict
+        Preset from ``get_active_mongo_profile``
+
+    Returns
+    -------
+    Path | None
+        Directory, or None if the preset keeps the database in the
+        container's own volume
+    """
+    volume = settings.get("volume")
+    if not volume:
+        return None
+    path = Path(os.path.expanduser(str(volume)))
+    if not path.is_absolute():
+        path = get_state_dir() / MONGO_KEY / path
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def write_mongo_override(service, compose_file_string):
+    """
+    Write the Mongo profile override layer of a service.
+
+    Parameters
+    ----------
+    service : str
+        nbs-pods service name
+    compose_file_string : str
+        Colon-separated compose file chain the layer is chained after
+
+    Returns
+    -------
+    Path | None
+        Path to the override file, or None if no preset is active or the
+        service does not run Mongo
+    """
+    settings = get_active_mongo_profile()
+    if settings is None:
+        return None
+    from nbs_pods.compose import load_compose_chain
+
+    containers = load_compose_chain(compose_file_string).get("services") or {}
+    services = {}
+    if MONGO_CONTAINER in containers:
+        mongo = {}
+        arguments = get_mongod_arguments(settings)
+        if arguments:
+            mongo["command"] = arguments
+        data_dir = get_data_dir(settings)
+        if data_dir is not None:
+            mongo["volumes"] = [f"{data_dir}:{MONGO_DATA_TARGET}"]
+        if mongo:
+            services[MONGO_CONTAINER] = mongo
+    if MONGO_INIT_CONTAINER in containers and settings.get("index_fields"):
+        fields = settings["index_fields"]
+        if isinstance(fields, str):
+            fields = [fields]
+        services[MONGO_INIT_CONTAINER] = {
+            "environment": [f"MONGO_INDEX_FIELDS={','.join(str(f) for f in fields)}"]
+        }
+    if not services:
+        return None
+    return write_json(get_cache_dir() / MONGO_KEY / f"{service}.yml", {"services": services})
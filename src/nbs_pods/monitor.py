@@ -0,0 +1,325 @@
+"""Resource usage of running services, for ``nbs-pods status`` and ``top``.
+
+Containers are mapped back to nbs-pods services by their compose project
+label (or, in whole-stack mode, the stack service label), using the compose
+chains recorded when the services were started. Samples come from the
+podman stats API when the service socket is available, and from
+``podman stats`` otherwise. CPU usage is computed from the CPU time
+consumed between two samples, so it reflects the refresh interval rather
+than the lifetime of the container.
+"""
+
+import json
+import os
+import re
+import subprocess
+import time
+from pathlib import Path
+
+from nbs_pods.compose import get_compose_project
+from nbs_pods.config import get_nbs_pods_dir
+from nbs_pods.podman import PROJECT_LABEL
+from nbs_pods.stack import SERVICE_LABEL as STACK_SERVICE_LABEL
+from nbs_pods.state import load_service_state
+
+OVERRIDE_KEYS = ("override", "development", "test", "hold")
+STAT_FIELDS = ("mem_usage", "mem_limit", "net_rx", "net_tx", "block_read", "block_write", "pids")
+
+_SIZE_RE = re.compile(r"^\s*([0-9.]+)\s*([a-zA-Z]*)\s*$")
+_SIZE_UNITS = {
+    "": 1, "b": 1,
+    "kb": 1000, "mb": 1000 ** 2, "gb": 1000 ** 3, "tb": 1000 ** 4,
+    "kib": 1024, "mib": 1024 ** 2, "gib": 1024 ** 3, "tib": 1024 ** 4,
+}
+
+
+def describe_chain(compose_file_string):
+    """
+    Describe where a service's compose chain comes from.
+
+    Parameters
+    ----------
+    compose_file_string : str
+        Colon-separated compose file chain
+
+    Returns
+    -------
+    tuple[str, list[str]]
+        (source, override_keys) where source is 'base' if the base file is
+        one of nbs-pods' own compose files, 'beamline' otherwise
+    """
+    files = compose_file_string.split(":")
+    nbs_compose_dir = os.path.realpath(get_nbs_pods_dir() / "compose")
+    base_file = os.path.realpath(files[0])
+    source = "base" if base_file.startswith(nbs_compose_dir + os.sep) else "beamline"
+    keys = []
+    for compose_file in files[1:]:
+        match = re.match(r"docker-compose\.(.+)\.yml$", Path(compose_file).name)
+        if match and match.group(1) in OVERRIDE_KEYS:
+            keys.append(match.group(1))
+    return source, keys
+
+
+def get_service_projects(services):
+    """
+    Map compose projects to the services that were started with them.
+
+    Parameters
+    ----------
+    services : list[str]
+        Known service names
+
+    Returns
+    -------
+    dict[str, dict]
+        Mapping of compose project to ``{"service", "source", "overrides"}``
+        for every service with a recorded compose chain
+    """
+    projects = {}
+    for service in services:
+        state = load_service_state(service)
+        if state is None:
+            continue
+        source, overrides = describe_chain(state["compose_file"])
+        info = {"service": service, "source": source, "overrides": overrides}
+        projects[get_compose_project(state["compose_file"])] = info
+        projects.setdefault(service, info)
+    return projects
+
+
+def parse_size(value):
+    """Parse a human readable size such as ``12.5MB`` or ``1.2GiB`` into bytes."""
+    match = _SIZE_RE.match(value or "")
+    if not match:
+        return 0
+    return int(float(match.group(1)) * _SIZE_UNITS.get(match.group(2).lower(), 1))
+
+
+def _split_pair(value):
+    first, _, second = (value or "").partition("/")
+    return parse_size(first), parse_size(second)
+
+
+def _from_api_stats(entry):
+    """Normalize a stats entry of the libpod API."""
+    return {
+        "id": entry.get("ContainerID", ""),
+        "name": entry.get("Name", ""),
+        "cpu_percent": float(entry.get("CPU") or 0.0),
+        "cpu_nano": entry.get("CPUNano"),
+        "mem_usage": int(entry.get("MemUsage") or 0),
+        "mem_limit": int(entry.get("MemLimit") or 0),
+        "net_rx": int(entry.get("NetInput") or 0),
+        "net_tx": int(entry.get("NetOutput") or 0),
+        "block_read": int(entry.get("BlockInput") or 0),
+        "block_write": int(entry.get("BlockOutput") or 0),
+        "pids": int(entry.get("PIDs") or 0),
+    }
+
+
+def _from_cli_stats(entry):
+    """Normalize an entry of ``podman stats --format json``."""
+    mem_usage, mem_limit = _split_pair(entry.get("mem_usage"))
+    net_rx, net_tx = _split_pair(entry.get("net_io"))
+    block_read, block_write = _split_pair(entry.get("block_io"))
+    try:
+        cpu_percent = float(str(entry.get("cpu_percent", "0")).rstrip("%") or 0)
+    except ValueError:
+        cpu_percent = 0.0
+    return {
+        "id": entry.get("id", ""),
+        "name": entry.get("name", ""),
+        "cpu_percent": cpu_percent,
+        "cpu_nano": None,
+        "mem_usage": mem_usage,
+        "mem_limit": mem_limit,
+        "net_rx": net_rx,
+        "net_tx": net_tx,
+        "block_read": block_read,
+        "block_write": block_write,
+        "pids": int(entry.get("pids") or 0),
+    }
+
+
+def _sample_api():
+    from nbs_pods.podman_api import get_client
+
+    client = get_client()
+    containers = client.list_containers(all_containers=False)
+    stats = [_from_api_stats(entry) for entry in client.container_stats()]
+    return containers, stats
+
+
+def _sample_cli():
+    ps = subprocess.run(
+        ["podman", "ps", "--format", "json"], capture_output=True, text=True
+    )
+    stats = subprocess.run(
+        ["podman", "stats", "--no-stream", "--format", "json"],
+        capture_output=True,
+        text=True,
+    )
+    if ps.returncode != 0 or stats.returncode != 0:
+        raise RuntimeError((ps.stderr or stats.stderr).strip() or "podman stats failed")
+    containers = json.loads(ps.stdout or "[]") or []
+    return containers, [_from_cli_stats(entry) for entry in json.loads(stats.stdout or "[]") or []]
+
+
+def sample_containers(use_api=None):
+    """
+    Take one resource usage sample of all running containers.
+
+    Parameters
+    ----------
+    use_api : bool, optional
+        Whether to use the podman stats API; by default it is used if the
+        podman service socket exists
+
+    Returns
+    -------
+    list[dict]
+        Per-container stats with the container's ``labels``
+
+    Raises
+    ------
+    RuntimeError
+        If neither the API nor the podman command line is available
+    """
+    from nbs_pods.podman_api import get_podman_socket
+
+    if use_api is None:
+        use_api = os.path.exists(get_podman_socket())
+    containers = stats = None
+    if use_api:
+        try:
+            containers, stats = _sample_api()
+        except (OSError, RuntimeError, ValueError):
+            containers = None
+    if containers is None:
+        try:
+            containers, stats = _sample_cli()
+        except (OSError, ValueError) as e:
+            raise RuntimeError(f"Could not sample container stats: {e}")
+
+    labels = {}
+    for container in containers:
+        for name in container.get("Names") or []:
+            labels[name] = container.get("Labels") or {}
+        labels[container.get("Id", "")] = container.get("Labels") or {}
+    for entry in stats:
+        entry["labels"] = labels.get(entry["name"]) or labels.get(entry["id"]) or {}
+    return stats
+
+
+def summarize(stats, projects, previous=None, interval=None):
+    """
+    Aggregate container stats per nbs-pods service.
+
+    Parameters
+    ----------
+    stats : list[dict]
+        Container stats from ``sample_containers``
+    projects : dict[str, dict]
+        Compose projects from ``get_service_projects``
+    previous : dict, optional
+        The previous summary; when given, CPU usage is computed from the CPU
+        time consumed since then
+    interval : float, optional
+        Seconds since the previous summary
+
+    Returns
+    -------
+    dict
+        ``{"time": ..., "services": {service: {...}}}``, where each service
+        has its source, override keys, summed usage and its ``containers``
+    """
+    previous_cpu = {}
+    for service in ((previous or {}).get("services") or {}).values():
+        for name, container in service["containers"].items():
+            previous_cpu[name] = container.get("cpu_nano")
+
+    services = {}
+    for entry in stats:
+        labels = entry.pop("labels")
+        project = labels.get(PROJECT_LABEL)
+        if project is None:
+            continue
+        info = projects.get(labels.get(STACK_SERVICE_LABEL) or project) or {
+            "service": labels.get(STACK_SERVICE_LABEL) or project,
+            "source": "unknown",
+            "overrides": [],
+        }
+        name = entry.pop("name")
+        cpu_nano = entry.get("cpu_nano")
+        if interval and cpu_nano is not None and previous_cpu.get(name) is not None:
+            entry["cpu_percent"] = (cpu_nano - previous_cpu[name]) / (interval * 1e9) * 100
+        service = services.setdefault(
+            info["service"],
+            dict(
+                {field: 0 for field in STAT_FIELDS},
+                source=info["source"],
+                overrides=list(info["overrides"]),
+                project=project,
+                cpu_percent=0.0,
+                containers={},
+            ),
+        )
+        service["containers"][name] = entry
+        service["cpu_percent"] += entry["cpu_percent"]
+        for field in STAT_FIELDS:
+            service[field] += entry[field]
+    return {"time": time.time(), "services": dict(sorted(services.items()))}
+
+
+def format_size(value):
+    """Format a byte count for the status table."""
+    for unit in ("B", "kB", "MB", "GB"):
+        if abs(value) < 1000:
+            return f"{value:.0f}{unit}" if unit == "B" else f"{value:.1f}{unit}"
+        value /= 1000
+    return f"{value:.1f}TB"
+
+
+def format_summary(summary, show_containers=False):
+    """
+    Format a summary as a table.
+
+    Parameters
+    ----------
+    summary : dict
+        Summary from ``summarize``
+    show_containers : bool
+        Whether to add a row for every container below its service
+
+    Returns
+    -------
+    str
+        Table text
+    """
+    rows = [("SERVICE", "SOURCE", "OVERRIDES", "CPU %", "MEM", "NET RX/TX", "BLOCK R/W", "PIDS")]
+
+    def usage(item):
+        return (
+            f"{item['cpu_percent']:.1f}",
+            format_size(item["mem_usage"]),
+            f"{format_size(item['net_rx'])}/{format_size(item['net_tx'])}",
+            f"{format_size(item['block_read'])}/{format_size(item['block_write'])}",
+            str(item["pids"]),
+        )
+
+    for service, item in summary["services"].items():
+        rows.append((service, item["source"], ",".join(item["overrides"]) or "-") + usage(item))
+        if show_containers:
+            for name, container in sorted(item["containers"].items()):
+                rows.append((f"  {name}", "", "") + usage(container))
+    if len(rows) == 1:
+        return "No nbs-pods containers are running"
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    lines = []
+    for row in rows:
+        cells = [
+            cell.ljust(width) if i < 3 else cell.rjust(width)
+            for i, (cell, width) in enumerate(zip(row, widths))
+        ]
+        lines.append("  ".join(cells).rstrip())
+    return "\n".join(lines)
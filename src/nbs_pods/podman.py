@@ -0,0 +1,193 @@
+"""Thin helpers around the podman command line."""
+
+import subprocess
+
+PROJECT_LABEL = "com.docker.compose.project"
+SERVICE_LABEL = "com.docker.compose.service"
+
+
+def find_containers(project, service=None, all_containers=False):
+    """
+    Find containers created by podman-compose for a project.
+
+    Parameters
+    ----------
+    project : str
+        Compose project name
+    service : str, optional
+        Compose service name within the project
+    all_containers : bool
+        Whether to include containers that are not running
+
+    Returns
+    -------
+    list[str]
+        Container IDs
+    """
+    command = ["podman", "ps", "-q", "--filter", f"label={PROJECT_LABEL}={project}"]
+    if service is not None:
+        command.extend(["--filter", f"label={SERVICE_LABEL}={service}"])
+    if all_containers:
+        command.append("-a")
+    result = subprocess.run(command, capture_output=True, text=True)
+    if result.returncode != 0:
+        return []
+    return result.stdout.split()
+
+
+def exec_in_container(container, command, timeout=None):
+    """
+    Run a command inside a running container.
+
+    Parameters
+    ----------
+    container : str
+        Container name or ID
+    command : list[str]
+        Command to run
+    timeout : float, optional
+        Timeout in seconds
+
+    Returns
+    -------
+    subprocess.CompletedProcess
+        Result with captured stdout/stderr
+    """
+    return subprocess.run(
+        ["podman", "exec", container] + list(command),
+        capture_output=True,
+        text=True,
+        timeout=timeout,
+    )
+
+
+def get_project_labels(project):
+    """
+    Get the labels of every container of a compose project.
+
+    Parameters
+    ----------
+    project : str
+        Compose project name
+
+    Returns
+    -------
+    dict[str, dict]
+        Mapping of compose service name to container labels, including
+        containers that are not running
+    """
+    import json
+
+    command = [
+        "podman", "ps", "-a", "--format", "json",
+        "--filter", f"label={PROJECT_LABEL}={project}",
+    ]
+    result = subprocess.run(command, capture_output=True, text=True)
+    if result.returncode != 0 or not result.stdout.strip():
+        return {}
+    containers = {}
+    for container in json.loads(result.stdout):
+        labels = container.get("Labels") or {}
+        if SERVICE_LABEL in labels:
+            containers[labels[SERVICE_LABEL]] = labels
+    return containers
+
+
+def get_events(since, until):
+    """
+    Get the podman events of a time range.
+
+    Parameters
+    ----------
+    since, until : float
+        Unix timestamps
+
+    Returns
+    -------
+    list[dict]
+        Events with ``Type``, ``Status``, ``Name``, ``timeNano`` and
+        ``Attributes`` keys; empty if podman is unavailable
+    """
+    import json
+
+    command = [
+        "podman", "events", "--stream=false", "--format", "json",
+        "--since", f"{since:.3f}", "--until", f"{until + 1:.3f}",
+    ]
+    try:
+        result = subprocess.run(command, capture_output=True, text=True, timeout=30)
+    except (OSError, subprocess.SubprocessError):
+        return []
+    if result.returncode != 0:
+        return []
+    events = []
+    for line in result.stdout.splitlines():
+        try:
+            event = json.loads(line)
+        except ValueError:
+            continue
+        if "timeNano" in event:
+            events.append(event)
+    return events
+
+
+def get_image_digests(reference):
+    """
+    Get the digests of a local image.
+
+    Parameters
+    ----------
+    reference : str
+        Image reference
+
+    Returns
+    -------
+    set[str] or None
+        Manifest digests the image is known by in registries, or None if
+        the image does not exist locally
+    """
+    import json
+
+    command = ["podman", "image", "inspect", "--format", "json", reference]
+    result = subprocess.run(command, capture_output=True, text=True)
+    if result.returncode != 0 or not result.stdout.strip():
+        return None
+    digests = set()
+    for image in json.loads(result.stdout):
+        if image.get("Digest"):
+            digests.add(image["Digest"])
+        for repo_digest in image.get("RepoDigests") or []:
+            digests.add(repo_digest.partition("@")[2])
+    return digests
+
+
+def get_project_containers(project):
+    """
+    Get the running containers of a compose project.
+
+    Parameters
+    ----------
+    project : str
+        Compose project name
+
+    Returns
+    -------
+    dict[str, str]
+        Mapping of compose service name to container name
+    """
+    import json
+
+    command = [
+        "podman", "ps", "--format", "json",
+        "--filter", f"label={PROJECT_LABEL}={project}",
+    ]
+    result = subprocess.run(command, capture_output=True, text=True)
+    if result.returncode != 0 or not result.stdout.strip():
+        return {}
+    containers = {}
+    for container in json.loads(result.stdout):
+        labels = container.get("Labels") or {}
+        names = container.get("Names") or []
+        if SERVICE_LABEL in labels and names:
+            containers[labels[SERVICE_LABEL]] = names[0]
+    return containers
@@ -0,0 +1,405 @@
+"""Client for the podman (libpod) REST API over its Unix socket."""
+
+import http.client
+import json
+import os
+import queue
+import socket
+import threading
+from urllib.parse import quote, urlencode
+
+API_PREFIX = "/v4.0.0/libpod"
+DEFAULT_POOL_SIZE = 8
+DEFAULT_TIMEOUT = 60.0
+
+
+class PodmanAPIError(RuntimeError):
+    """Raised when the podman service answers with an error status."""
+
+    def __init__(self, status, message):
+        super().__init__(f"podman API error {status}: {message}")
+        self.status = status
+        self.message = message
+
+
+def get_podman_socket():
+    """
+    Get the path of the podman service socket.
+
+    Returns
+    -------
+    str
+        NBS_PODS_PODMAN_SOCKET, a ``unix://`` CONTAINER_HOST, or the default
+        rootless (or root) socket location
+    """
+    if socket_path := os.getenv("NBS_PODS_PODMAN_SOCKET"):
+        return socket_path
+    container_host = os.getenv("CONTAINER_HOST", "")
+    if container_host.startswith("unix://"):
+        return container_host[len("unix://"):]
+    if os.getuid() == 0:
+        return "/run/podman/podman.sock"
+    runtime_dir = os.getenv("XDG_RUNTIME_DIR") or f"/run/user/{os.getuid()}"
+    return os.path.join(runtime_dir, "podman", "podman.sock")
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTP connection over a Unix domain socket."""
+
+    def __init__(self, socket_path, timeout=DEFAULT_TIMEOUT):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+
+class PodmanClient:
+    """
+    Thread-safe podman API client with a pool of keep-alive connections.
+
+    Parameters
+    ----------
+    socket_path : str, optional
+        Podman service socket, defaults to ``get_podman_socket()``
+    pool_size : int
+        Maximum number of idle connections kept for reuse
+    timeout : float
+        Socket timeout in seconds
+    """
+
+    def __init__(self, socket_path=None, pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT):
+        self.socket_path = socket_path or get_podman_socket()
+        self.timeout = timeout
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+
+    def _acquire(self):
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            return UnixHTTPConnection(self.socket_path, timeout=self.timeout)
+
+    def _release(self, connection):
+        try:
+            self._pool.put_nowait(connection)
+        except queue.Full:
+            connection.close()
+
+    def close(self):
+        """Close all pooled connections."""
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                return
+
+    def request(self, method, path, params=None, body=None, timeout=None):
+        """
+        Send a request to the libpod API.
+
+        Parameters
+        ----------
+        method : str
+            HTTP method
+        path : str
+            Path below the libpod API prefix, e.g. ``/containers/json``
+        params : dict, optional
+            Query parameters; dict and list values are JSON encoded
+        body : dict, optional
+            JSON request body
+        timeout : float, optional
+            Socket timeout for this request, e.g. for long image pulls
+
+        Returns
+        -------
+        tuple[int, bytes]
+            (status, response body)
+
+        Raises
+        ------
+        PodmanAPIError
+            If the response status is 400 or above
+        OSError
+            If the podman socket cannot be reached
+        """
+        url = API_PREFIX + path
+        if params:
+            encoded = {
+                key: json.dumps(value) if isinstance(value, (dict, list)) else value
+                for key, value in params.items()
+                if value is not None
+            }
+            encoded = {
+                key: str(value).lower() if isinstance(value, bool) else value
+                for key, value in encoded.items()
+            }
+            url += "?" + urlencode(encoded)
+        headers = {}
+        data = None
+        if body is not None:
+            data = json.dumps(body).encode()
+            headers["Content-Type"] = "application/json"
+
+        # A pooled connection may have been closed by the server; retry once
+        # on a fresh connection in that case
+        for attempt in range(2):
+            connection = self._acquire()
+            try:
+                connection.timeout = timeout or self.timeout
+                if connection.sock is not None:
+                    connection.sock.settimeout(connection.timeout)
+                connection.request(method, url, body=data, headers=headers)
+                response = connection.getresponse()
+                payload = response.read()
+            except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+                connection.close()
+                if attempt:
+                    raise
+                continue
+            except Exception:
+                connection.close()
+                raise
+            if response.will_close:
+                connection.close()
+            else:
+                self._release(connection)
+            break
+
+        if response.status >= 400:
+            try:
+                message = json.loads(payload).get("message", payload.decode())
+            except ValueError:
+                message = payload.decode(errors="replace")
+            raise PodmanAPIError(response.status, message)
+        return response.status, payload
+
+    def request_json(self, method, path, params=None, body=None, timeout=None):
+        """Send a request and decode the JSON response (None if empty)."""
+        _, payload = self.request(method, path, params, body, timeout)
+        return json.loads(payload) if payload.strip() else None
+
+    def exists(self, kind, name):
+        """
+        Check whether a container, network, volume or image exists.
+
+        Parameters
+        ----------
+        kind : str
+            'containers', 'networks', 'volumes' or 'images'
+        name : str
+            Name or ID
+
+        Returns
+        -------
+        bool
+        """
+        try:
+            self.request("GET", f"/{kind}/{quote(name, safe='')}/exists")
+        except PodmanAPIError as e:
+            if e.status == 404:
+                return False
+            raise
+        return True
+
+    def ping(self):
+        """Check that the podman service answers."""
+        self.request("GET", "/_ping")
+
+    # Containers
+
+    def list_containers(self, labels=None, all_containers=True):
+        """
+        List containers, optionally filtered by labels.
+
+        Parameters
+        ----------
+        labels : dict, optional
+            Label filters, e.g. ``{"com.docker.compose.project": "sim"}``
+        all_containers : bool
+            Whether to include containers that are not running
+
+        Returns
+        -------
+        list[dict]
+            Container summaries
+        """
+        filters = {}
+        if labels:
+            filters["label"] = [f"{key}={value}" for key, value in labels.items()]
+        params = {"all": all_containers, "filters": filters or None}
+        return self.request_json("GET", "/containers/json", params) or []
+
+    def create_container(self, spec):
+        """Create a container from a libpod SpecGenerator; returns its ID."""
+        return self.request_json("POST", "/containers/create", body=spec)["Id"]
+
+    def start_container(self, name):
+        """Start a container."""
+        self.request("POST", f"/containers/{quote(name, safe='')}/start")
+
+    def stop_container(self, name, timeout=10):
+        """Stop a container, killing it after ``timeout`` seconds."""
+        self.request(
+            "POST",
+            f"/containers/{quote(name, safe='')}/stop",
+            {"timeout": timeout},
+            timeout=self.timeout + timeout,
+        )
+
+    def pause_container(self, name):
+        """Pause (freeze) a running container."""
+        self.request("POST", f"/containers/{quote(name, safe='')}/pause")
+
+    def unpause_container(self, name):
+        """Unpause a paused container."""
+        self.request("POST", f"/containers/{quote(name, safe='')}/unpause")
+
+    def remove_container(self, name, force=True, volumes=True):
+        """Remove a container and, optionally, its anonymous volumes."""
+        self.request(
+            "DELETE",
+            f"/containers/{quote(name, safe='')}",
+            {"force": force, "v": volumes},
+        )
+
+    def inspect_container(self, name):
+        """Get the full inspect data of a container."""
+        return self.request_json("GET", f"/containers/{quote(name, safe='')}/json")
+
+    def container_logs(self, name, since=None):
+        """
+        Get the log of a container, each line prefixed with its timestamp.
+
+        Parameters
+        ----------
+        name : str
+            Container name or ID
+        since : float, optional
+            Unix time of the oldest line to return
+
+        Returns
+        -------
+        list[bytes]
+            Lines, stdout and stderr interleaved, as ``podman logs --timestamps``
+        """
+        params = {"stdout": True, "stderr": True, "timestamps": True}
+        if since:
+            params["since"] = f"{since:.6f}"
+        _, payload = self.request("GET", f"/containers/{quote(name, safe='')}/logs", params)
+        # Containers without a TTY multiplex stdout and stderr in frames of an
+        # 8-byte header (stream, 3 zero bytes, big-endian length) and the data
+        data = payload
+        if payload[:1] in (b"\x00", b"\x01", b"\x02") and payload[1:4] == b"\x00\x00\x00":
+            chunks = []
+            offset = 0
+            while offset + 8 <= len(payload):
+                length = int.from_bytes(payload[offset + 4:offset + 8], "big")
+                chunks.append(payload[offset + 8:offset + 8 + length])
+                offset += 8 + length
+            data = b"".join(chunks)
+        lines = data.split(b"\n")
+        if lines and not lines[-1]:
+            lines.pop()
+        return lines
+
+    def container_stats(self, names=None):
+        """
+        Get one resource usage sample for containers.
+
+        Parameters
+        ----------
+        names : list[str], optional
+            Containers to sample, defaults to all running containers
+
+        Returns
+        -------
+        list[dict]
+            Stats entries
+        """
+        # "containers" is a repeated query parameter, not a JSON list
+        query = urlencode([("stream", "false")] + [("containers", n) for n in names or []])
+        _, payload = self.request("GET", "/containers/stats?" + query)
+        data = json.loads(payload) if payload.strip() else {}
+        return data.get("Stats") or []
+
+    # Networks
+
+    def create_network(self, spec):
+        """Create a network from a libpod network spec."""
+        return self.request_json("POST", "/networks/create", body=spec)
+
+    def remove_network(self, name):
+        """Remove a network."""
+        self.request("DELETE", f"/networks/{quote(name, safe='')}")
+
+    def list_networks(self, labels=None):
+        """List networks, optionally filtered by labels."""
+        filters = {}
+        if labels:
+            filters["label"] = [f"{key}={value}" for key, value in labels.items()]
+        return self.request_json("GET", "/networks/json", {"filters": filters or None}) or []
+
+    # Volumes
+
+    def create_volume(self, name, labels=None):
+        """Create a named volume."""
+        body = {"Name": name, "Label": labels or {}}
+        return self.request_json("POST", "/volumes/create", body=body)
+
+    def remove_volume(self, name, force=False):
+        """Remove a named volume."""
+        self.request("DELETE", f"/volumes/{quote(name, safe='')}", {"force": force})
+
+    def list_volumes(self, labels=None):
+        """List volumes, optionally filtered by labels."""
+        filters = {}
+        if labels:
+            filters["label"] = [f"{key}={value}" for key, value in labels.items()]
+        return self.request_json("GET", "/volumes/json", {"filters": filters or None}) or []
+
+    # Images
+
+    def pull_image(self, reference, timeout=3600):
+        """
+        Pull an image, waiting for the pull to finish.
+
+        Raises
+        ------
+        PodmanAPIError
+            If the pull reports an error
+        """
+        _, payload = self.request(
+            "POST", "/images/pull", {"reference": reference, "quiet": True}, timeout=timeout
+        )
+        for line in payload.splitlines():
+            if not line.strip():
+                continue
+            report = json.loads(line)
+            if report.get("error"):
+                raise PodmanAPIError(500, report["error"])
+
+    def inspect_image(self, reference):
+        """Get the inspect data of a local image."""
+        return self.request_json("GET", f"/images/{quote(reference, safe='')}/json")
+
+
+_client_lock = threading.Lock()
+_client = None
+
+
+def get_client():
+    """
+    Get the shared podman API client for this process.
+
+    Returns
+    -------
+    PodmanClient
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = PodmanClient()
+        return _client
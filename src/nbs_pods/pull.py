@@ -0,0 +1,239 @@
+"""Prefetching the images of services before they are started.
+
+Images are collected from the same compose chains ``start`` resolves, so
+overrides that swap an image are honoured, and each distinct image is
+pulled once however many services use it. An image that exists locally is
+only pulled if the registry now has a different manifest for its tag, which
+is checked with a ``HEAD`` request against the registry's v2 API rather
+than a full ``podman pull``.
+"""
+
+import json
+import os
+
+from nbs_pods.compose import interpolate, load_compose_chain
+
+DEFAULT_REGISTRY = "docker.io"
+LOCAL_REGISTRY = "localhost"
+
+_MANIFEST_TYPES = ", ".join(
+    [
+        "application/vnd.oci.image.index.v1+json",
+        "application/vnd.docker.distribution.manifest.list.v2+json",
+        "application/vnd.oci.image.manifest.v1+json",
+        "application/vnd.docker.distribution.manifest.v2+json",
+    ]
+)
+
+
+def parse_image_reference(reference):
+    """
+    Split an image reference into its parts, normalizing short names.
+
+    Parameters
+    ----------
+    reference : str
+        Image reference, e.g. ``docker.io/redis`` or
+        ``ghcr.io/xraygui/nbs-pods/queueserver:latest``
+
+    Returns
+    -------
+    tuple[str, str, str]
+        (registry, repository, tag_or_digest), e.g.
+        ``("docker.io", "library/redis", "latest")``
+    """
+    name, _, digest = reference.partition("@")
+    tag = None
+    last = name.rsplit("/", 1)[-1]
+    if ":" in last:
+        name, tag = name.rsplit(":", 1)
+    first, sep, rest = name.partition("/")
+    if sep and ("." in first or ":" in first or first == LOCAL_REGISTRY):
+        registry, repository = first, rest
+    else:
+        registry, repository = DEFAULT_REGISTRY, name
+    if registry == DEFAULT_REGISTRY and "/" not in repository:
+        repository = f"library/{repository}"
+    return registry, repository, digest or tag or "latest"
+
+
+def normalize_image_reference(reference):
+    """Get the fully qualified form of an image reference."""
+    registry, repository, version = parse_image_reference(reference)
+    separator = "@" if version.startswith("sha256:") else ":"
+    return f"{registry}/{repository}{separator}{version}"
+
+
+def is_insecure_registry(registry):
+    """
+    Whether a registry is reached over plain HTTP without TLS verification.
+
+    Registries on the loopback interface, such as a local stand-in
+    registry, and those listed in the comma-separated
+    ``NBS_PODS_INSECURE_REGISTRIES`` are.
+    """
+    host = registry.rsplit(":", 1)[0] if not registry.endswith("]") else registry
+    if host in ("localhost", "127.0.0.1", "[::1]"):
+        return True
+    insecure = os.getenv("NBS_PODS_INSECURE_REGISTRIES", "")
+    return registry in [item.strip() for item in insecure.split(",") if item.strip()]
+
+
+def collect_images(chains, env):
+    """
+    Collect the distinct images used by resolved compose chains.
+
+    Parameters
+    ----------
+    chains : dict[str, str]
+        Mapping of service to its colon-separated compose file chain
+    env : dict
+        Environment used for variable interpolation
+
+    Returns
+    -------
+    dict[str, list[str]]
+        Mapping of fully qualified image reference to the services using
+        it, in first-use order
+
+    Raises
+    ------
+    RuntimeError
+        If a compose file cannot be loaded or interpolated
+    """
+    images = {}
+    for service, chain in chains.items():
+        compose_doc = interpolate(load_compose_chain(chain), env)
+        for definition in (compose_doc.get("services") or {}).values():
+            image = (definition or {}).get("image")
+            if not image:
+                continue
+            users = images.setdefault(normalize_image_reference(image), [])
+            if service not in users:
+                users.append(service)
+    return images
+
+
+def _get_bearer_token(challenge, timeout):
+    """Get an anonymous token for a ``WWW-Authenticate: Bearer`` challenge."""
+    import re
+    from urllib.parse import urlencode
+    from urllib.request import urlopen
+
+    params = dict(re.findall(r'(\w+)="([^"]*)"', challenge))
+    realm = params.pop("realm", None)
+    if realm is None:
+        raise RuntimeError(f"Unsupported registry authentication: {challenge}")
+    with urlopen(f"{realm}?{urlencode(params)}", timeout=timeout) as response:
+        payload = json.loads(response.read())
+    return payload.get("token") or payload.get("access_token")
+
+
+def get_remote_digest(reference, timeout=10):
+    """
+    Get the digest a registry currently serves for an image tag.
+
+    Parameters
+    ----------
+    reference : str
+        Image reference
+    timeout : float
+        Timeout of each HTTP request in seconds
+
+    Returns
+    -------
+    str
+        Manifest digest, e.g. ``sha256:...``
+
+    Raises
+    ------
+    RuntimeError
+        If the registry cannot be reached or does not know the image
+    """
+    from urllib.error import HTTPError, URLError
+    from urllib.request import Request, urlopen
+
+    registry, repository, version = parse_image_reference(reference)
+    if version.startswith("sha256:"):
+        return version
+    host = "registry-1.docker.io" if registry == DEFAULT_REGISTRY else registry
+    scheme = "http" if is_insecure_registry(registry) else "https"
+    url = f"{scheme}://{host}/v2/{repository}/manifests/{version}"
+
+    headers = {"Accept": _MANIFEST_TYPES}
+    for attempt in range(2):
+        request = Request(url, headers=headers, method="HEAD")
+        try:
+            with urlopen(request, timeout=timeout) as response:
+                digest = response.headers.get("Docker-Content-Digest")
+                if not digest:
+                    raise RuntimeError(f"{registry} did not report a digest for {reference}")
+                return digest
+        except HTTPError as e:
+            challenge = e.headers.get("WWW-Authenticate", "")
+            if e.code == 401 and attempt == 0 and challenge.lower().startswith("bearer"):
+                try:
+                    token = _get_bearer_token(challenge[len("bearer"):].strip(), timeout)
+                except (OSError, ValueError) as token_error:
+                    raise RuntimeError(f"Could not authenticate to {registry}: {token_error}")
+                headers["Authorization"] = f"Bearer {token}"
+                continue
+            raise RuntimeError(f"{registry} answered {e.code} for {reference}")
+        except (URLError, OSError) as e:
+            raise RuntimeError(f"Could not reach {registry}: {e}")
+    raise RuntimeError(f"Could not authenticate to {registry}")
+
+
+def get_pull_command(reference):
+    """
+    Get the ``podman pull`` command for an image.
+
+    Returns
+    -------
+    list[str]
+        Command to run
+    """
+    command = ["podman", "pull"]
+    registry, _, _ = parse_image_reference(reference)
+    if is_insecure_registry(registry):
+        command.append("--tls-verify=false")
+    command.append(reference)
+    return command
+
+
+def check_image(reference, local_digests):
+    """
+    Decide whether an image has to be pulled.
+
+    Parameters
+    ----------
+    reference : str
+        Fully qualified image reference
+    local_digests : set[str] or None
+        Digests of the local image, None if it does not exist locally
+
+    Returns
+    -------
+    tuple[bool, str]
+        (pull, reason)
+
+    Raises
+    ------
+    RuntimeError
+        If a locally built image is missing, since there is no registry to
+        pull it from
+    """
+    registry, _, version = parse_image_reference(reference)
+    if local_digests is None:
+        if registry == LOCAL_REGISTRY:
+            raise RuntimeError(f"{reference} does not exist, build it with nbs-pods build")
+        return True, "not present locally"
+    if registry == LOCAL_REGISTRY or version.startswith("sha256:"):
+        return False, "present locally"
+    try:
+        remote_digest = get_remote_digest(reference)
+    except RuntimeError as e:
+        return False, f"kept local image ({e})"
+    if remote_digest in local_digests:
+        return False, "up to date"
+    return True, f"registry has {remote_digest[:19]}"
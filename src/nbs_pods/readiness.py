@@ -0,0 +1,416 @@
+"""Readiness probes for services.
+
+Probes are declared in a service's compose file under the ``x-nbs-pods``
+extension, e.g.::
+
+    x-nbs-pods:
+      readiness:
+        timeout: 120
+        probes:
+          - type: mongo
+            container: mongo
+          - type: kafka
+            host: localhost
+            port: 9092
+          - type: http
+            url: http://localhost:8000/api/v1/
+
+A probe with ``host`` runs from the host against a published port. A probe
+with ``container`` runs a client inside that compose container via
+``podman exec``, for services that do not publish a port.
+"""
+
+import socket
+import struct
+import subprocess
+import time
+
+from nbs_pods.compose import get_nbs_pods_extension, load_compose_file
+from nbs_pods.podman import exec_in_container, find_containers
+from nbs_pods.trace import span
+
+DEFAULT_TIMEOUT = 120.0
+DEFAULT_PORTS = {
+    "redis": 6379,
+    "mongo": 27017,
+    "kafka": 9092,
+}
+INITIAL_DELAY = 0.1
+MAX_DELAY = 2.0
+BACKOFF = 1.5
+CONNECT_TIMEOUT = 2.0
+
+
+class ProbeError(Exception):
+    """Raised when a probe's target is reachable but not ready."""
+
+
+def _recv_exactly(sock, size):
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ProbeError("Connection closed")
+        data += chunk
+    return data
+
+
+def probe_tcp(host, port, timeout=CONNECT_TIMEOUT):
+    """
+    Check that a TCP port accepts connections.
+
+    Parameters
+    ----------
+    host : str
+        Host name
+    port : int
+        Port number
+    timeout : float
+        Connection timeout in seconds
+    """
+    with socket.create_connection((host, port), timeout=timeout):
+        pass
+
+
+def probe_http(url, timeout=CONNECT_TIMEOUT):
+    """
+    Check that an HTTP server answers a GET request without a server error.
+
+    Parameters
+    ----------
+    url : str
+        URL to request
+    timeout : float
+        Request timeout in seconds
+    """
+    import urllib.error
+    import urllib.request
+
+    try:
+        with urllib.request.urlopen(url, timeout=timeout):
+            pass
+    except urllib.error.HTTPError as e:
+        # A client error still means the server is up and routing requests
+        if e.code >= 500:
+            raise ProbeError(f"HTTP {e.code}")
+
+
+def probe_redis(host, port=DEFAULT_PORTS["redis"], timeout=CONNECT_TIMEOUT):
+    """
+    Check that a Redis server answers PING.
+
+    Parameters
+    ----------
+    host : str
+        Host name
+    port : int
+        Port number
+    timeout : float
+        Connection timeout in seconds
+    """
+    with socket.create_connection((host, port), timeout=timeout) as sock:
+        sock.sendall(b"*1\r\n$4\r\nPING\r\n")
+        reply = sock.recv(64)
+    if not reply.startswith(b"+PONG"):
+        raise ProbeError(reply.decode(errors="replace").strip())
+
+
+def _bson_ok(document):
+    """Get the value of the top-level ``ok`` field of a BSON document."""
+    fixed_sizes = {0x01: 8, 0x07: 12, 0x08: 1, 0x09: 8, 0x0A: 0, 0x10: 4, 0x11: 8, 0x12: 8}
+    pos = 4
+    while pos < len(document) - 1:
+        element_type = document[pos]
+        name_end = document.index(b"\x00", pos + 1)
+        name = document[pos + 1 : name_end]
+        pos = name_end + 1
+        if name == b"ok":
+            if element_type == 0x01:
+                return struct.unpack_from("<d", document, pos)[0]
+            if element_type == 0x10:
+                return struct.unpack_from("<i", document, pos)[0]
+            if element_type == 0x08:
+                return document[pos]
+        if element_type in fixed_sizes:
+            pos += fixed_sizes[element_type]
+        elif element_type == 0x02:
+            pos += 4 + struct.unpack_from("<i", document, pos)[0]
+        elif element_type in (0x03, 0x04):
+            pos += struct.unpack_from("<i", document, pos)[0]
+        elif element_type == 0x05:
+            pos += 5 + struct.unpack_from("<i", document, pos)[0]
+        else:
+            break
+    return None
+
+
+def probe_mongo(host, port=DEFAULT_PORTS["mongo"], timeout=CONNECT_TIMEOUT):
+    """
+    Check that a MongoDB server answers the ``ping`` command.
+
+    Parameters
+    ----------
+    host : str
+        Host name
+    port : int
+        Port number
+    timeout : float
+        Connection timeout in seconds
+    """
+    db = b"admin\x00"
+    elements = (
+        b"\x10ping\x00" + struct.pack("<i", 1)
+        + b"\x02$db\x00" + struct.pack("<i", len(db)) + db
+    )
+    document = struct.pack("<i", len(elements) + 5) + elements + b"\x00"
+    # OP_MSG: flag bits, then a single body section (kind 0)
+    body = struct.pack("<I", 0) + b"\x00" + document
+    header = struct.pack("<iiii", 16 + len(body), 1, 0, 2013)
+
+    with socket.create_connection((host, port), timeout=timeout) as sock:
+        sock.sendall(header + body)
+        length, _, _, op_code = struct.unpack("<iiii", _recv_exactly(sock, 16))
+        reply = _recv_exactly(sock, length - 16)
+    if op_code != 2013:
+        raise ProbeError(f"Unexpected reply op code {op_code}")
+    if _bson_ok(reply[5:]) != 1:
+        raise ProbeError("ping did not return ok")
+
+
+def probe_kafka(host, port=DEFAULT_PORTS["kafka"], timeout=CONNECT_TIMEOUT):
+    """
+    Check that a Kafka broker answers a metadata request with a live broker.
+
+    Parameters
+    ----------
+    host : str
+        Host name
+    port : int
+        Port number
+    timeout : float
+        Connection timeout in seconds
+    """
+    client_id = b"nbs-pods"
+    # Metadata v4 (the oldest version Kafka 4 still accepts): all topics,
+    # no auto-creation
+    request = (
+        struct.pack(">hhih", 3, 4, 1, len(client_id)) + client_id
+        + struct.pack(">i", -1) + b"\x00"
+    )
+    with socket.create_connection((host, port), timeout=timeout) as sock:
+        sock.sendall(struct.pack(">i", len(request)) + request)
+        (length,) = struct.unpack(">i", _recv_exactly(sock, 4))
+        reply = _recv_exactly(sock, length)
+    # correlation id, throttle time, broker count
+    _, _, broker_count = struct.unpack_from(">iii", reply)
+    if broker_count < 1:
+        raise ProbeError("No brokers registered")
+
+
+PROBES = {
+    "tcp": probe_tcp,
+    "http": probe_http,
+    "redis": probe_redis,
+    "mongo": probe_mongo,
+    "kafka": probe_kafka,
+}
+
+
+def get_exec_command(probe):
+    """
+    Get the client command that runs a probe inside its container.
+
+    Parameters
+    ----------
+    probe : dict
+        Probe declaration
+
+    Returns
+    -------
+    tuple[list[str], str | None]
+        (command, expected) where ``expected`` must appear in the output,
+        or None if a zero exit code is enough
+
+    Raises
+    ------
+    ValueError
+        If the probe type cannot run inside a container
+    """
+    probe_type = probe["type"]
+    port = str(probe.get("port", DEFAULT_PORTS.get(probe_type, "")))
+    if probe_type == "redis":
+        return ["redis-cli", "-p", port, "ping"], "PONG"
+    if probe_type == "mongo":
+        command = ["mongosh", "--quiet", "--port", port]
+        return command + ["--eval", "db.adminCommand('ping').ok"], "1"
+    if probe_type == "kafka":
+        return ["kafka-broker-api-versions.sh", "--bootstrap-server", f"localhost:{port}"], None
+    if probe_type == "tcp":
+        return ["bash", "-c", f"exec 3<>/dev/tcp/127.0.0.1/{port}"], None
+    raise ValueError(f"Probe type '{probe_type}' cannot run inside a container")
+
+
+def run_probe(probe, project):
+    """
+    Run a probe once.
+
+    Parameters
+    ----------
+    probe : dict
+        Probe declaration
+    project : str
+        Compose project the probed containers belong to
+
+    Raises
+    ------
+    Exception
+        If the target is not ready yet
+    """
+    if "container" in probe:
+        command, expected = get_exec_command(probe)
+        containers = find_containers(project, probe["container"])
+        if not containers:
+            raise ProbeError(f"Container {probe['container']} is not running")
+        result = exec_in_container(containers[0], command, timeout=CONNECT_TIMEOUT * 5)
+        if result.returncode != 0:
+            raise ProbeError(result.stderr.strip() or f"exit code {result.returncode}")
+        if expected is not None and expected not in result.stdout:
+            raise ProbeError(result.stdout.strip())
+        return
+
+    probe_type = probe["type"]
+    if probe_type == "http":
+        probe_http(probe["url"])
+        return
+    PROBES[probe_type](probe.get("host", "localhost"), int(probe.get("port", DEFAULT_PORTS.get(probe_type, 0))))
+
+
+def get_probe_name(probe):
+    """Get a display name for a probe."""
+    if "name" in probe:
+        return probe["name"]
+    target = probe.get("container") or probe.get("url") or f"{probe.get('host', 'localhost')}:{probe.get('port', '')}"
+    return f"{probe['type']} {target}"
+
+
+def get_readiness_config(compose_files):
+    """
+    Get the readiness declaration for a compose chain.
+
+    Later files in the chain replace the declaration of earlier ones.
+
+    Parameters
+    ----------
+    compose_files : list[str]
+        Compose file paths, base file first
+
+    Returns
+    -------
+    dict
+        Readiness declaration with ``probes`` and ``timeout`` keys
+
+    Raises
+    ------
+    ValueError
+        If a probe has an unknown type
+    """
+    readiness = {}
+    for compose_file in compose_files:
+        extension = get_nbs_pods_extension(load_compose_file(compose_file))
+        if "readiness" in extension:
+            readiness = extension["readiness"] or {}
+
+    probes = readiness.get("probes", [])
+    for probe in probes:
+        if probe.get("type") not in PROBES:
+            raise ValueError(f"Unknown readiness probe type: {probe.get('type')}")
+    return {
+        "probes": probes,
+        "timeout": float(readiness.get("timeout", DEFAULT_TIMEOUT)),
+    }
+
+
+def wait_for_probe(probe, project, deadline, service=None):
+    """
+    Poll a probe with exponential backoff until it succeeds.
+
+    Parameters
+    ----------
+    probe : dict
+        Probe declaration
+    project : str
+        Compose project the probed containers belong to
+    deadline : float
+        ``time.monotonic()`` value to give up at
+    service : str, optional
+        Service name, used for tracing
+
+    Returns
+    -------
+    float
+        Seconds until the probe succeeded
+
+    Raises
+    ------
+    TimeoutError
+        If the probe did not succeed before the deadline
+    """
+    start = time.monotonic()
+    delay = INITIAL_DELAY
+    with span(get_probe_name(probe), "ready", service, row=get_probe_name(probe)):
+        while True:
+            try:
+                run_probe(probe, project)
+                return time.monotonic() - start
+            except (OSError, ProbeError, subprocess.SubprocessError, struct.error) as e:
+                last_error = e
+            if time.monotonic() + delay > deadline:
+                raise TimeoutError(f"{get_probe_name(probe)} not ready: {last_error}")
+            time.sleep(delay)
+            delay = min(delay * BACKOFF, MAX_DELAY)
+
+
+def wait_for_ready(service, compose_files, project):
+    """
+    Wait until all readiness probes of a service succeed.
+
+    Parameters
+    ----------
+    service : str
+        Service name, used for reporting
+    compose_files : list[str]
+        Compose file paths of the service, base file first
+    project : str
+        Compose project the service was started as
+
+    Returns
+    -------
+    float | None
+        Seconds until the service was ready, or None if it declares no probes
+
+    Raises
+    ------
+    TimeoutError
+        If any probe did not succeed within the service's timeout
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    config = get_readiness_config(compose_files)
+    probes = config["probes"]
+    if not probes:
+        return None
+
+    start = time.monotonic()
+    deadline = start + config["timeout"]
+    with ThreadPoolExecutor(max_workers=len(probes)) as executor:
+        futures = [
+            executor.submit(wait_for_probe, probe, project, deadline, service)
+            for probe in probes
+        ]
+        for probe, future in zip(probes, futures):
+            elapsed = future.result()
+            print(f"  [{service}] {get_probe_name(probe)} ready after {elapsed:.1f}s\n", end="", flush=True)
+
+    elapsed = time.monotonic() - start
+    print(f"{service} ready in {elapsed:.1f}s\n", end="", flush=True)
+    return elapsed
@@ -0,0 +1,186 @@
+"""Resource profiles: CPU, memory and I/O settings as a compose override layer.
+
+Presets are read from ``resources.yml`` in the beamline pods directory and
+from the defaults shipped in nbs-pods' ``config/resources.yml``; a beamline
+preset replaces a shipped preset of the same name. A preset maps nbs-pods
+services to resource settings, applied to every container of the service,
+with per-container settings under ``containers``::
+
+    profile: acquisition        # active preset, unless NBS_PODS_PROFILE is set
+    presets:
+      acquisition:
+        queueserver:
+          cpuset: "2-3"
+          cpu_shares: 4096
+        gui:
+          cpus: 2
+          mem_limit: 4g
+        bluesky-services:
+          containers:
+            mongo:
+              mem_limit: 2g
+
+The settings of the active preset are written to a generated compose file
+that is chained after the service's other override files.
+"""
+
+import os
+
+from nbs_pods.config import get_cache_dir, load_profile_files, write_json
+
+RESOURCES_KEY = "resources"
+PROFILE_ENV = "NBS_PODS_PROFILE"
+
+# Profile setting -> compose service key
+RESOURCE_SETTINGS = {
+    "cpus": "cpus",
+    "cpu_shares": "cpu_shares",
+    "cpuset": "cpuset",
+    "mem_limit": "mem_limit",
+    "memory": "mem_limit",
+    "mem_reservation": "mem_reservation",
+    "memswap_limit": "memswap_limit",
+    "pids_limit": "pids_limit",
+    "io_weight": "blkio_config",
+}
+
+
+def load_profiles():
+    """
+    Load the resource presets and the configured active preset.
+
+    Returns
+    -------
+    tuple[dict, str | None]
+        (presets, active), see ``load_profile_files``
+    """
+    return load_profile_files("resources.yml", "resource")
+
+
+def get_active_profile():
+    """
+    Get the name of the resource preset to apply.
+
+    Returns
+    -------
+    str | None
+        NBS_PODS_PROFILE if set, otherwise the ``profile`` of the profile
+        files; None (or 'none') applies no preset
+    """
+    profile = os.getenv(PROFILE_ENV)
+    if profile is None:
+        _, profile = load_profiles()
+    if not profile or profile == "none":
+        return None
+    return profile
+
+
+def translate_settings(settings, where):
+    """
+    Translate profile settings to compose service keys.
+
+    Parameters
+    ----------
+    settings : dict
+        Profile settings, e.g. ``{"memory": "4g", "io_weight": 500}``
+    where : str
+        Description of the settings' location, for error messages
+
+    Returns
+    -------
+    dict
+        Compose service keys
+
+    Raises
+    ------
+    RuntimeError
+        If a setting is not a known resource setting
+    """
+    compose = {}
+    for key, value in settings.items():
+        if key not in RESOURCE_SETTINGS:
+            raise RuntimeError(
+                f"Unknown resource setting '{key}' in {where}; "
+                f"use one of {', '.join(RESOURCE_SETTINGS)}"
+            )
+        if key == "io_weight":
+            value = {"weight": int(value)}
+        compose[RESOURCE_SETTINGS[key]] = value
+    return compose
+
+
+def get_service_resources(service, container_names, profile=None):
+    """
+    Get the compose resource settings a preset gives a service's containers.
+
+    Parameters
+    ----------
+    service : str
+        nbs-pods service name
+    container_names : list[str]
+        Compose service (container) names of the service
+    profile : str, optional
+        Preset name, defaults to ``get_active_profile()``
+
+    Returns
+    -------
+    dict[str, dict]
+        Mapping of container name to compose resource keys; empty if no
+        preset is active or it does not mention the service
+
+    Raises
+    ------
+    RuntimeError
+        If the preset does not exist or has unknown settings
+    """
+    presets, _ = load_profiles()
+    profile = profile or get_active_profile()
+    if profile is None:
+        return {}
+    if profile not in presets:
+        raise RuntimeError(
+            f"Unknown resource profile '{profile}'; available: {', '.join(presets) or 'none'}"
+        )
+    settings = dict((presets[profile] or {}).get(service) or {})
+    per_container = settings.pop("containers", None) or {}
+    where = f"profile '{profile}', service '{service}'"
+    common = translate_settings(settings, where)
+
+    resources = {}
+    for name in container_names:
+        values = dict(common)
+        values.update(translate_settings(per_container.get(name) or {}, f"{where}, container '{name}'"))
+        if values:
+            resources[name] = values
+    unknown = set(per_container) - set(container_names)
+    if unknown:
+        raise RuntimeError(f"No container {', '.join(sorted(unknown))} in {where}")
+    return resources
+
+
+def write_resource_override(service, compose_file_string):
+    """
+    Write the resource override layer of a service.
+
+    Parameters
+    ----------
+    service : str
+        nbs-pods service name
+    compose_file_string : str
+        Colon-separated compose file chain the layer is chained after
+
+    Returns
+    -------
+    Path | None
+        Path to the override file, or None if the active preset sets no
+        resources for the service
+    """
+    if get_active_profile() is None:
+        return None
+    from nbs_pods.compose import load_compose_chain
+
+    container_names = list((load_compose_chain(compose_file_string).get("services") or {}))
+    resources = get_service_resources(service, container_names)
+    if not resources:
+        return None
+    return write_json(get_cache_dir() / RESOURCES_KEY / f"{service}.yml", {"services": resources})
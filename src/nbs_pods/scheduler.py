@@ -0,0 +1,166 @@
+"""Dependency-ordered, concurrent execution of service operations."""
+
+import os
+
+DEFAULT_JOBS = 4
+
+
+def get_default_jobs():
+    """
+    Get the default parallelism limit.
+
+    Returns
+    -------
+    int
+        Value of NBS_PODS_JOBS, or DEFAULT_JOBS if not set
+    """
+    jobs = os.getenv("NBS_PODS_JOBS")
+    if jobs:
+        return max(1, int(jobs))
+    return DEFAULT_JOBS
+
+
+def build_dependency_graph(services, get_dependencies):
+    """
+    Build a dependency graph restricted to a set of services.
+
+    Dependencies on services outside of ``services`` are dropped, since
+    they are assumed to be running already (or deliberately not requested).
+
+    Parameters
+    ----------
+    services : list[str]
+        Services to include in the graph
+    get_dependencies : callable
+        Function mapping a service name to the services it depends on
+
+    Returns
+    -------
+    dict[str, set[str]]
+        Mapping of service to the set of services it depends on
+    """
+    selected = set(services)
+    graph = {}
+    for service in services:
+        graph[service] = {
+            dep for dep in get_dependencies(service) if dep in selected and dep != service
+        }
+    return graph
+
+
+def reverse_graph(graph):
+    """
+    Reverse a dependency graph, e.g. to stop dependents before dependencies.
+
+    Parameters
+    ----------
+    graph : dict[str, set[str]]
+        Mapping of service to the set of services it depends on
+
+    Returns
+    -------
+    dict[str, set[str]]
+        Mapping of service to the set of services that depend on it
+    """
+    reversed_graph = {service: set() for service in graph}
+    for service, deps in graph.items():
+        for dep in deps:
+            reversed_graph[dep].add(service)
+    return reversed_graph
+
+
+def check_for_cycles(graph):
+    """
+    Check that a dependency graph is acyclic.
+
+    Parameters
+    ----------
+    graph : dict[str, set[str]]
+        Mapping of service to the set of services it depends on
+
+    Raises
+    ------
+    RuntimeError
+        If the graph contains a dependency cycle
+    """
+    remaining = {service: set(deps) for service, deps in graph.items()}
+    while remaining:
+        ready = [service for service, deps in remaining.items() if not deps]
+        if not ready:
+            cycle = ", ".join(sorted(remaining))
+            raise RuntimeError(f"Dependency cycle between services: {cycle}")
+        for service in ready:
+            del remaining[service]
+        for deps in remaining.values():
+            deps.difference_update(ready)
+
+
+def run_in_dependency_order(graph, func, max_workers=None):
+    """
+    Run ``func`` for every service, as soon as all of its dependencies are done.
+
+    Independent services run concurrently, up to ``max_workers`` at a time.
+    If ``func`` raises for a service, every service that (transitively)
+    depends on it is skipped, while unrelated services still run.
+
+    Parameters
+    ----------
+    graph : dict[str, set[str]]
+        Mapping of service to the set of services it depends on
+    func : callable
+        Function called with a service name; raises on failure
+    max_workers : int, optional
+        Parallelism limit, defaults to ``get_default_jobs()``
+
+    Returns
+    -------
+    tuple[dict, dict, list]
+        (results, errors, skipped) where ``results`` maps successful services
+        to the return value of ``func``, ``errors`` maps failed services to
+        the raised exception, and ``skipped`` lists services that were not
+        run because a dependency failed
+
+    Raises
+    ------
+    RuntimeError
+        If the graph contains a dependency cycle
+    """
+    from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+    check_for_cycles(graph)
+    if max_workers is None:
+        max_workers = get_default_jobs()
+
+    pending = {service: set(deps) for service, deps in graph.items()}
+    results = {}
+    errors = {}
+    skipped = []
+    running = {}
+
+    def skip_dependents(failed):
+        for service, deps in list(pending.items()):
+            if failed in deps:
+                del pending[service]
+                skipped.append(service)
+                skip_dependents(service)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            # Keep submission order stable so output is predictable with -j 1
+            for service in [s for s in graph if s in pending and not pending[s]]:
+                del pending[service]
+                running[executor.submit(func, service)] = service
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                service = running.pop(future)
+                try:
+                    results[service] = future.result()
+                except Exception as e:
+                    errors[service] = e
+                    skip_dependents(service)
+                    continue
+                for deps in pending.values():
+                    deps.discard(service)
+
+    return results, errors, skipped
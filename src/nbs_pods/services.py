@@ -1,17 +1,15 @@
 """Service discovery and management."""
 
-from pathlib import Path
-
-from nbs_pods.config import get_beamline_pods_dir, get_nbs_pods_dir
-from glob import glob
-
-BASE_SERVICES = [
-    "bluesky-services",
-    "queueserver",
-    "gui",
-    "sim",
-    "viewer",
-]
+from nbs_pods.compose import (
+    build_compose_file_string,
+    get_nbs_pods_extension,
+    load_compose_file,
+)
+from nbs_pods.index import (
+    get_base_services,
+    get_beamline_services,
+    get_gui_services,
+)
 
 
 def discover_base_services():
@@ -23,22 +21,7 @@ def discover_base_services():
     list[str]
         List of base service names
     """
-    nbs_pods_dir = get_nbs_pods_dir()
-    compose_dir = nbs_pods_dir / "compose"
-
-    if not compose_dir.exists():
-        return BASE_SERVICES
-
-    services = []
-    for item in compose_dir.iterdir():
-        if item.is_dir():
-            docker_compose_files = item.glob("docker-compose*.yml")
-            for compose_file in docker_compose_files:
-                if compose_file.exists():
-                    services.append(item.name)
-                    break
-
-    return sorted(services) if services else BASE_SERVICES
+    return get_base_services()
 
 
 def discover_beamline_services():
@@ -50,57 +33,15 @@ def discover_beamline_services():
     list[str]
         List of beamline service names
     """
-    beamline_pods_dir = get_beamline_pods_dir()
-    nbs_pods_dir = get_nbs_pods_dir()
-
-    if beamline_pods_dir == nbs_pods_dir:
-        return []
-
-    base_services = set(discover_base_services())
-    services = []
-
-    compose_dir = beamline_pods_dir / "compose"
-    if compose_dir.exists():
-        for item in compose_dir.iterdir():
-            if item.is_dir() and item.name not in base_services:
-                compose_files = glob(str(item / "docker-compose*.yml"))
-                for compose_file in compose_files:
-                    if Path(compose_file).exists():
-                        services.append(item.name)
-                        break
-
-    beamline_subdir = compose_dir / "beamline"
-    if beamline_subdir.exists():
-        for item in beamline_subdir.iterdir():
-            if item.is_dir():
-                compose_file = item / "docker-compose.yml"
-                if compose_file.exists() and item.name not in services:
-                    services.append(item.name)
-
-    return sorted(services)
+    return get_beamline_services()
+
 
 def discover_gui_services():
     """
     Discover GUI services.
     """
-    beamline_pods_dir = get_beamline_pods_dir()
-    nbs_pods_dir = get_nbs_pods_dir()
-
-    if beamline_pods_dir == nbs_pods_dir:
-        return []
-
-    services = ["gui", "viewer"]
+    return get_gui_services()
 
-    compose_dir = beamline_pods_dir / "compose"
-    if compose_dir.exists():
-        for item in compose_dir.iterdir():
-            if item.is_dir() and item.name not in services:
-                x11_compose_file = item / "docker-compose.x11.yml"
-                wayland_compose_file = item / "docker-compose.wayland.yml"
-                if x11_compose_file.exists() or wayland_compose_file.exists():
-                    services.append(item.name)
-
-    return sorted(services)
 
 def get_all_services():
     """
@@ -114,3 +55,48 @@ def get_all_services():
     base_services = discover_base_services()
     beamline_services = discover_beamline_services()
     return base_services, beamline_services
+
+
+def get_service_dependencies(service, all_services, gui_services=["gui", "viewer"]):
+    """
+    Get the services that a service depends on.
+
+    Dependencies are taken from two places in the service's compose files:
+
+    - external networks named ``<service>_<network>``, which are created by
+      the compose project of another service (e.g. ``bluesky-services_bluesky``)
+    - an explicit ``x-nbs-pods: depends_on:`` list
+
+    Parameters
+    ----------
+    service : str
+        Service name
+    all_services : list[str]
+        All known services
+    gui_services : list[str]
+        Services with display protocol specific compose files
+
+    Returns
+    -------
+    list[str]
+        Sorted list of service names
+    """
+    compose_file_string = build_compose_file_string(service, gui_services=gui_services)
+    dependencies = set()
+    for compose_file in compose_file_string.split(":"):
+        compose_doc = load_compose_file(compose_file)
+
+        extension = get_nbs_pods_extension(compose_doc)
+        dependencies.update(extension.get("depends_on", []))
+
+        for key, network in (compose_doc.get("networks") or {}).items():
+            network = network or {}
+            if not network.get("external"):
+                continue
+            network_name = network.get("name", key)
+            for other in all_services:
+                if other != service and network_name.startswith(f"{other}_"):
+                    dependencies.add(other)
+
+    dependencies.discard(service)
+    return sorted(dependencies)
@@ -0,0 +1,456 @@
+"""Multi-beamline mode: one bluesky-services stack shared by several beamlines.
+
+With ``--shared`` (or ``NBS_PODS_SHARED=1``), ``bluesky-services`` runs once
+per host, from the compose chain of the beamline that started it. Every
+beamline that starts it afterwards joins the running stack, and ``stop``
+only tears it down when the last beamline leaves. Beamlines are recorded in
+``$XDG_STATE_HOME/nbs-pods/shared/``, under a file lock.
+
+A beamline's own services run in compose projects named
+``<beamline>-<service>``, on a per-beamline network ``nbs-<beamline>`` that
+the shared containers join under their usual host names, so queueserver,
+gui and simulated IOCs of different beamlines do not see each other. Their
+data is namespaced by the beamline name through a generated override layer:
+
+- Kafka: the RunEngine publishes to ``<beamline>.bluesky.runengine.documents``
+  and the gui and viewer consume it
+- Mongo: documents are written to ``<beamline>-<database>``, which Tiled
+  serves under ``/<beamline>``
+- Redis: metadata and queueserver keys are prefixed with the beamline name
+
+The namespaced settings are rewritten into copies of the beamline's
+``beamline.toml``, ``gui_config.toml``, ``viewer_config.toml`` and Tiled
+profiles, which are mounted over the originals.
+"""
+
+import fcntl
+import json
+import os
+import re
+import subprocess
+from contextlib import contextmanager
+
+from nbs_pods.config import (
+    get_beamline_name,
+    get_beamline_pods_dir,
+    get_cache_dir,
+    get_nbs_pods_dir,
+    get_shared_state_dir,
+    write_file,
+    write_json,
+)
+
+SHARED_ENV = "NBS_PODS_SHARED"
+SHARED_KEY = "shared"
+SHARED_SERVICE = "bluesky-services"
+# Network key under which services join the bluesky-services network
+SHARED_NETWORK = "bluesky-services_bluesky"
+
+TILED_CONTAINER = "tiled_server"
+MONGO_INIT_CONTAINER = "mongo-init"
+TILED_CONFIG_TARGET = "/etc/nbs-pods/tiled"
+TILED_PROFILES_TARGET = "/etc/tiled/profiles"
+STARTUP_TARGET = "/usr/local/share/ipython/profile_default/startup"
+STARTUP_FILES = ("beamline.toml", "gui_config.toml", "viewer_config.toml")
+
+_SECTION_RE = re.compile(r"^\s*\[\[?\s*([^\]]+?)\s*\]\]?\s*(#.*)?$")
+_STRING_RE = re.compile(r'^(\s*)([\w-]+)(\s*=\s*)"([^"]*)"(.*)$')
+_MONGO_URI_RE = re.compile(r"(mongodb://[^/\s\"']+/)([^?\s\"']+)")
+
+
+def is_shared_mode():
+    """
+    Whether the current beamline uses the shared bluesky-services stack.
+
+    Returns
+    -------
+    bool
+        True if NBS_PODS_SHARED is set, or the beamline joined the shared
+        stack and has not left it yet
+    """
+    if os.getenv(SHARED_ENV, "").lower() in ("1", "true", "yes", "on"):
+        return True
+    return get_beamline_name() in load_shared_state()["beamlines"]
+
+
+def get_beamline_namespace(beamline=None):
+    """
+    Get the name a beamline's topics, databases and prefixes start with.
+
+    Parameters
+    ----------
+    beamline : str, optional
+        Beamline name, defaults to ``get_beamline_name()``
+
+    Returns
+    -------
+    str
+        The lower-cased beamline name without punctuation
+    """
+    beamline = beamline or get_beamline_name()
+    return re.sub(r"[^a-z0-9]", "", beamline.lower()) or "beamline"
+
+
+def get_beamline_network(beamline=None):
+    """Get the name of the network of a beamline's services."""
+    return f"nbs-{get_beamline_namespace(beamline)}"
+
+
+def get_kafka_topic(beamline=None):
+    """Get the Kafka topic a beamline's RunEngine publishes documents to."""
+    return f"{get_beamline_namespace(beamline)}.bluesky.runengine.documents"
+
+
+@contextmanager
+def shared_lock():
+    """Hold the lock serializing changes to the shared stack between beamlines."""
+    with open(get_shared_state_dir() / f"{SHARED_SERVICE}.lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def load_shared_state():
+    """
+    Get the beamlines using the shared stack and the chain it runs from.
+
+    Returns
+    -------
+    dict
+        ``{"beamlines": [...], "compose_file": ...}``; ``compose_file`` is
+        None if the stack is not running
+    """
+    try:
+        with open(get_shared_state_dir() / f"{SHARED_SERVICE}.json", encoding="utf-8") as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return {"beamlines": [], "compose_file": None}
+    compose_file = state.get("compose_file")
+    if compose_file and not all(os.path.exists(f) for f in compose_file.split(":")):
+        compose_file = None
+    return {"beamlines": list(state.get("beamlines") or []), "compose_file": compose_file}
+
+
+def save_shared_state(state):
+    """
+    Record the beamlines using the shared stack; call with the lock held.
+
+    Parameters
+    ----------
+    state : dict
+        State from ``load_shared_state``
+    """
+    write_json(get_shared_state_dir() / f"{SHARED_SERVICE}.json", state)
+
+
+def namespace_mongo_uris(text, beamline=None):
+    """Prefix the database of every ``mongodb://`` URI in a text with the beamline."""
+    namespace = get_beamline_namespace(beamline)
+    return _MONGO_URI_RE.sub(lambda m: f"{m.group(1)}{namespace}-{m.group(2)}", text)
+
+
+def namespace_settings(text, beamline=None):
+    """
+    Rewrite the namespaced settings of a beamline's startup TOML file.
+
+    Parameters
+    ----------
+    text : str
+        Contents of ``beamline.toml``, ``gui_config.toml`` or
+        ``viewer_config.toml``
+    beamline : str, optional
+        Beamline name, defaults to ``get_beamline_name()``
+
+    Returns
+    -------
+    str
+        The text with the Kafka name and acronyms, Redis prefixes and Tiled
+        catalog URLs of the beamline
+    """
+    namespace = get_beamline_namespace(beamline)
+    section = ""
+    lines = []
+    for line in text.splitlines(keepends=True):
+        match = _SECTION_RE.match(line)
+        if match:
+            section = match.group(1)
+            lines.append(line)
+            continue
+        match = _STRING_RE.match(line.rstrip("\n"))
+        if match:
+            indent, key, equals, value, rest = match.groups()
+            if (section, key) == ("settings.kafka", "name") or key in ("bl_acronym", "beamline_acronym"):
+                value = namespace
+            elif section.startswith("settings.redis.") and key == "prefix":
+                value = f"{namespace}-"
+            elif section == "catalog" and key == "url" and value.startswith("http"):
+                value = f"{value.rstrip('/')}/api/v1/metadata/{namespace}"
+            line = f'{indent}{key}{equals}"{value}"{rest}' + ("\n" if line.endswith("\n") else "")
+        lines.append(line)
+    return "".join(lines)
+
+
+def write_namespaced_files(beamline=None):
+    """
+    Write the beamline's startup files and Tiled profiles with namespaced settings.
+
+    Sources are the beamline pods directory's ``config/ipython`` startup
+    files and nbs-pods' Tiled profiles, which the images ship.
+
+    Returns
+    -------
+    list[str]
+        Compose volume entries mounting the files over the originals
+    """
+    namespace = get_beamline_namespace(beamline)
+    target_dir = get_shared_state_dir() / "beamlines" / namespace
+    sources = []
+    startup_dir = get_beamline_pods_dir() / "config" / "ipython" / "profile_default" / "startup"
+    for name in STARTUP_FILES:
+        if (startup_dir / name).is_file():
+            sources.append((startup_dir / name, "startup", f"{STARTUP_TARGET}/{name}", namespace_settings))
+    profiles_dir = get_nbs_pods_dir() / "config" / "tiled" / "profiles"
+    for path in sorted(profiles_dir.glob("*.yml")):
+        sources.append((path, "tiled", f"{TILED_PROFILES_TARGET}/{path.name}", namespace_mongo_uris))
+
+    volumes = []
+    for path, subdir, target, rewrite in sources:
+        output = target_dir / subdir / path.name
+        text = rewrite(path.read_text(encoding="utf-8"), beamline)
+        if not output.is_file() or output.read_text(encoding="utf-8") != text:
+            write_file(output, text)
+        volumes.append(f"{output}:{target}:ro")
+    return volumes
+
+
+def write_tiled_config(beamlines):
+    """
+    Write the shared Tiled server configuration, one tree per beamline.
+
+    Every tree of nbs-pods' Tiled config is served under ``/<beamline>``
+    from the beamline's namespaced database.
+
+    Parameters
+    ----------
+    beamlines : list[str]
+        Beamlines using the shared stack
+
+    Returns
+    -------
+    Path
+        Directory containing the configuration
+    """
+    import yaml
+
+    with open(get_nbs_pods_dir() / "config" / "tiled" / "config" / "config.yml", encoding="utf-8") as f:
+        config = yaml.safe_load(f) or {}
+    trees = []
+    for beamline in beamlines:
+        namespace = get_beamline_namespace(beamline)
+        for tree in config.get("trees") or []:
+            tree = json.loads(namespace_mongo_uris(json.dumps(tree), beamline))
+            tree["path"] = f"/{namespace}/{tree.get('path', '/').strip('/')}".rstrip("/")
+            trees.append(tree)
+    config["trees"] = trees
+    config_dir = get_shared_state_dir() / "tiled"
+    write_json(config_dir / "config.yml", config)
+    return config_dir
+
+
+def write_shared_override(service, compose_file_string):
+    """
+    Write the shared-mode override layer of a service.
+
+    For bluesky-services, the layer serves the shared Tiled configuration;
+    for services on its network, it moves them to the beamline's network
+    and mounts the namespaced configuration.
+
+    Parameters
+    ----------
+    service : str
+        nbs-pods service name
+    compose_file_string : str
+        Colon-separated compose file chain the layer is chained after
+
+    Returns
+    -------
+    Path | None
+        Path to the override file, or None outside shared mode or for
+        services that do not use bluesky-services
+    """
+    if not is_shared_mode():
+        return None
+    from nbs_pods.compose import load_compose_chain
+
+    compose_doc = load_compose_chain(compose_file_string)
+    containers = list(compose_doc.get("services") or {})
+    if service == SHARED_SERVICE:
+        if TILED_CONTAINER not in containers:
+            return None
+        config_dir = write_tiled_config(load_shared_state()["beamlines"])
+        override = {
+            "services": {
+                TILED_CONTAINER: {
+                    "command": f"tiled serve config {TILED_CONFIG_TARGET} --host 0.0.0.0",
+                    "volumes": [f"{config_dir}:{TILED_CONFIG_TARGET}:ro"],
+                }
+            }
+        }
+        if MONGO_INIT_CONTAINER in containers:
+            # Index the namespaced databases the shared Tiled serves
+            with open(config_dir / "config.yml", encoding="utf-8") as f:
+                databases = sorted({m.group(2) for m in _MONGO_URI_RE.finditer(f.read())})
+            override["services"][MONGO_INIT_CONTAINER] = {
+                "environment": [f"MONGO_INDEX_DATABASES={','.join(databases)}"]
+            }
+        override_file = get_shared_state_dir() / "compose" / f"{service}.yml"
+    else:
+        if SHARED_NETWORK not in (compose_doc.get("networks") or {}):
+            return None
+        namespace = get_beamline_namespace()
+        environment = [
+            f"NBS_BEAMLINE_ACRONYM={namespace}",
+            f"QS_REDIS_NAME_PREFIX={namespace}_qs",
+        ]
+        volumes = write_namespaced_files()
+        override = {
+            "networks": {SHARED_NETWORK: {"external": True, "name": get_beamline_network()}},
+            "services": {
+                name: {"environment": environment, "volumes": volumes} for name in containers
+            },
+        }
+        override_file = get_cache_dir() / SHARED_KEY / f"{service}.yml"
+    write_json(override_file, override)
+    return override_file
+
+
+def connect_project_network(project, network):
+    """
+    Create a network and connect the running containers of a project to it.
+
+    The containers keep their compose service names as aliases, so services
+    on the network reach them as ``mongo``, ``kafka`` and so on.
+
+    Parameters
+    ----------
+    project : str
+        Compose project whose containers to connect
+    network : str
+        Network name
+
+    Raises
+    ------
+    RuntimeError
+        If the network cannot be created or a container cannot join it
+    """
+    from nbs_pods.podman import get_project_containers
+
+    result = subprocess.run(
+        ["podman", "network", "create", "--ignore", network], capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Could not create network {network}: {result.stderr.strip()}")
+    for name, container in get_project_containers(project).items():
+        result = subprocess.run(
+            ["podman", "network", "connect", "--alias", name, network, container],
+            capture_output=True,
+            text=True,
+        )
+        if result.returncode != 0 and "already" not in result.stderr:
+            raise RuntimeError(f"Could not connect {container} to {network}: {result.stderr.strip()}")
+
+
+def disconnect_project_network(project, network):
+    """
+    Disconnect the containers of a project from a network.
+
+    Failures are ignored, since the network may already be gone.
+
+    Parameters
+    ----------
+    project : str
+        Compose project whose containers to disconnect
+    network : str
+        Network name
+    """
+    from nbs_pods.podman import get_project_containers
+
+    for container in get_project_containers(project).values():
+        subprocess.run(
+            ["podman", "network", "disconnect", network, container], capture_output=True
+        )
+
+
+def connect_beamline_network(project, beamline=None):
+    """
+    Create a beamline's network and connect the shared containers to it.
+
+    Parameters
+    ----------
+    project : str
+        Compose project of the shared stack
+
+    Raises
+    ------
+    RuntimeError
+        If the network cannot be created or a container cannot join it
+    """
+    connect_project_network(project, get_beamline_network(beamline))
+
+
+def disconnect_beamline_network(project, beamline=None):
+    """
+    Disconnect the shared containers from a beamline's network and remove it.
+
+    Failures are ignored, since the network may already be gone.
+
+    Parameters
+    ----------
+    project : str
+        Compose project of the shared stack
+    """
+    network = get_beamline_network(beamline)
+    disconnect_project_network(project, network)
+    subprocess.run(["podman", "network", "rm", network], capture_output=True)
+
+
+def create_kafka_topic(project, beamline=None):
+    """
+    Create a beamline's document topic on the shared Kafka broker.
+
+    The topic gets the partition count of the active Kafka profile; an
+    existing topic with fewer partitions gets partitions added.
+
+    Parameters
+    ----------
+    project : str
+        Compose project of the shared stack
+
+    Returns
+    -------
+    bool
+        Whether the topic exists now; if not, Kafka creates it on first use
+    """
+    from nbs_pods.kafka import get_active_kafka_profile, get_topic_partitions
+    from nbs_pods.podman import exec_in_container, get_project_containers
+
+    container = get_project_containers(project).get("kafka")
+    if container is None:
+        return False
+    topic = ["--bootstrap-server", "kafka:29092", "--topic", get_kafka_topic(beamline)]
+    partitions = ["--partitions", str(get_topic_partitions(get_active_kafka_profile()))]
+    try:
+        created = exec_in_container(
+            container,
+            ["kafka-topics.sh", "--create", "--if-not-exists", *topic, *partitions,
+             "--replication-factor", "1"],
+            timeout=60,
+        ).returncode == 0
+        if created:
+            # Fails if the topic already has as many partitions
+            exec_in_container(container, ["kafka-topics.sh", "--alter", *topic, *partitions], timeout=60)
+        return created
+    except subprocess.TimeoutExpired:
+        return False
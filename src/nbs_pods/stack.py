@@ -0,0 +1,172 @@
+"""Whole-stack operations through a single merged compose project."""
+
+import re
+
+from nbs_pods.compose import get_compose_project, load_compose_chain
+from nbs_pods.config import get_beamline_name, get_cache_dir
+
+SERVICE_LABEL = "io.nbs-pods.service"
+
+
+def get_stack_project():
+    """
+    Get the compose project name used for the merged stack.
+
+    Returns
+    -------
+    str
+        ``nbs-<beamline>``, normalized for podman-compose
+    """
+    return re.sub(r"[^a-z0-9_-]", "", f"nbs-{get_beamline_name()}".lower())
+
+
+def _qualify(resources, project):
+    """
+    Map a project's network or volume keys to their real podman names.
+
+    Returns
+    -------
+    tuple[dict, dict]
+        (names, definitions) mapping each key to its podman name, and each
+        podman name to a definition that no longer depends on the project
+    """
+    names = {}
+    definitions = {}
+    for key, definition in (resources or {}).items():
+        definition = dict(definition or {})
+        if definition.get("external"):
+            name = definition.get("name", key)
+        else:
+            name = definition.get("name", f"{project}_{key}")
+        definition["name"] = name
+        names[key] = name
+        definitions[name] = definition
+    return names, definitions
+
+
+def _rename_service_networks(networks, names):
+    if isinstance(networks, dict):
+        return {names.get(key, key): value for key, value in networks.items()}
+    return [names.get(key, key) for key in networks]
+
+
+def _rename_service_volumes(volumes, names):
+    renamed = []
+    for volume in volumes:
+        if isinstance(volume, dict):
+            if volume.get("type", "volume") == "volume" and volume.get("source") in names:
+                volume = dict(volume, source=names[volume["source"]])
+        else:
+            source, sep, rest = str(volume).partition(":")
+            if sep and source in names:
+                volume = names[source] + sep + rest
+        renamed.append(volume)
+    return renamed
+
+
+def build_stack_document(chains):
+    """
+    Merge the compose chains of several services into one compose document.
+
+    Every network and volume is keyed by the name it would have had in the
+    service's own project (e.g. ``bluesky-services_bluesky``) and given that
+    name explicitly, so services using it as an external network find it
+    whether or not its owner is part of the stack. A definition from the
+    owning service replaces external references to the same name.
+
+    Parameters
+    ----------
+    chains : dict[str, str]
+        Mapping of service name to its colon-separated compose file chain
+
+    Returns
+    -------
+    dict
+        Merged compose document
+
+    Raises
+    ------
+    RuntimeError
+        If two services define a container with the same name
+    """
+    stack = {"services": {}, "networks": {}, "volumes": {}}
+    owners = {}
+
+    for service, compose_file_string in chains.items():
+        project = get_compose_project(compose_file_string)
+        compose_doc = load_compose_chain(compose_file_string)
+
+        network_names, networks = _qualify(compose_doc.get("networks"), project)
+        volume_names, volumes = _qualify(compose_doc.get("volumes"), project)
+        for merged, definitions in ((stack["networks"], networks), (stack["volumes"], volumes)):
+            for name, definition in definitions.items():
+                if name not in merged or merged[name].get("external"):
+                    merged[name] = definition
+
+        for name, definition in (compose_doc.get("services") or {}).items():
+            if name in stack["services"]:
+                raise RuntimeError(
+                    f"Container '{name}' is defined by both {owners[name]} and {service}"
+                )
+            definition = dict(definition)
+            if "networks" in definition:
+                definition["networks"] = _rename_service_networks(
+                    definition["networks"], network_names
+                )
+            if "volumes" in definition:
+                definition["volumes"] = _rename_service_volumes(
+                    definition["volumes"], volume_names
+                )
+            labels = definition.get("labels") or {}
+            if isinstance(labels, list):
+                labels = dict(label.partition("=")[::2] for label in labels)
+            definition["labels"] = {**labels, SERVICE_LABEL: service}
+            stack["services"][name] = definition
+            owners[name] = service
+
+    return {key: value for key, value in stack.items() if value}
+
+
+def get_stack_containers(stack_doc, services):
+    """
+    Get the compose container names belonging to some services of a stack.
+
+    Parameters
+    ----------
+    stack_doc : dict
+        Merged compose document from ``build_stack_document``
+    services : list[str]
+        nbs-pods service names
+
+    Returns
+    -------
+    list[str]
+        Compose service (container) names
+    """
+    return [
+        name
+        for name, definition in stack_doc.get("services", {}).items()
+        if definition["labels"][SERVICE_LABEL] in services
+    ]
+
+
+def write_stack_file(stack_doc):
+    """
+    Write a merged compose document to the cache directory.
+
+    Parameters
+    ----------
+    stack_doc : dict
+        Merged compose document
+
+    Returns
+    -------
+    Path
+        Path to the written compose file
+    """
+    import yaml
+
+    stack_file = get_cache_dir() / "stack.yml"
+    with open(stack_file, "w", encoding="utf-8") as f:
+        yaml.safe_dump(stack_doc, f, sort_keys=False)
+    return stack_file
@@ -0,0 +1,114 @@
+"""Recorded compose chains of started services, for stop, pause and resume."""
+
+import json
+import os
+
+from nbs_pods.config import get_state_dir, write_json
+
+RUNNING = "running"
+PAUSED = "paused"
+STOPPED = "stopped"
+
+
+def _get_state_file(service):
+    services_dir = get_state_dir() / "services"
+    services_dir.mkdir(exist_ok=True)
+    return services_dir / f"{service}.json"
+
+
+def save_service_state(service, compose_file_string, status=RUNNING):
+    """
+    Record the compose chain a service was started with.
+
+    Parameters
+    ----------
+    service : str
+        Service name
+    compose_file_string : str
+        Colon-separated compose file chain, including override files
+    status : str
+        RUNNING, PAUSED or STOPPED
+    """
+    state_file = _get_state_file(service)
+    write_json(state_file, {"compose_file": compose_file_string, "status": status}, indent=None)
+
+
+def load_service_state(service):
+    """
+    Get the recorded state of a service.
+
+    Parameters
+    ----------
+    service : str
+        Service name
+
+    Returns
+    -------
+    dict | None
+        ``{"compose_file": ..., "status": ...}``, or None if the service
+        was not started by nbs-pods or a file of its chain no longer exists
+    """
+    try:
+        with open(_get_state_file(service), encoding="utf-8") as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not all(os.path.exists(f) for f in state["compose_file"].split(":")):
+        return None
+    return state
+
+
+def set_service_status(service, status):
+    """
+    Update the recorded status of a service, if it has a recorded state.
+
+    Parameters
+    ----------
+    service : str
+        Service name
+    status : str
+        RUNNING, PAUSED or STOPPED
+    """
+    state = load_service_state(service)
+    if state is not None:
+        save_service_state(service, state["compose_file"], status)
+
+
+def clear_service_state(service):
+    """
+    Forget the recorded state of a service, e.g. after ``down``.
+
+    Parameters
+    ----------
+    service : str
+        Service name
+    """
+    try:
+        os.remove(_get_state_file(service))
+    except FileNotFoundError:
+        pass
+
+
+def get_services_with_status(statuses):
+    """
+    Get the services whose recorded status is one of ``statuses``.
+
+    Parameters
+    ----------
+    statuses : list[str]
+        Statuses to select
+
+    Returns
+    -------
+    list[str]
+        Sorted service names
+    """
+    services_dir = get_state_dir() / "services"
+    if not services_dir.is_dir():
+        return []
+    services = []
+    for state_file in sorted(services_dir.glob("*.json")):
+        state = load_service_state(state_file.stem)
+        if state is not None and state["status"] in statuses:
+            services.append(state_file.stem)
+    return services
@@ -2,7 +2,6 @@
 """Deployment script for beamline pods."""
 
 import os
-import subprocess
 import sys
 from pathlib import Path
 
@@ -19,10 +18,10 @@ def main():
     if not args:
         args = ["start"]
 
+    # Run nbs-pods in this interpreter instead of starting a second one
     try:
-        result = subprocess.run(["nbs-pods"] + args, check=False)
-        sys.exit(result.returncode)
-    except FileNotFoundError:
+        from nbs_pods.cli import main as nbs_pods_main
+    except ImportError:
         print(
             "Error: nbs-pods CLI not found. Make sure nbs-pods is installed.",
             file=sys.stderr,
@@ -30,6 +29,8 @@ def main():
         print("Run: pixi install", file=sys.stderr)
         sys.exit(1)
 
+    nbs_pods_main(args)
+
 
 if __name__ == "__main__":
     main()
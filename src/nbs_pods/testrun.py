@@ -0,0 +1,430 @@
+"""Concurrent, isolated runs of the services' test variants, for ``nbs-pods test``.
+
+A service's test variant is its compose chain with ``docker-compose.test.yml``
+applied, run until the container named like the service exits, as
+``nbs-pods start --test`` does. Here every test runs in a compose project
+of its own (``nbstest<run>-<service>``), merged into one compose file with
+the services' host ports and fixed container names removed, so tests do
+not collide with each other or with the running services. A test that
+uses the bluesky-services network gets a network of its own instead, which
+the running containers of the services it depends on join under their
+compose service names; tests reach ``mongo``, ``kafka`` or ``queueserver``
+as usual, but not each other.
+
+Each test's output is written to a log file; exit codes, durations and the
+end of the output of failed tests are collected into a report that can be
+written as JUnit XML and as JSON.
+"""
+
+import json
+import re
+import subprocess
+import time
+import uuid
+
+from nbs_pods.compose import (
+    build_compose_file_string,
+    get_compose_override,
+    get_compose_project,
+    load_compose_chain,
+)
+from nbs_pods.config import get_beamline_name, get_cache_dir, get_state_dir, write_json
+from nbs_pods.shared import (
+    SHARED_NETWORK,
+    SHARED_SERVICE,
+    connect_project_network,
+    disconnect_project_network,
+    is_shared_mode,
+    load_shared_state,
+)
+from nbs_pods.state import RUNNING, load_service_state
+
+TEST_KEY = "test"
+PASSED = "passed"
+FAILED = "failed"
+ERROR = "error"
+TIMEOUT = "timeout"
+# Lines of output kept in the report of a test that did not pass
+REPORT_LINES = 50
+
+
+def get_test_services(services):
+    """
+    Get the services that have a test variant.
+
+    Parameters
+    ----------
+    services : list[str]
+        Service names
+
+    Returns
+    -------
+    list[str]
+        Services with a ``docker-compose.test.yml``
+    """
+    return [service for service in services if get_compose_override(service, key=TEST_KEY)]
+
+
+def get_test_project(run_id, service):
+    """Get the compose project of a service's test in a run."""
+    return re.sub(r"[^a-z0-9_-]", "", f"nbstest{run_id}-{service}".lower())
+
+
+def get_running_project(service):
+    """
+    Get the compose project of a running service.
+
+    Parameters
+    ----------
+    service : str
+        nbs-pods service name
+
+    Returns
+    -------
+    str | None
+        Compose project, or None if the service is not running
+    """
+    if service == SHARED_SERVICE and is_shared_mode():
+        compose_file = load_shared_state()["compose_file"]
+        return get_compose_project(compose_file) if compose_file else None
+    state = load_service_state(service)
+    if state is None or state.get("status", RUNNING) != RUNNING:
+        return None
+    return get_compose_project(state["compose_file"])
+
+
+def build_test_document(compose_file_string, network):
+    """
+    Merge a test variant into one compose document isolated from other projects.
+
+    Parameters
+    ----------
+    compose_file_string : str
+        Colon-separated compose file chain of the test variant
+    network : str
+        Network that replaces the bluesky-services network
+
+    Returns
+    -------
+    tuple[dict, bool]
+        (document, whether the test uses the bluesky-services network)
+    """
+    compose_doc = load_compose_chain(compose_file_string)
+    for definition in (compose_doc.get("services") or {}).values():
+        definition.pop("ports", None)
+        definition.pop("container_name", None)
+    networks = compose_doc.get("networks") or {}
+    shared = SHARED_NETWORK in networks and (networks[SHARED_NETWORK] or {}).get("external")
+    if shared:
+        networks[SHARED_NETWORK] = {"external": True, "name": network}
+    return compose_doc, bool(shared)
+
+
+def _tail(path, lines=REPORT_LINES):
+    try:
+        with open(path, encoding="utf-8", errors="replace") as f:
+            return "".join(f.readlines()[-lines:])
+    except OSError:
+        return ""
+
+
+class TestRun:
+    """One run of the test variants of several services."""
+
+    def __init__(self, services, all_services, env, override_keys, gui_services, timeout=None, keep=False):
+        self.run_id = uuid.uuid4().hex[:6]
+        self.services = services
+        self.all_services = all_services
+        self.override_keys = override_keys
+        self.gui_services = gui_services
+        self.env = dict(env)
+        self.env.pop("COMPOSE_FILE", None)
+        self.env.pop("COMPOSE_PROJECT_NAME", None)
+        self.timeout = timeout
+        self.keep = keep
+        self.log_dir = get_state_dir() / TEST_KEY / f"{time.strftime('%Y%m%d-%H%M%S')}-{self.run_id}"
+
+    def prepare(self, service, project):
+        """Write the test's compose file and connect its dependencies to its network."""
+        from nbs_pods.services import get_service_dependencies
+
+        compose_file_string = build_compose_file_string(
+            service, gui_services=self.gui_services, override_keys=self.override_keys
+        )
+        network = f"{project}_{SHARED_NETWORK}"
+        compose_doc, shared = build_test_document(compose_file_string, network)
+
+        dependencies = {}
+        for dependency in get_service_dependencies(service, self.all_services, self.gui_services):
+            dependency_project = get_running_project(dependency)
+            if dependency_project is None:
+                raise RuntimeError(f"{dependency} is not running; start it with `nbs-pods start {dependency}`")
+            dependencies[dependency] = dependency_project
+        if shared:
+            try:
+                for dependency_project in dependencies.values():
+                    connect_project_network(dependency_project, network)
+            except RuntimeError:
+                self.remove_network(network, dependencies)
+                raise
+        compose_file = write_json(get_cache_dir() / TEST_KEY / f"{project}.yml", compose_doc)
+        return compose_file, compose_doc, network if shared else None, dependencies
+
+    def cleanup(self, project, compose_file, network, dependencies, log):
+        command = ["podman-compose", "-p", project, "-f", str(compose_file), "down", "-v"]
+        subprocess.run(command, env=self.env, stdout=log, stderr=subprocess.STDOUT)
+        if network is not None:
+            self.remove_network(network, dependencies)
+        compose_file.unlink(missing_ok=True)
+
+    def remove_network(self, network, dependencies):
+        for dependency_project in dependencies.values():
+            disconnect_project_network(dependency_project, network)
+        subprocess.run(["podman", "network", "rm", "-f", network], capture_output=True)
+
+    def run_test(self, service):
+        """
+        Run the test variant of a service.
+
+        Parameters
+        ----------
+        service : str
+            Service name
+
+        Returns
+        -------
+        dict
+            Result with ``service``, ``project``, ``status``, ``exit_code``,
+            ``duration``, ``log`` and, unless the test passed, ``output``
+        """
+        from nbs_pods.logs import keep_logs
+
+        project = get_test_project(self.run_id, service)
+        log_file = self.log_dir / f"{service}.log"
+        self.log_dir.mkdir(parents=True, exist_ok=True)
+        result = {"service": service, "project": project, "exit_code": None, "log": str(log_file)}
+        start = time.monotonic()
+        with open(log_file, "w", encoding="utf-8") as log:
+            try:
+                compose_file, compose_doc, network, dependencies = self.prepare(service, project)
+            except RuntimeError as e:
+                log.write(f"{e}\n")
+                result.update(status=ERROR, duration=time.monotonic() - start, message=str(e))
+                result["output"] = str(e)
+                return result
+
+            command = ["podman-compose", "-p", project, "-f", str(compose_file), "up", "--abort-on-container-exit"]
+            if service in (compose_doc.get("services") or {}):
+                command += ["--exit-code-from", service]
+            log.flush()
+            try:
+                process = subprocess.Popen(
+                    command, env=self.env, stdout=log, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL
+                )
+                try:
+                    exit_code = process.wait(timeout=self.timeout)
+                    status = PASSED if exit_code == 0 else FAILED
+                    message = None if exit_code == 0 else f"exited with code {exit_code}"
+                except subprocess.TimeoutExpired:
+                    process.terminate()
+                    exit_code = process.wait()
+                    status = TIMEOUT
+                    message = f"timed out after {self.timeout:g} s"
+                result.update(exit_code=exit_code, status=status, duration=time.monotonic() - start)
+                if message:
+                    result["message"] = message
+            except OSError as e:
+                result.update(status=ERROR, duration=time.monotonic() - start, message=str(e))
+            finally:
+                keep_logs(service, project)
+                if not self.keep:
+                    self.cleanup(project, compose_file, network, dependencies, log)
+        if result["status"] != PASSED:
+            result["output"] = _tail(log_file)
+        return result
+
+    def run(self, jobs):
+        """
+        Run the tests concurrently.
+
+        Parameters
+        ----------
+        jobs : int
+            Number of tests run at a time
+
+        Returns
+        -------
+        dict
+            Report with the ``run``, ``beamline``, ``time``, ``duration``,
+            ``log_dir`` and the result of every test in ``tests``
+        """
+        from nbs_pods.scheduler import run_in_dependency_order
+
+        started = time.time()
+        start = time.monotonic()
+
+        def run_and_report(service):
+            result = self.run_test(service)
+            print(
+                f"{result['status'].upper():7} {service} ({result['duration']:.1f} s)"
+                + (f": {result['message']}" if result.get("message") else "")
+                + "\n",
+                end="",
+                flush=True,
+            )
+            return result
+
+        results, errors, _ = run_in_dependency_order(
+            {service: set() for service in self.services}, run_and_report, max_workers=jobs
+        )
+        tests = []
+        for service in self.services:
+            if service in results:
+                tests.append(results[service])
+            else:
+                error = errors.get(service)
+                tests.append({
+                    "service": service,
+                    "project": get_test_project(self.run_id, service),
+                    "status": ERROR,
+                    "exit_code": None,
+                    "duration": 0.0,
+                    "message": str(error),
+                    "output": str(error),
+                })
+        return {
+            "run": self.run_id,
+            "beamline": get_beamline_name(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z", time.localtime(started)),
+            "duration": time.monotonic() - start,
+            "log_dir": str(self.log_dir),
+            "tests": tests,
+        }
+
+
+def format_report(report):
+    """
+    Format a test report as a table.
+
+    Parameters
+    ----------
+    report : dict
+        Report from ``TestRun.run``
+
+    Returns
+    -------
+    str
+        Report text
+    """
+    rows = [("SERVICE", "STATUS", "EXIT", "TIME")]
+    for test in report["tests"]:
+        rows.append((
+            test["service"],
+            test["status"],
+            "-" if test["exit_code"] is None else str(test["exit_code"]),
+            f"{test['duration']:.1f} s",
+        ))
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    lines = [
+        "  ".join(
+            cell.ljust(width) if i < 2 else cell.rjust(width)
+            for i, (cell, width) in enumerate(zip(row, widths))
+        ).rstrip()
+        for row in rows
+    ]
+    passed = sum(1 for test in report["tests"] if test["status"] == PASSED)
+    lines += [
+        "",
+        f"{passed}/{len(report['tests'])} passed in {report['duration']:.1f} s; "
+        f"logs in {report['log_dir']}",
+    ]
+    return "\n".join(lines)
+
+
+def write_junit(report, path):
+    """
+    Write a test report as JUnit XML.
+
+    Parameters
+    ----------
+    report : dict
+        Report from ``TestRun.run``
+    path : str
+        Output file
+    """
+    import xml.etree.ElementTree as ET
+
+    tests = report["tests"]
+    suite = ET.Element(
+        "testsuite",
+        name=f"nbs-pods.{report['beamline']}",
+        tests=str(len(tests)),
+        failures=str(sum(1 for test in tests if test["status"] in (FAILED, TIMEOUT))),
+        errors=str(sum(1 for test in tests if test["status"] == ERROR)),
+        time=f"{report['duration']:.3f}",
+        timestamp=report["time"],
+    )
+    for test in tests:
+        case = ET.SubElement(
+            suite,
+            "testcase",
+            classname=f"nbs-pods.{report['beamline']}",
+            name=test["service"],
+            time=f"{test['duration']:.3f}",
+        )
+        if test["status"] != PASSED:
+            tag = "error" if test["status"] == ERROR else "failure"
+            element = ET.SubElement(case, tag, message=test.get("message") or test["status"])
+            element.text = test.get("output", "")
+        if test.get("log"):
+            ET.SubElement(case, "system-out").text = f"Log: {test['log']}"
+    testsuites = ET.Element("testsuites")
+    testsuites.append(suite)
+    if hasattr(ET, "indent"):
+        # Python 3.9+; older versions write the XML on one line
+        ET.indent(testsuites)
+    ET.ElementTree(testsuites).write(path, encoding="utf-8", xml_declaration=True)
+
+
+def write_json_report(report, path):
+    """Write a test report as JSON."""
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+        f.write("\n")
+
+
+def run_tests(services, all_services, env, override_keys, gui_services, jobs, timeout=None, keep=False):
+    """
+    Run the test variants of services concurrently.
+
+    Parameters
+    ----------
+    services : list[str]
+        Services to test
+    all_services : list[str]
+        All known services, used to resolve dependencies
+    env : dict
+        Environment of podman-compose
+    override_keys : list[str]
+        Override keys of the test variants, including 'test'
+    gui_services : list[str]
+        Services with display protocol specific compose files
+    jobs : int
+        Number of tests run at a time
+    timeout : float, optional
+        Seconds after which a test is stopped and counts as failed
+    keep : bool
+        Whether to keep the tests' containers, networks and compose files
+
+    Returns
+    -------
+    dict
+        Report, see ``TestRun.run``
+    """
+    test_run = TestRun(services, all_services, env, override_keys, gui_services, timeout, keep)
+    print(
+        f"Testing {', '.join(services)} ({jobs} at a time); logs in {test_run.log_dir}\n",
+        end="",
+        flush=True,
+    )
+    return test_run.run(jobs)
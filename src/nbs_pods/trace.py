@@ -0,0 +1,303 @@
+"""Bring-up timeline tracing in Chrome trace format.
+
+Spans are recorded per service, so services brought up concurrently show up
+as separate rows when the trace is opened in ``chrome://tracing`` or
+Perfetto. Spans that overlap within a service, such as concurrent container
+creation or readiness probes, go on their own ``<service>/<detail>`` rows.
+Tracing is off unless ``enable_tracing`` is called, until then ``span`` is a
+no-op.
+"""
+
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+MAIN_ROW = "nbs-pods"
+STACK_SERVICE_LABEL = "io.nbs-pods.service"
+
+_lock = threading.Lock()
+_events = []
+_rows = {}
+_origin = None
+
+
+def enable_tracing():
+    """Start recording spans, with timestamps relative to now."""
+    global _origin
+    _origin = (time.perf_counter(), time.time())
+
+
+def is_tracing():
+    """Whether spans are being recorded."""
+    return _origin is not None
+
+
+def _get_row(row):
+    with _lock:
+        if row not in _rows:
+            _rows[row] = len(_rows)
+        return _rows[row]
+
+
+def _to_us(perf_time):
+    return (perf_time - _origin[0]) * 1e6
+
+
+def add_span(name, category, start, end, service=None, args=None, row=None):
+    """
+    Record a span measured elsewhere.
+
+    Parameters
+    ----------
+    name : str
+        Span name
+    category : str
+        Phase, e.g. 'resolve', 'pull' or 'ready'; summarized per service
+    start, end : float
+        ``time.perf_counter()`` values
+    service : str, optional
+        Service the span belongs to
+    args : dict, optional
+        Extra data shown in the trace viewer
+    row : str, optional
+        Detail within the service, for spans that overlap other spans of
+        the same service
+    """
+    if _origin is None:
+        return
+    service = service or MAIN_ROW
+    event = {
+        "name": name,
+        "cat": category,
+        "ph": "X",
+        "ts": _to_us(start),
+        "dur": max(0.0, (end - start) * 1e6),
+        "pid": 1,
+        "tid": _get_row(f"{service}/{row}" if row else service),
+        "args": dict(args or {}, service=service),
+    }
+    with _lock:
+        _events.append(event)
+
+
+def add_instant(name, category, timestamp, service=None, args=None, row=None):
+    """Record a point in time, given as a ``time.perf_counter()`` value."""
+    if _origin is None:
+        return
+    service = service or MAIN_ROW
+    event = {
+        "name": name,
+        "cat": category,
+        "ph": "i",
+        "s": "t",
+        "ts": _to_us(timestamp),
+        "pid": 1,
+        "tid": _get_row(f"{service}/{row}" if row else service),
+        "args": dict(args or {}, service=service),
+    }
+    with _lock:
+        _events.append(event)
+
+
+@contextmanager
+def span(name, category, service=None, row=None, **args):
+    """
+    Record the duration of a block as a span.
+
+    Parameters
+    ----------
+    name : str
+        Span name
+    category : str
+        Phase the span belongs to
+    service : str, optional
+        Service the span belongs to
+    row : str, optional
+        Detail within the service, for spans that overlap other spans of
+        the same service
+    **args
+        Extra data shown in the trace viewer
+    """
+    if _origin is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_span(name, category, start, time.perf_counter(), service, args, row)
+
+
+def wall_to_perf(wall_time):
+    """Convert a ``time.time()`` value to the ``time.perf_counter()`` clock."""
+    return _origin[0] + (wall_time - _origin[1])
+
+
+def add_podman_events():
+    """
+    Add image pull and container create/start times reported by podman.
+
+    podman-compose does not report when it pulls, creates or starts a
+    container, but ``podman events`` does. Create spans run from a
+    container's create to its init event, start spans from init to start.
+    Pull events only mark completion, so a pull span runs from the start of
+    the service's bring-up (or its previous pull) to the pull event. Launch
+    spans run from a container's start to the first line it logs, which
+    covers its entrypoint getting the service process going, e.g. ``pixi
+    run`` before the queueserver.
+
+    Containers are matched to services by the ``project`` argument of the
+    services' ``up`` spans, or by the stack service label.
+    """
+    from nbs_pods.logs import get_first_line_time
+    from nbs_pods.podman import get_events
+
+    if _origin is None:
+        return
+    events = get_events(_origin[1], time.time())
+
+    # Image events carry no project label; attribute pulls to the service
+    # whose bring-up span contains them
+    up_spans = [
+        (event["ts"], event["ts"] + event["dur"], event["args"]["service"])
+        for event in list(_events)
+        if event["cat"] == "up"
+    ]
+    pull_start = {service: start for start, _, service in up_spans}
+    project_services = {
+        event["args"]["project"]: event["args"]["service"]
+        for event in list(_events)
+        if event["cat"] == "up" and "project" in event["args"]
+    }
+    containers = {}
+    for event in events:
+        timestamp = wall_to_perf(event["timeNano"] / 1e9)
+        attributes = event.get("Attributes") or {}
+        if event.get("Type") == "image" and event.get("Status") == "pull":
+            ts = _to_us(timestamp)
+            for start, end, service in up_spans:
+                if start <= ts <= end:
+                    begin = _origin[0] + max(pull_start[service], start) / 1e6
+                    add_span(f"pull {event.get('Name')}", "pull", begin, timestamp, service, row="pull")
+                    pull_start[service] = ts
+                    break
+            continue
+        if event.get("Type") != "container":
+            continue
+        service = attributes.get(STACK_SERVICE_LABEL) or project_services.get(
+            attributes.get("com.docker.compose.project")
+        )
+        if service is None:
+            continue
+        name = event.get("Name")
+        times = containers.setdefault(name, {"service": service})
+        times[event.get("Status")] = timestamp
+
+    for name, times in containers.items():
+        service = times["service"]
+        if "create" in times and "init" in times:
+            add_span(f"create {name}", "create", times["create"], times["init"], service, row=name)
+        if "init" in times and "start" in times:
+            add_span(f"start {name}", "start", times["init"], times["start"], service, row=name)
+        elif "start" in times:
+            add_instant(f"start {name}", "start", times["start"], service, row=name)
+        if "start" in times:
+            first_line = get_first_line_time(name, since=_origin[1])
+            if first_line is not None and wall_to_perf(first_line) >= times["start"]:
+                launched = wall_to_perf(first_line)
+                add_span(f"launch {name}", "launch", times["start"], launched, service, row=name)
+
+
+def write_trace(trace_file):
+    """
+    Write the recorded spans as Chrome trace JSON.
+
+    Parameters
+    ----------
+    trace_file : str
+        Output path
+    """
+    with _lock:
+        events = sorted(_events, key=lambda event: event["ts"])
+        rows = dict(_rows)
+    metadata = [
+        {"name": "thread_name", "ph": "M", "pid": 1, "tid": tid, "args": {"name": service}}
+        for service, tid in rows.items()
+    ]
+    metadata.append(
+        {"name": "process_name", "ph": "M", "pid": 1, "args": {"name": "nbs-pods"}}
+    )
+    with open(trace_file, "w", encoding="utf-8") as f:
+        json.dump({"traceEvents": metadata + events, "displayTimeUnit": "ms"}, f)
+
+
+def _union_length(intervals):
+    """Total length covered by possibly overlapping intervals."""
+    total = 0.0
+    current_start = current_end = None
+    for start, end in sorted(intervals):
+        if current_end is None or start > current_end:
+            if current_end is not None:
+                total += current_end - current_start
+            current_start, current_end = start, end
+        else:
+            current_end = max(current_end, end)
+    if current_end is not None:
+        total += current_end - current_start
+    return total
+
+
+def get_summary():
+    """
+    Summarize the recorded spans per service and phase.
+
+    Overlapping spans of a phase, e.g. containers created concurrently,
+    count once, so every value is wall time.
+
+    Returns
+    -------
+    tuple[list[str], dict[str, dict[str, float]]]
+        (phases, summary) where ``summary`` maps each service to the seconds
+        spent per phase, plus the time from its first span starting to its
+        last span ending under ``"total"``
+    """
+    phases = []
+    intervals = {}
+    with _lock:
+        events = [event for event in _events if event["ph"] == "X"]
+    for event in events:
+        service = event["args"]["service"]
+        phase = event["cat"]
+        if phase not in phases:
+            phases.append(phase)
+        interval = (event["ts"], event["ts"] + event["dur"])
+        service_intervals = intervals.setdefault(service, {})
+        service_intervals.setdefault(phase, []).append(interval)
+        service_intervals.setdefault("total", []).append(interval)
+
+    summary = {}
+    for service, phase_intervals in intervals.items():
+        all_intervals = phase_intervals.pop("total")
+        summary[service] = {
+            phase: _union_length(spans) / 1e6 for phase, spans in phase_intervals.items()
+        }
+        start = min(interval[0] for interval in all_intervals)
+        end = max(interval[1] for interval in all_intervals)
+        summary[service]["total"] = (end - start) / 1e6
+    return phases, summary
+
+
+def print_summary():
+    """Print a table of seconds spent per service and phase."""
+    phases, summary = get_summary()
+    if not summary:
+        return
+    width = max(len(service) for service in summary) + 2
+    columns = [phase for phase in phases if phase != "cli"] + ["total"]
+    print(f"\n{'service':<{width}}" + "".join(f"{phase:>9}" for phase in columns))
+    for service, totals in summary.items():
+        cells = "".join(
+            f"{totals[phase]:>8.2f}s" if phase in totals else f"{'-':>9}" for phase in columns
+        )
+        print(f"{service:<{width}}{cells}")